@@ -0,0 +1,41 @@
+import argparse
+import json
+import time
+from squirrel_server import compressBody, zstandard
+
+# Compares the bytes each content encoding saves on a GET /squirrels body
+# against the CPU it costs to compress it.
+#
+#   python bench_compression.py --rows 10000 --repeat 20
+
+def makeBody(rows):
+    squirrels = [{"id": i + 1, "name": "squirrel{}".format(i), "size": ("small", "medium", "large")[i % 3]}
+                 for i in range(rows)]
+    return bytes(json.dumps(squirrels), "utf-8")
+
+def measure(body, encoding, level, repeat):
+    start = time.process_time()
+    for i in range(repeat):
+        compressed = compressBody(body, encoding, level)
+    elapsed = (time.process_time() - start) / repeat
+    return len(compressed), elapsed
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=10000)
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    body = makeBody(args.rows)
+    scenarios = [("gzip", 1), ("gzip", 6), ("gzip", 9), ("deflate", 6)]
+    if zstandard is not None:
+        scenarios += [("zstd", 1), ("zstd", 3), ("zstd", 9)]
+
+    print("identity              {:10d} bytes".format(len(body)))
+    for encoding, level in scenarios:
+        size, elapsed = measure(body, encoding, level, args.repeat)
+        print("{:8s} level {:2d}      {:10d} bytes  {:5.1f}% saved  {:8.2f} ms cpu".format(
+            encoding, level, size, 100.0 * (len(body) - size) / len(body), elapsed * 1000))
+
+if __name__ == '__main__':
+    main()
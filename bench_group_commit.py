@@ -0,0 +1,81 @@
+import argparse
+import http.client
+import os
+import shutil
+import tempfile
+import threading
+import time
+from squirrel_db import GroupCommitter, SquirrelDB, SquirrelDBPool
+from squirrel_server import SquirrelServerHandler, ThreadPoolHTTPServer
+
+# Measures POST /squirrels throughput from many concurrent clients with the
+# old rollback journal, with WAL, and with WAL plus the group committer.
+#
+#   python bench_group_commit.py --clients 16 --writes 200
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+SCENARIOS = [
+    ("rollback journal, commit per write", "DELETE", "FULL", False),
+    ("WAL, commit per write", "WAL", "NORMAL", False),
+    ("WAL, commit per write, synchronous=FULL", "WAL", "FULL", False),
+    ("WAL, group commit, synchronous=FULL", "WAL", "FULL", True),
+]
+
+def client(address, writes, errors):
+    conn = http.client.HTTPConnection(*address)
+    for i in range(writes):
+        conn.request("POST", "/squirrels", body="name=bench{}&size=small".format(i),
+                     headers={"Content-Type": "application/x-www-form-urlencoded"})
+        response = conn.getresponse()
+        response.read()
+        if response.status != 201:
+            errors.append(response.status)
+    conn.close()
+
+def measure(filename, clients, writes, journalMode, synchronous, groupCommit):
+    SquirrelDB.journalMode = journalMode
+    SquirrelDB.synchronous = synchronous
+    SquirrelServerHandler.dbPool = SquirrelDBPool(size=clients, filename=filename)
+    SquirrelServerHandler.groupCommitter = GroupCommitter(filename, synchronous=synchronous) if groupCommit else None
+    SquirrelServerHandler.log_message = lambda *args: None
+    server = ThreadPoolHTTPServer(("127.0.0.1", 0), SquirrelServerHandler, workers=clients)
+    serverThread = threading.Thread(target=server.serve_forever)
+    serverThread.start()
+    errors = []
+    try:
+        threads = [threading.Thread(target=client, args=(server.server_address, writes, errors))
+                   for i in range(clients)]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+    finally:
+        server.shutdown()
+        server.server_close()
+        if SquirrelServerHandler.groupCommitter is not None:
+            SquirrelServerHandler.groupCommitter.close()
+        SquirrelServerHandler.dbPool.close()
+    if errors:
+        raise RuntimeError("{} writes failed".format(len(errors)))
+    return clients * writes / elapsed
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--clients", type=int, default=16)
+    parser.add_argument("--writes", type=int, default=200, help="POSTs per client")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp()
+    try:
+        for label, journalMode, synchronous, groupCommit in SCENARIOS:
+            filename = os.path.join(workdir, "{}.db".format(len(os.listdir(workdir))))
+            shutil.copyfile(os.path.join(HERE, "empty_squirrel_db.db"), filename)
+            rate = measure(filename, args.clients, args.writes, journalMode, synchronous, groupCommit)
+            print("{:42s} {:8.1f} writes/s".format(label, rate))
+    finally:
+        shutil.rmtree(workdir)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,234 @@
+import argparse
+import http.client
+import json
+import multiprocessing
+import os
+import random
+import shlex
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from squirrel_db import SquirrelDB
+
+# Load-tests squirrel_server end to end: the real server runs in its own
+# process on a free loopback port over a seeded scratch database, and
+# client threads spread over several processes drive a weighted mix of
+# requests for a fixed time, once over keep-alive connections and once
+# with a new connection per request. RPS and p50/p95/p99 latency go to
+# a JSON file; given a baseline file from an earlier run on the same
+# machine, the run fails when throughput drops or latency rises past
+# the tolerances.
+#
+#   python bench_load.py --clients 32 --duration 10 --save-baseline bench_load_baseline.json
+#   python bench_load.py --clients 32 --duration 10 --baseline bench_load_baseline.json
+#   python bench_load.py --mix get=50,create=50 --server-args "--group-commit"
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+SIZES = ("small", "medium", "large")
+EXPECTED = {"get": 200, "list": 200, "create": 201, "update": 200}
+CONNECTIONS = ("keepalive", "new")
+FORM = {"Content-Type": "application/x-www-form-urlencoded"}
+
+def parseMix(text):
+    mix = {}
+    for part in text.split(","):
+        name, _, weight = part.partition("=")
+        if name not in EXPECTED:
+            raise argparse.ArgumentTypeError("operations are " + ", ".join(EXPECTED))
+        mix[name] = float(weight)
+    if sum(mix.values()) <= 0:
+        raise argparse.ArgumentTypeError("the mix needs a positive weight")
+    return mix
+
+def freePort():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def startServer(filename, serverArgs):
+    port = freePort()
+    process = subprocess.Popen([sys.executable, os.path.join(HERE, "squirrel_server.py"), "--host", "127.0.0.1",
+                                "--port", str(port), "--db", filename, "--no-access-log"] + serverArgs,
+                               stdout=subprocess.DEVNULL)
+    deadline = time.monotonic() + 10
+    while True:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return process, port
+        except OSError:
+            if process.poll() is not None or time.monotonic() > deadline:
+                process.kill()
+                raise RuntimeError("squirrel_server did not start")
+            time.sleep(0.05)
+
+def stopServer(process):
+    process.send_signal(signal.SIGTERM)
+    try:
+        process.wait(timeout=10)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+
+def sendRequest(conn, operation, rng, seedRows, headers):
+    if operation == "get":
+        conn.request("GET", "/squirrels/{}".format(rng.randint(1, seedRows)), headers=headers)
+    elif operation == "list":
+        conn.request("GET", "/squirrels?limit=50&after_id={}".format(rng.randint(0, seedRows)), headers=headers)
+    elif operation == "create":
+        conn.request("POST", "/squirrels", body="name=load{}&size={}".format(rng.randint(0, 1 << 30), rng.choice(SIZES)),
+                     headers=dict(headers, **FORM))
+    else:
+        conn.request("PUT", "/squirrels/{}".format(rng.randint(1, seedRows)),
+                     body="name=load{}&size={}".format(rng.randint(0, 1 << 30), rng.choice(SIZES)),
+                     headers=dict(headers, **FORM))
+    response = conn.getresponse()
+    response.read()
+    return response.status
+
+def clientThread(port, mix, keepAlive, seedRows, seed, window, results):
+    # records (operation, seconds, ok) for requests started inside window
+    rng = random.Random(seed)
+    operations, weights = list(mix), list(mix.values())
+    headers = {} if keepAlive else {"Connection": "close"}
+    measureFrom, stopAt = window
+    conn = None
+    while True:
+        started = time.time()
+        if started >= stopAt:
+            break
+        operation = rng.choices(operations, weights)[0]
+        if conn is None:
+            conn = http.client.HTTPConnection("127.0.0.1", port, timeout=30)
+        begin = time.perf_counter()
+        try:
+            ok = sendRequest(conn, operation, rng, seedRows, headers) == EXPECTED[operation]
+        except (OSError, http.client.HTTPException):
+            ok = False
+            conn.close()
+            conn = None
+        elapsed = time.perf_counter() - begin
+        if not keepAlive and conn is not None:
+            conn.close()
+            conn = None
+        if started >= measureFrom:
+            results.append((operation, elapsed, ok))
+    if conn is not None:
+        conn.close()
+
+def clientProcess(port, threads, mix, keepAlive, seedRows, seed, startAt, window):
+    results = []
+    workers = [threading.Thread(target=clientThread, args=(port, mix, keepAlive, seedRows, seed + i, window, results))
+               for i in range(threads)]
+    time.sleep(max(0.0, startAt - time.time()))
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return results
+
+def percentile(ordered, share):
+    # nearest rank, in milliseconds
+    if not ordered:
+        return None
+    return round(ordered[min(len(ordered) - 1, max(0, int(share * len(ordered) + 0.5) - 1))] * 1000, 3)
+
+def summarize(results, seconds):
+    latencies = sorted(elapsed for operation, elapsed, ok in results)
+    return {"requests": len(results), "errors": sum(1 for operation, elapsed, ok in results if not ok),
+            "rps": round(len(results) / seconds, 1), "p50_ms": percentile(latencies, 0.50),
+            "p95_ms": percentile(latencies, 0.95), "p99_ms": percentile(latencies, 0.99)}
+
+def runScenario(args, workdir, connections):
+    # a fresh file per scenario; a stopped server may leave -wal and -shm
+    # files next to its database, which must not meet a new copy of it
+    keepAlive = connections == "keepalive"
+    filename = os.path.join(workdir, connections + ".db")
+    shutil.copyfile(os.path.join(HERE, "empty_squirrel_db.db"), filename)
+    db = SquirrelDB(filename)
+    db.createSquirrels([("squirrel{}".format(i), SIZES[i % 3]) for i in range(args.seed_rows)])
+    db.close()
+    process, port = startServer(filename, shlex.split(args.server_args))
+    try:
+        processes = min(args.client_processes, args.clients)
+        startAt = time.time() + 1.0
+        window = (startAt + args.warmup, startAt + args.warmup + args.duration)
+        jobs = [(port, args.clients // processes + (1 if i < args.clients % processes else 0), args.mix, keepAlive,
+                 args.seed_rows, i * 1000, startAt, window) for i in range(processes)]
+        with multiprocessing.Pool(processes) as pool:
+            results = [result for chunk in pool.starmap(clientProcess, jobs) for result in chunk]
+    finally:
+        stopServer(process)
+    scenario = summarize(results, args.duration)
+    scenario["operations"] = {operation: summarize([result for result in results if result[0] == operation], args.duration)
+                              for operation in args.mix}
+    return scenario
+
+def regressions(report, baseline, maxRpsDrop, maxLatencyRise):
+    found = []
+    for name, scenario in report["scenarios"].items():
+        base = baseline.get("scenarios", {}).get(name)
+        if base is None:
+            continue
+        if scenario["errors"] > base.get("errors", 0):
+            found.append("{}: {} errors (baseline {})".format(name, scenario["errors"], base.get("errors", 0)))
+        if scenario["rps"] < base["rps"] * (1 - maxRpsDrop):
+            found.append("{}: {} rps (baseline {})".format(name, scenario["rps"], base["rps"]))
+        for key in ("p50_ms", "p95_ms", "p99_ms"):
+            if scenario[key] is not None and base.get(key) and scenario[key] > base[key] * (1 + maxLatencyRise):
+                found.append("{}: {} {} (baseline {})".format(name, key, scenario[key], base[key]))
+    return found
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--clients", type=int, default=32, help="concurrent clients")
+    parser.add_argument("--client-processes", type=int, default=min(4, os.cpu_count() or 1),
+                        help="processes the clients are spread over")
+    parser.add_argument("--duration", type=float, default=10.0, help="measured seconds per scenario")
+    parser.add_argument("--warmup", type=float, default=1.0, help="unmeasured seconds before each scenario")
+    parser.add_argument("--mix", type=parseMix, default=parseMix("get=70,list=10,create=10,update=10"),
+                        help="weighted operations out of get, list, create and update")
+    parser.add_argument("--connections", choices=CONNECTIONS + ("both",), default="both",
+                        help="reuse connections, open one per request, or run both scenarios")
+    parser.add_argument("--seed-rows", type=int, default=1000, help="squirrels in the database to start with")
+    parser.add_argument("--server-args", default="", help="extra squirrel_server.py flags, e.g. '--group-commit'")
+    parser.add_argument("--output", default="bench_load_results.json", help="where the results are written")
+    parser.add_argument("--baseline", help="results file to compare against; regressions exit with status 1")
+    parser.add_argument("--save-baseline", help="also write the results here, as the baseline for later runs")
+    parser.add_argument("--max-rps-drop", type=float, default=0.15, help="tolerated share of throughput lost")
+    parser.add_argument("--max-latency-rise", type=float, default=0.25, help="tolerated share of latency added")
+    args = parser.parse_args()
+
+    report = {"config": {"clients": args.clients, "duration": args.duration, "mix": args.mix,
+                         "seed_rows": args.seed_rows, "server_args": args.server_args},
+              "scenarios": {}}
+    workdir = tempfile.mkdtemp()
+    try:
+        for connections in CONNECTIONS:
+            if args.connections in (connections, "both"):
+                report["scenarios"][connections] = runScenario(args, workdir, connections)
+    finally:
+        shutil.rmtree(workdir)
+
+    for path in filter(None, (args.output, args.save_baseline)):
+        with open(path, "w") as f:
+            json.dump(report, f, indent=2)
+            f.write("\n")
+    for name, scenario in report["scenarios"].items():
+        print("{:10s} {:9.1f} rps  p50 {:7.2f} ms  p95 {:7.2f} ms  p99 {:7.2f} ms  {} errors".format(
+            name, scenario["rps"], scenario["p50_ms"] or 0, scenario["p95_ms"] or 0, scenario["p99_ms"] or 0,
+            scenario["errors"]))
+    if args.baseline:
+        with open(args.baseline) as f:
+            found = regressions(report, json.load(f), args.max_rps_drop, args.max_latency_rise)
+        for line in found:
+            print("REGRESSION " + line)
+        if found:
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+import argparse
+import os
+import shutil
+import tempfile
+import time
+from squirrel_async_server import BufferedConnection
+from squirrel_db import SquirrelDB, SquirrelDBPool
+from squirrel_metrics import Metrics
+from squirrel_server import SquirrelServerHandler
+
+# Measures what the metrics cost per request: GET /squirrels/1 is run
+# in-process through SquirrelServerHandler (no sockets) with metrics off
+# and on, and the bare Metrics calls one request makes are timed alone;
+# on a noisy machine the bare figure is the one to trust.
+#
+#   python bench_metrics.py --requests 20000
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+REQUEST = b"GET /squirrels/1 HTTP/1.1\r\nHost: bench\r\n\r\n"
+
+def perRequest(requests, metrics):
+    SquirrelServerHandler.metrics = metrics
+    SquirrelServerHandler.dbPool.metrics = metrics
+    with SquirrelServerHandler.dbPool.connection() as db:
+        db.metrics = metrics
+    start = time.perf_counter()
+    for i in range(requests):
+        SquirrelServerHandler(BufferedConnection(REQUEST), ("127.0.0.1", 0), None)
+    return (time.perf_counter() - start) / requests * 1e6
+
+def bareCalls(requests):
+    metrics = Metrics()
+    start = time.perf_counter()
+    for i in range(requests):
+        token = metrics.requestStarted("handleSquirrelsRetrieve", "GET")
+        metrics.observeDB("getSquirrel", 0.0001)
+        metrics.requestFinished(token, 200)
+    return (time.perf_counter() - start) / requests * 1e6
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=20000)
+    parser.add_argument("--rounds", type=int, default=5)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(workdir, "squirrel_db.db")
+        shutil.copyfile(os.path.join(HERE, "empty_squirrel_db.db"), filename)
+        db = SquirrelDB(filename)
+        db.createSquirrel("Chippy", "small")
+        db.close()
+        SquirrelServerHandler.dbPool = SquirrelDBPool(size=1, filename=filename)
+        SquirrelServerHandler.accessLog = False
+        # alternating rounds, best of each, so drift on a busy machine
+        # does not land on one side
+        off = on = float("inf")
+        for i in range(args.rounds):
+            off = min(off, perRequest(args.requests, None))
+            on = min(on, perRequest(args.requests, Metrics()))
+        SquirrelServerHandler.dbPool.close()
+    finally:
+        shutil.rmtree(workdir)
+
+    print("request, metrics off:  {:8.2f} us".format(off))
+    print("request, metrics on:   {:8.2f} us".format(on))
+    print("overhead per request:  {:8.2f} us".format(on - off))
+    print("bare metrics calls:    {:8.2f} us".format(bareCalls(args.requests)))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+import argparse
+import os
+import pickle
+import random
+import shutil
+import tempfile
+import time
+from mydb import MyDB
+
+# Times filling a MyDB store one saveString at a time, the way it used to
+# work (unpickle the whole list, append, pickle it all back) and with the
+# append-only log, then times reading single strings back from the log
+# through loadStrings and through the mmap'd offset index, and looking
+# strings up by scanning and through the sorted search index.
+#
+#   python bench_mydb.py --strings 5000
+
+def fillPickle(fname, strings):
+    with open(fname, "wb") as f:
+        pickle.dump([], f)
+    for s in strings:
+        with open(fname, "rb") as f:
+            arr = pickle.load(f)
+        arr.append(s)
+        with open(fname, "wb") as f:
+            pickle.dump(arr, f)
+
+def fillLog(fname, strings):
+    db = MyDB(fname)
+    for s in strings:
+        db.saveString(s)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--strings", type=int, default=5000)
+    parser.add_argument("--lookups", type=int, default=10000)
+    args = parser.parse_args()
+
+    strings = ["squirrel number {}".format(i) for i in range(args.strings)]
+    workdir = tempfile.mkdtemp()
+    try:
+        for label, fill in (("pickle rewrite per string", fillPickle), ("append-only log", fillLog)):
+            fname = os.path.join(workdir, label.replace(" ", "_"))
+            start = time.perf_counter()
+            fill(fname, strings)
+            elapsed = time.perf_counter() - start
+            if MyDB(fname).loadStrings() != strings:
+                raise RuntimeError(label + " lost strings")
+            print("{:28s} {:8.3f} s {:10.1f} us per string".format(label, elapsed, elapsed / args.strings * 1e6))
+        db = MyDB(fname)
+        picks = [random.randrange(args.strings) for i in range(args.lookups)]
+        start = time.perf_counter()
+        loaded = [db.loadStrings()[i] for i in picks[:10]]
+        print("{:28s} {:19.1f} us per string".format("lookup through loadStrings", (time.perf_counter() - start) / 10 * 1e6))
+        start = time.perf_counter()
+        indexed = [db.getString(i) for i in picks]
+        print("{:28s} {:19.1f} us per string".format("lookup through getString", (time.perf_counter() - start) / args.lookups * 1e6))
+        if loaded != indexed[:10]:
+            raise RuntimeError("the two lookups differ")
+        db.close()
+        scanned = MyDB(fname)
+        indexed = MyDB(fname, searchIndex=True)
+        indexed.contains("")
+        for label, db in (("contains by scan", scanned), ("contains by search index", indexed)):
+            start = time.perf_counter()
+            for i in picks[:10]:
+                if not db.contains(strings[i]):
+                    raise RuntimeError(label + " missed a string")
+            print("{:28s} {:19.1f} us per string".format(label, (time.perf_counter() - start) / 10 * 1e6))
+            db.close()
+    finally:
+        shutil.rmtree(workdir)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,63 @@
+import argparse
+import multiprocessing
+import os
+import shutil
+import tempfile
+import time
+from mydb import MyDB
+
+# Times N processes appending to one MyDB store at the same time, one
+# saveString per string and through write buffers, with and without
+# fsync, and checks that every string written is there exactly once.
+#
+#   python bench_mydb_writers.py --writers 8 --strings 2000
+
+def writer(fname, n, strings, batch, durable):
+    db = MyDB(fname, durable=durable)
+    if batch == 1:
+        for i in range(strings):
+            db.saveString("writer{}-{}".format(n, i))
+        return
+    with db.writeBuffer(maxStrings=batch) as buffer:
+        for i in range(strings):
+            buffer.saveString("writer{}-{}".format(n, i))
+
+def measure(workdir, writers, strings, batch, durable):
+    fname = os.path.join(workdir, "b{}-{}.db".format(batch, int(durable)))
+    MyDB(fname)
+    context = multiprocessing.get_context("fork")
+    processes = [context.Process(target=writer, args=(fname, n, strings, batch, durable)) for n in range(writers)]
+    start = time.perf_counter()
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+    elapsed = time.perf_counter() - start
+    expected = sorted("writer{}-{}".format(n, i) for n in range(writers) for i in range(strings))
+    stored = sorted(MyDB(fname).loadStrings())
+    lost = len(set(expected) - set(stored))
+    duplicated = len(stored) - len(set(stored))
+    return writers * strings / elapsed, lost, duplicated
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--writers", type=int, default=8, help="concurrent writer processes")
+    parser.add_argument("--strings", type=int, default=2000, help="strings per writer")
+    parser.add_argument("--batch", type=int, default=100, help="strings per buffered write")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp()
+    failed = False
+    try:
+        for label, batch, durable in (("saveString", 1, False), ("write buffer", args.batch, False),
+                                      ("saveString, fsync", 1, True), ("write buffer, fsync", args.batch, True)):
+            rate, lost, duplicated = measure(workdir, args.writers, args.strings, batch, durable)
+            print("{:22s} {:10.0f} strings/s {:6d} lost {:6d} duplicated".format(label, rate, lost, duplicated))
+            failed = failed or lost or duplicated
+    finally:
+        shutil.rmtree(workdir)
+    if failed:
+        raise SystemExit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,74 @@
+import argparse
+import time
+from urllib.parse import urlsplit
+from squirrel_server import SquirrelServerHandler
+
+# Compares the old parsePath plus if-chain dispatch against the router,
+# with extra resources registered to show matching cost stays flat. Each
+# figure is the best of --rounds, since the differences are small next to
+# the noise of a busy machine.
+#
+#   python bench_router.py --lookups 200000 --extra-routes 200
+
+PATHS = [("GET", "/squirrels"), ("GET", "/squirrels/17?fields=name"), ("PUT", "/squirrels/17"),
+         ("POST", "/squirrels:batch"), ("GET", "/acorns/3")]
+
+def parsePath(path):
+    path = urlsplit(path).path
+    if path.startswith("/"):
+        parts = path[1:].split("/")
+        resourceName = parts[0]
+        resourceId = None
+        if len(parts) > 1:
+            resourceId = parts[1]
+        return (resourceName, resourceId)
+    return False
+
+def ifChain(method, path):
+    resourceName, resourceId = parsePath(path)
+    if resourceName == "squirrels":
+        if method == "GET":
+            return "handleSquirrelsRetrieve" if resourceId else "handleSquirrelsIndex"
+        if method == "POST":
+            return None if resourceId else "handleSquirrelsCreate"
+        if method == "PUT":
+            return "handleSquirrelsUpdate" if resourceId else None
+        if method == "DELETE":
+            return "handleSquirrelsDelete" if resourceId else None
+    elif resourceName == "squirrels:batch" and not resourceId:
+        return {"POST": "handleSquirrelsBatchCreate", "PUT": "handleSquirrelsBatchUpdate",
+                "DELETE": "handleSquirrelsBatchDelete"}.get(method)
+    return None
+
+def routed(method, path):
+    matched = SquirrelServerHandler.routes.match(urlsplit(path).path)
+    if matched is None:
+        return None
+    return matched[0].get(method)
+
+def measure(dispatch, lookups, rounds):
+    best = float("inf")
+    for round in range(rounds):
+        start = time.perf_counter()
+        for i in range(lookups):
+            method, path = PATHS[i % len(PATHS)]
+            dispatch(method, path)
+        best = min(best, (time.perf_counter() - start) / lookups * 1e9)
+    return best
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--lookups", type=int, default=200000)
+    parser.add_argument("--extra-routes", type=int, default=200)
+    parser.add_argument("--rounds", type=int, default=5)
+    args = parser.parse_args()
+
+    print("parsePath + if-chain:        {:8.1f} ns/lookup".format(measure(ifChain, args.lookups, args.rounds)))
+    print("router:                      {:8.1f} ns/lookup".format(measure(routed, args.lookups, args.rounds)))
+    for i in range(args.extra_routes):
+        SquirrelServerHandler.routes.add("GET", "/resource{}/{{itemId}}".format(i), "handleSquirrelsRetrieve")
+    print("router, {:4d} more routes:     {:8.1f} ns/lookup".format(
+        args.extra_routes, measure(routed, args.lookups, args.rounds)))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,86 @@
+import argparse
+import http.client
+import os
+import shutil
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from http.server import HTTPServer
+from squirrel_db import SquirrelDB, SquirrelDBPool
+from squirrel_server import SquirrelServerHandler
+
+# Compares GET throughput when every request opens its own SquirrelDB (the
+# old behaviour) against borrowing connections from SquirrelDBPool.
+#
+#   python bench_squirrel_db_pool.py --requests 2000 --rows 100
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+class ConnectPerRequest:
+
+    def __init__(self, filename):
+        self.filename = filename
+
+    @contextmanager
+    def connection(self):
+        db = SquirrelDB(self.filename)
+        try:
+            yield db
+        finally:
+            db.close()
+
+    def close(self):
+        pass
+
+def seed(filename, rows):
+    db = SquirrelDB(filename)
+    for i in range(rows):
+        db.createSquirrel("squirrel{}".format(i), "small")
+    db.close()
+
+def measure(pool, requests, paths):
+    SquirrelServerHandler.dbPool = pool
+    SquirrelServerHandler.log_message = lambda *args: None
+    server = HTTPServer(("127.0.0.1", 0), SquirrelServerHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    try:
+        host, port = server.server_address
+        start = time.perf_counter()
+        for i in range(requests):
+            conn = http.client.HTTPConnection(host, port)
+            conn.request("GET", paths[i % len(paths)])
+            conn.getresponse().read()
+            conn.close()
+        elapsed = time.perf_counter() - start
+    finally:
+        server.shutdown()
+        server.server_close()
+        pool.close()
+    return requests / elapsed
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--rows", type=int, default=100)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(workdir, "squirrel_db.db")
+        shutil.copyfile(os.path.join(HERE, "empty_squirrel_db.db"), filename)
+        seed(filename, args.rows)
+        paths = ["/squirrels/{}".format(i + 1) for i in range(args.rows)]
+
+        before = measure(ConnectPerRequest(filename), args.requests, paths)
+        after = measure(SquirrelDBPool(filename=filename), args.requests, paths)
+    finally:
+        shutil.rmtree(workdir)
+
+    print("connect per request: {:8.1f} req/s".format(before))
+    print("pooled connections:  {:8.1f} req/s".format(after))
+    print("speedup:             {:8.2f}x".format(after / before))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,51 @@
+import argparse
+import os
+import shutil
+import tempfile
+import time
+from squirrel_db import SquirrelDB
+
+# Times GET /squirrels?name=...&fields=... style lookups against a large
+# table, with the name/size indexes and with them dropped.
+#
+#   python bench_squirrel_filters.py --rows 1000000 --lookups 200
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+SIZES = ("small", "medium", "large")
+
+def seed(filename, rows):
+    db = SquirrelDB(filename)
+    db.createSquirrels([("squirrel{}".format(i % (rows // 10 or 1)), SIZES[i % 3]) for i in range(rows)])
+    db.close()
+
+def measure(db, rows, lookups):
+    start = time.perf_counter()
+    for i in range(lookups):
+        db.getSquirrelRows(limit=100, name="squirrel{}".format(i % (rows // 10 or 1)), fields=("id", "size"))
+    return (time.perf_counter() - start) / lookups * 1000
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=1000000)
+    parser.add_argument("--lookups", type=int, default=200)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(workdir, "squirrel_db.db")
+        shutil.copyfile(os.path.join(HERE, "empty_squirrel_db.db"), filename)
+        seed(filename, args.rows)
+        db = SquirrelDB(filename)
+        indexed = measure(db, args.rows, args.lookups)
+        db.connection.execute("DROP INDEX squirrels_name")
+        db.connection.execute("DROP INDEX squirrels_size")
+        scanned = measure(db, args.rows, max(args.lookups // 20, 1))
+        db.close()
+    finally:
+        shutil.rmtree(workdir)
+
+    print("indexed lookup:   {:8.3f} ms".format(indexed))
+    print("full table scan:  {:8.3f} ms".format(scanned))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+import argparse
+import json
+import os
+import shutil
+import tempfile
+import time
+import tracemalloc
+from squirrel_db import SquirrelDB, dict_factory
+
+# Times listing every squirrel and serializing the list to JSON, the way
+# GET /squirrels used to (dict_factory rows and json.dumps) and the way it
+# does now (tuple rows formatted with the Squirrel JSON template), and
+# reports the peak memory tracemalloc sees for each.
+#
+#   python bench_squirrel_rows.py --rows 1000000
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+SIZES = ("small", "medium", "large")
+
+def seed(filename, rows):
+    db = SquirrelDB(filename)
+    db.createSquirrels([("squirrel{}".format(i), SIZES[i % 3]) for i in range(rows)])
+    db.close()
+
+def dictRows(db):
+    cursor = db.connection.cursor()
+    cursor.row_factory = dict_factory
+    cursor.execute("SELECT * FROM squirrels ORDER BY id")
+    return json.dumps(cursor.fetchall())
+
+def tupleRows(db):
+    return db.getSquirrelRows().toJSON()
+
+def measure(db, listing, repeat):
+    elapsed = float("inf")
+    for i in range(repeat):
+        start = time.perf_counter()
+        body = listing(db)
+        elapsed = min(elapsed, time.perf_counter() - start)
+        del body
+    tracemalloc.start()
+    listing(db)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return (elapsed, peak)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=1000000)
+    parser.add_argument("--repeat", type=int, default=3, help="timed runs; the best is reported")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(workdir, "squirrel_db.db")
+        shutil.copyfile(os.path.join(HERE, "empty_squirrel_db.db"), filename)
+        seed(filename, args.rows)
+        db = SquirrelDB(filename)
+        if dictRows(db) != tupleRows(db):
+            raise RuntimeError("the two listings differ")
+        results = [("dict_factory + json.dumps", measure(db, dictRows, args.repeat)),
+                   ("tuple rows + JSON template", measure(db, tupleRows, args.repeat))]
+        db.close()
+    finally:
+        shutil.rmtree(workdir)
+
+    for label, (elapsed, peak) in results:
+        print("{:30s} {:8.2f} s {:8.1f} MB peak".format(label, elapsed, peak / (1 << 20)))
+
+if __name__ == '__main__':
+    main()
@@ -1,23 +1,609 @@
+import heapq
+import mmap
+import os
 import os.path
 import pickle
+import struct
+import threading
+import zlib
+from bisect import bisect_left, insort
+from contextlib import contextmanager
+from itertools import islice
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# A store is a log: MAGIC, then one record per string, its utf-8 length and
+# crc32 as two little-endian uint32s followed by the bytes. Files from
+# before the log are a pickled list and are converted on the first append.
+MAGIC = b"MYDBLOG1\n"
+RECORD_HEADER = struct.Struct("<II")
+# Next to the log, <filename>.idx holds INDEX_HEADER (a magic and the inode
+# of the log it describes) and then the offset of every record as a
+# little-endian uint64, so string i is found without reading the others.
+INDEX_MAGIC = b"MYDBIDX1"
+INDEX_HEADER = struct.Struct("<8sQ")
+OFFSET = struct.Struct("<Q")
+# With searchIndex on, <filename>.sidx holds SEARCH_HEADER (a magic, the
+# inode of the log and how many strings it covers) and then the positions
+# of those strings as uint64s, ordered by string. Strings appended since
+# are kept sorted in memory and folded into the file once there are more
+# than MIN_TAIL of them and more than an eighth of the store, so a merge
+# rereads every string but only after the store has grown by an eighth.
+SEARCH_MAGIC = b"MYDBSRT1"
+SEARCH_HEADER = struct.Struct("<8sQQ")
+MIN_TAIL = 1024
+
+def encodeRecord(s):
+    data = bytes(s, "utf-8")
+    return RECORD_HEADER.pack(len(data), zlib.crc32(data)) + data
+
+def iterRecords(f):
+    # (offset, bytes) of every whole record from f's position on; a crash
+    # in the middle of an append leaves a short or corrupt tail record,
+    # which ends the log. A bad record with whole records after it is
+    # damage rather than a torn append and raises ValueError.
+    while True:
+        offset = f.tell()
+        header = f.read(RECORD_HEADER.size)
+        if len(header) < RECORD_HEADER.size:
+            return
+        length, crc = RECORD_HEADER.unpack(header)
+        data = f.read(length)
+        if len(data) < length or zlib.crc32(data) != crc:
+            if recordFollows(f, offset):
+                raise ValueError("{}: corrupt record at offset {}".format(f.name, offset))
+            return
+        yield offset, data
+
+def recordFollows(f, offset):
+    # whether a whole non-empty record starts anywhere in f after offset.
+    # Every byte is tried, as a bad length says nothing about where the
+    # next record is; empty records are left out because eight zero bytes
+    # are one, and zeros are what a crash often leaves behind.
+    size = os.fstat(f.fileno()).st_size
+    if size - offset <= RECORD_HEADER.size:
+        return False
+    with mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ) as data:
+        for start in range(offset + 1, size - RECORD_HEADER.size):
+            length, crc = RECORD_HEADER.unpack_from(data, start)
+            end = start + RECORD_HEADER.size + length
+            if 0 < length and end <= size and zlib.crc32(data[start + RECORD_HEADER.size:end]) == crc:
+                return True
+    return False
+
+def readRecords(f):
+    # (strings, offset just past the last whole record) from f positioned
+    # after MAGIC
+    strings = []
+    end = f.tell()
+    for offset, data in iterRecords(f):
+        strings.append(data.decode("utf-8"))
+        end = offset + RECORD_HEADER.size + len(data)
+    return strings, end
+
+def writeIndex(indexName, ino, offsets):
+    tmp = indexName + ".tmp"
+    with open(tmp, 'wb') as f:
+        f.write(INDEX_HEADER.pack(INDEX_MAGIC, ino))
+        f.write(struct.pack("<{}Q".format(len(offsets)), *offsets))
+    os.replace(tmp, indexName)
+
+def writeSearchIndex(searchName, ino, positions, count):
+    tmp = searchName + ".tmp"
+    positions = iter(positions)
+    with open(tmp, 'wb') as f:
+        f.write(SEARCH_HEADER.pack(SEARCH_MAGIC, ino, count))
+        while True:
+            chunk = list(islice(positions, 65536))
+            if not chunk:
+                break
+            f.write(struct.pack("<{}Q".format(len(chunk)), *chunk))
+    os.replace(tmp, searchName)
+
+class SortedRun:
+
+    # The strings a .sidx file covers, in sorted order, read through the
+    # store's offset index; bisect works on it directly.
+
+    def __init__(self, db, positions):
+        # positions is None for an empty run
+        self.db = db
+        self.positions = positions
+        self.count = (len(positions) - SEARCH_HEADER.size) // OFFSET.size if positions is not None else 0
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, i):
+        return self.db.getString(self.position(i))
+
+    def position(self, i):
+        return OFFSET.unpack_from(self.positions, SEARCH_HEADER.size + i * OFFSET.size)[0]
+
+def syncDirectory(path):
+    # makes a rename into path's directory survive a power failure
+    fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+class WriteBuffer:
+
+    # Collects strings for MyDB.saveStringsBatch, handing them over
+    # maxStrings at a time and whatever is left when the with block ends.
+
+    def __init__(self, db, maxStrings=1000):
+        self.db = db
+        self.maxStrings = maxStrings
+        self.strings = []
+
+    def saveString(self, s):
+        self.strings.append(s)
+        if len(self.strings) >= self.maxStrings:
+            self.flush()
+
+    def flush(self):
+        strings, self.strings = self.strings, []
+        self.db.saveStringsBatch(strings)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.flush()
 
 class MyDB:
 
-    def __init__(self, filename):
+    # Writers in any number of processes take an exclusive flock on
+    # <filename>.lock (where fcntl exists), so appends never interleave
+    # and a rewrite never races an append. Readers take no lock and write
+    # nothing, so read access to the files is all they need: records and
+    # offsets are appended after everything they point at, rewrites
+    # replace files by rename, and what a crash left behind is read around
+    # in memory until the next writer repairs it. With durable set, every
+    # write is fsynced before it returns.
+
+    def __init__(self, filename, searchIndex=False, durable=False):
         self.fname = filename
+        self.indexName = filename + ".idx"
+        self.searchName = filename + ".sidx"
+        self.lockName = filename + ".lock"
+        self.searchIndex = searchIndex
+        self.durable = durable
+        self._threadLock = threading.RLock()
+        self._lockFile = None
+        self._lockHeld = False
+        # (log inode, log size, index size) as this instance's last append
+        # left them; while they still match, the next append needs no check
+        self._appended = None
+        # (log inode, log file, index file) kept open for appending
+        self._appendFiles = None
+        # read-only maps of the log and its index and the log's inode and
+        # size when it was mapped, None until a string is read by index;
+        # how many strings there are, how many of them the index names and
+        # the offsets of the rest. A pickle file is held as its list.
+        self._data = None
+        self._offsets = None
+        self._logStat = None
+        self._count = 0
+        self._indexed = 0
+        self._unindexed = []
+        self._pickled = None
+        self._logIno = None
+        # the mapped .sidx run, its inode and size, the sorted (string,
+        # position) pairs it does not cover, and how many strings the
+        # .sidx file covers as last seen by saveString
+        self._run = None
+        self._searchStat = None
+        self._tail = []
+        self._searchCovered = None
         if not os.path.isfile(self.fname):
-            self.saveStrings([])
+            with self._locked():
+                # another process may have created it in the meantime
+                if not os.path.exists(self.fname):
+                    self.saveStrings([])
 
     def loadStrings(self):
         with open(self.fname, 'rb') as f:
-            arr = pickle.load(f)
-        return arr
-        
+            if f.read(len(MAGIC)) != MAGIC:
+                f.seek(0)
+                return pickle.load(f)
+            return readRecords(f)[0]
+
     def saveStrings(self, arr):
-        with open(self.fname, 'wb') as f:
-            pickle.dump(arr, f)
+        # the whole store is rewritten into a temporary file that replaces
+        # the old one, so a crash leaves either the old strings or the new
+        with self._locked():
+            tmp = self.fname + ".tmp"
+            offsets = []
+            offset = len(MAGIC)
+            with open(tmp, 'wb') as f:
+                f.write(MAGIC)
+                for s in arr:
+                    record = encodeRecord(s)
+                    f.write(record)
+                    offsets.append(offset)
+                    offset += len(record)
+                if self.durable:
+                    os.fsync(f.fileno())
+                ino = os.fstat(f.fileno()).st_ino
+            # an index left naming the old inode is rebuilt if the log is
+            # replaced and the index is not
+            writeIndex(self.indexName, ino, offsets)
+            self._unmap()
+            self._dropSearch()
+            self._searchCovered = None
+            if self.searchIndex:
+                writeSearchIndex(self.searchName, ino, sorted(range(len(arr)), key=arr.__getitem__), len(arr))
+                self._searchCovered = len(arr)
+            os.replace(tmp, self.fname)
+            if self.durable:
+                syncDirectory(self.fname)
 
     def saveString(self, s):
-        arr = self.loadStrings()
-        arr.append(s)
-        self.saveStrings(arr)
+        # one record appended to the log and one offset to its index,
+        # whatever the size of the store
+        self.saveStringsBatch([s])
+
+    def saveStringsBatch(self, strings):
+        # appends all of strings under one lock, with one write to the log,
+        # one to its index and, for a durable store, one fsync
+        records = [encodeRecord(s) for s in strings]
+        if not records:
+            return
+        offsets = []
+        with self._locked():
+            ino, offset = self._appendOffset()
+            for record in records:
+                offsets.append(offset)
+                offset += len(record)
+            if self._appendFiles is None or self._appendFiles[0] != ino:
+                self._closeAppendFiles()
+                self._appendFiles = (ino, open(self.fname, 'ab', buffering=0), open(self.indexName, 'ab', buffering=0))
+            logFile, indexFile = self._appendFiles[1:]
+            logFile.write(b"".join(records))
+            if self.durable:
+                os.fsync(logFile.fileno())
+            indexFile.write(struct.pack("<{}Q".format(len(offsets)), *offsets))
+            indexSize = indexFile.tell()
+            self._appended = (ino, offset, indexSize)
+            count = (indexSize - INDEX_HEADER.size) // OFFSET.size
+            if self.searchIndex:
+                self._searchAppended(ino, count)
+
+    def writeBuffer(self, maxStrings=1000):
+        # with db.writeBuffer() as buffer: buffer.saveString(s) ...
+        return WriteBuffer(self, maxStrings)
+
+    def recover(self):
+        # converts a pickle file to the log, cuts off a torn tail record
+        # and brings the index up to date; returns the end of the log.
+        # Raises ValueError, leaving the log as it is, if a record before
+        # the tail is corrupt.
+        with self._locked():
+            end = self._syncIndex()
+            if end is None:
+                self.saveStrings(self.loadStrings())
+                end = self._syncIndex()
+            if end < os.path.getsize(self.fname):
+                self._unmap()
+                os.truncate(self.fname, end)
+            return end
+
+    def compact(self):
+        # rewrites the store from the strings it holds; no append can land
+        # between the load and the rewrite
+        with self._locked():
+            self.saveStrings(self.loadStrings())
+
+    def iterStrings(self):
+        # the strings in order, read a record at a time, so memory stays
+        # bounded by the longest string however large the store is
+        with open(self.fname, 'rb') as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                f.seek(0)
+                yield from pickle.load(f)
+                return
+            for offset, data in iterRecords(f):
+                yield data.decode("utf-8")
+
+    def contains(self, s):
+        if not self.searchIndex:
+            return any(stored == s for stored in self.iterStrings())
+        run, tail = self._searchRuns()
+        i = bisect_left(run, s)
+        if i < len(run) and run[i] == s:
+            return True
+        i = bisect_left(tail, (s,))
+        return i < len(tail) and tail[i][0] == s
+
+    def findPrefix(self, prefix):
+        # the stored strings that start with prefix, in sorted order
+        if not self.searchIndex:
+            return sorted(stored for stored in self.iterStrings() if stored.startswith(prefix))
+        run, tail = self._searchRuns()
+        found = []
+        for i in range(bisect_left(run, prefix), len(run)):
+            stored = run[i]
+            if not stored.startswith(prefix):
+                break
+            found.append(stored)
+        tailFound = []
+        for i in range(bisect_left(tail, (prefix,)), len(tail)):
+            stored = tail[i][0]
+            if not stored.startswith(prefix):
+                break
+            tailFound.append(stored)
+        return list(heapq.merge(found, tailFound)) if tailFound else found
+
+    def getString(self, i):
+        if not 0 <= i < self._count:
+            # the store may have grown since it was mapped
+            self._refresh()
+            if i < 0:
+                i += self._count
+            if not 0 <= i < self._count:
+                raise IndexError("MyDB index out of range")
+        if self._pickled is not None:
+            return self._pickled[i]
+        if i < self._indexed:
+            offset = OFFSET.unpack_from(self._offsets, INDEX_HEADER.size + i * OFFSET.size)[0]
+        else:
+            offset = self._unindexed[i - self._indexed]
+        length, crc = RECORD_HEADER.unpack_from(self._data, offset)
+        start = offset + RECORD_HEADER.size
+        data = self._data[start:start + length]
+        # checked like every record loadStrings reads, so neither read
+        # path hands out a damaged string
+        if zlib.crc32(data) != crc:
+            raise ValueError("{}: string {} fails its checksum".format(self.fname, i))
+        return str(data, "utf-8")
+
+    def __len__(self):
+        self._refresh()
+        return self._count
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            return [self.getString(i) for i in range(*key.indices(len(self)))]
+        return self.getString(key)
+
+    def close(self):
+        # drops the maps and open files; the store stays usable and opens
+        # what it needs again
+        with self._threadLock:
+            self._unmap()
+            self._dropSearch()
+            self._closeAppendFiles()
+            if self._lockFile is not None and not self._lockHeld:
+                self._lockFile.close()
+                self._lockFile = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _unmap(self):
+        if self._data is not None:
+            self._data.close()
+        if self._offsets is not None:
+            self._offsets.close()
+        self._data = self._offsets = self._logStat = self._pickled = None
+        self._count = self._indexed = 0
+        self._unindexed = []
+
+    def _appendOffset(self):
+        # where the next record goes; called with the lock held
+        try:
+            log = os.stat(self.fname)
+            index = os.stat(self.indexName)
+            if (log.st_ino, log.st_size, index.st_size) == self._appended:
+                return log.st_ino, log.st_size
+        except FileNotFoundError:
+            pass
+        # another writer appended, rewrote the store or died halfway
+        # through an append since this instance last wrote
+        self._appended = None
+        end = self.recover()
+        return os.stat(self.fname).st_ino, end
+
+    def _closeAppendFiles(self):
+        if self._appendFiles is not None:
+            self._appendFiles[1].close()
+            self._appendFiles[2].close()
+            self._appendFiles = None
+
+    @contextmanager
+    def _locked(self):
+        # held by one writer across processes and threads; reentrant for
+        # the thread holding it
+        with self._threadLock:
+            if self._lockHeld or fcntl is None:
+                yield
+                return
+            if self._lockFile is None:
+                self._lockFile = open(self.lockName, 'ab')
+            fcntl.flock(self._lockFile.fileno(), fcntl.LOCK_EX)
+            self._lockHeld = True
+            try:
+                yield
+            finally:
+                self._lockHeld = False
+                fcntl.flock(self._lockFile.fileno(), fcntl.LOCK_UN)
+
+    def _searchAppended(self, ino, count):
+        if self._searchCovered is None or count - self._searchCovered > max(MIN_TAIL, count // 8):
+            # another process may have merged since this one last looked;
+            # a file that cannot be used is rebuilt by the merge
+            self._searchCovered = self._readSearchCovered(ino)
+            if self._searchCovered is None or count - self._searchCovered > max(MIN_TAIL, count // 8):
+                self._mergeSearch()
+
+    def _refresh(self):
+        # maps the log and its index again if the log has grown or been
+        # replaced since they were mapped; costs one stat otherwise
+        stat = os.stat(self.fname)
+        if (stat.st_ino, stat.st_size) == self._logStat:
+            return
+        self._unmap()
+        # mapped before the log, so every offset in it names a record the
+        # log already holds
+        try:
+            with open(self.indexName, 'rb') as f:
+                self._offsets = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (FileNotFoundError, ValueError):
+            # missing, or empty and so cannot be mapped
+            pass
+        with open(self.fname, 'rb') as f:
+            stat = os.fstat(f.fileno())
+            self._logStat = (stat.st_ino, stat.st_size)
+            self._logIno = stat.st_ino
+            if f.read(len(MAGIC)) != MAGIC:
+                f.seek(0)
+                self._pickled = pickle.load(f)
+                self._count = len(self._pickled)
+                return
+            self._data = mmap.mmap(f.fileno(), stat.st_size, access=mmap.ACCESS_READ)
+            self._indexed, end = self._mappedEnd(stat.st_ino)
+            # records a crash kept out of the index; a record appended
+            # since the log was mapped waits for the next refresh
+            f.seek(end)
+            for offset, data in iterRecords(f):
+                if offset + RECORD_HEADER.size + len(data) > stat.st_size:
+                    break
+                self._unindexed.append(offset)
+        self._count = self._indexed + len(self._unindexed)
+
+    def _mappedEnd(self, ino):
+        # how many offsets at the start of the mapped index can be used
+        # with the mapped log and the end of the last record they name;
+        # none when the index is missing, torn or describes another log
+        offsets, data = self._offsets, self._data
+        if offsets is None or len(offsets) < INDEX_HEADER.size:
+            return 0, len(MAGIC)
+        magic, indexIno = INDEX_HEADER.unpack_from(offsets)
+        count = (len(offsets) - INDEX_HEADER.size) // OFFSET.size
+        if magic != INDEX_MAGIC or indexIno != ino or count == 0:
+            return 0, len(MAGIC)
+        last = OFFSET.unpack_from(offsets, INDEX_HEADER.size + (count - 1) * OFFSET.size)[0]
+        if last + RECORD_HEADER.size > len(data):
+            return 0, len(MAGIC)
+        length, crc = RECORD_HEADER.unpack_from(data, last)
+        end = last + RECORD_HEADER.size + length
+        if end > len(data) or zlib.crc32(data[last + RECORD_HEADER.size:end]) != crc:
+            return 0, len(MAGIC)
+        return count, end
+
+    def _syncIndex(self):
+        # adds the offsets of records the index is missing, or rebuilds it
+        # when it is missing, torn or describes another file, and returns
+        # the end of the last whole record; None for a pickle file
+        with open(self.fname, 'rb') as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                return None
+            ino = os.fstat(f.fileno()).st_ino
+            end = self._indexedEnd(f, ino)
+            rebuild = end is None
+            f.seek(len(MAGIC) if rebuild else end)
+            end = f.tell()
+            missing = []
+            for offset, data in iterRecords(f):
+                missing.append(offset)
+                end = offset + RECORD_HEADER.size + len(data)
+        if rebuild:
+            writeIndex(self.indexName, ino, missing)
+        elif missing:
+            with open(self.indexName, 'ab') as f:
+                f.write(struct.pack("<{}Q".format(len(missing)), *missing))
+        return end
+
+    def _indexedEnd(self, f, ino):
+        # the end of the last record the index names, checked against the
+        # log, or None when the index cannot be trusted
+        try:
+            with open(self.indexName, 'r+b') as index:
+                magic, indexIno = INDEX_HEADER.unpack(index.read(INDEX_HEADER.size).ljust(INDEX_HEADER.size, b"\0"))
+                if magic != INDEX_MAGIC or indexIno != ino:
+                    return None
+                size = os.fstat(index.fileno()).st_size
+                count = (size - INDEX_HEADER.size) // OFFSET.size
+                if INDEX_HEADER.size + count * OFFSET.size != size:
+                    # an offset torn in the middle of being appended
+                    index.truncate(INDEX_HEADER.size + count * OFFSET.size)
+                if count == 0:
+                    return len(MAGIC)
+                index.seek(INDEX_HEADER.size + (count - 1) * OFFSET.size)
+                last = OFFSET.unpack(index.read(OFFSET.size))[0]
+        except FileNotFoundError:
+            return None
+        f.seek(last)
+        for offset, data in iterRecords(f):
+            return offset + RECORD_HEADER.size + len(data)
+        return None
+
+    def _searchRuns(self):
+        # the sorted run and the sorted tail, brought up to date with the store
+        count = len(self)
+        try:
+            stat = os.stat(self.searchName)
+            current = (stat.st_ino, stat.st_size)
+        except FileNotFoundError:
+            current = None
+        if self._run is None or current != self._searchStat:
+            self._mapSearch(count, current)
+        for position in range(len(self._run) + len(self._tail), count):
+            insort(self._tail, (self.getString(position), position))
+        return self._run, self._tail
+
+    def _mapSearch(self, count, current):
+        # a .sidx file that is missing, stale or covers strings this
+        # instance has not mapped yet is left for the next writer to
+        # rebuild; until then the run is empty and every string is sorted
+        # into the tail in memory
+        self._dropSearch()
+        self._run = SortedRun(self, None)
+        self._searchStat = current
+        covered = self._readSearchCovered(self._logIno)
+        if covered is None or covered > count:
+            return
+        with open(self.searchName, 'rb') as f:
+            positions = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            stat = os.fstat(f.fileno())
+        self._run = SortedRun(self, positions)
+        self._searchStat = (stat.st_ino, stat.st_size)
+
+    def _readSearchCovered(self, ino):
+        # how many strings the .sidx file covers, or None when it is
+        # missing, torn or was written for another log
+        try:
+            with open(self.searchName, 'rb') as f:
+                header = f.read(SEARCH_HEADER.size)
+                size = os.fstat(f.fileno()).st_size
+        except FileNotFoundError:
+            return None
+        if len(header) < SEARCH_HEADER.size:
+            return None
+        magic, searchIno, covered = SEARCH_HEADER.unpack(header)
+        if magic != SEARCH_MAGIC or searchIno != ino or size != SEARCH_HEADER.size + covered * OFFSET.size:
+            return None
+        return covered
+
+    def _mergeSearch(self):
+        run, tail = self._searchRuns()
+        count = len(run) + len(tail)
+        merged = heapq.merge(((run[i], run.position(i)) for i in range(len(run))), tail)
+        writeSearchIndex(self.searchName, self._logIno, (position for s, position in merged), count)
+        self._dropSearch()
+        self._searchCovered = count
+
+    def _dropSearch(self):
+        if self._run is not None and self._run.positions is not None:
+            self._run.positions.close()
+        self._run = self._searchStat = None
+        self._tail = []
@@ -0,0 +1,80 @@
+import math
+import threading
+import time
+
+READ_METHODS = frozenset(["GET", "HEAD", "OPTIONS"])
+REASONS = {429: "Too Many Requests", 503: "Service Unavailable"}
+
+def refusal(status, retryAfter, close=False):
+    # a complete response for callers that have no handler to send it with
+    body = "{} {}".format(status, REASONS[status]).encode("ascii")
+    head = "HTTP/1.1 {} {}\r\nRetry-After: {}\r\nContent-Type: text/plain\r\nContent-Length: {}\r\n".format(
+        status, REASONS[status], retryAfter, len(body))
+    if close:
+        head += "Connection: close\r\n"
+    return head.encode("ascii") + b"\r\n" + body
+
+class AdmissionController:
+
+    # Decides, before a request is handled, whether the server takes it.
+    # At most maxInFlight requests are handled at once; writes may only
+    # fill maxInFlight - readReserve of those slots, so reads still get in
+    # while writes pile up. With a rate, every client address gets a token
+    # bucket of burst requests refilled at rate per second. A refused
+    # request costs a lock and a dict lookup, so shedding stays cheap
+    # however overloaded the server is.
+
+    def __init__(self, maxInFlight=0, readReserve=0, rate=0.0, burst=None, retryAfter=1, maxClients=10000):
+        if readReserve and not 0 <= readReserve < maxInFlight:
+            raise ValueError("readReserve must be smaller than maxInFlight")
+        self.maxInFlight = maxInFlight
+        self.readReserve = readReserve
+        self.rate = rate
+        self.burst = burst if burst else max(1.0, rate)
+        self.retryAfter = retryAfter
+        self.maxClients = maxClients
+        self.inFlight = 0
+        self._lock = threading.Lock()
+        # client -> [tokens, last refill]
+        self._buckets = {}
+
+    def admit(self, client, isWrite):
+        # None when the request may go ahead, and release() must follow
+        # it; otherwise the {"status", "retryAfter"} to refuse it with
+        with self._lock:
+            if self.rate:
+                wait = self._takeToken(client)
+                if wait:
+                    return {"status": 429, "retryAfter": max(1, math.ceil(wait))}
+            if self.maxInFlight:
+                limit = self.maxInFlight - self.readReserve if isWrite else self.maxInFlight
+                if self.inFlight >= limit:
+                    return {"status": 503, "retryAfter": self.retryAfter}
+            self.inFlight += 1
+        return None
+
+    def release(self):
+        with self._lock:
+            self.inFlight -= 1
+
+    def _takeToken(self, client):
+        # seconds until the client has a token again, or 0 after taking one
+        now = time.monotonic()
+        bucket = self._buckets.get(client)
+        if bucket is None:
+            if len(self._buckets) >= self.maxClients:
+                self._forgetIdleClients(now)
+            bucket = self._buckets[client] = [self.burst, now]
+        else:
+            bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+        if bucket[0] < 1:
+            return (1 - bucket[0]) / self.rate
+        bucket[0] -= 1
+        return 0
+
+    def _forgetIdleClients(self, now):
+        # a bucket that has refilled completely is the same as a new one
+        full = self.burst / self.rate
+        for client in [client for client, (tokens, last) in self._buckets.items() if now - last >= full]:
+            del self._buckets[client]
@@ -0,0 +1,444 @@
+import asyncio
+import http.client
+import io
+import signal
+from concurrent.futures import ThreadPoolExecutor
+from email.utils import formatdate
+from urllib.parse import parse_qs, urlsplit
+from squirrel_admission import READ_METHODS, refusal
+from squirrel_server import (MEDIA_TYPES, SquirrelServerHandler, changesBody, changesEvents, chooseFormat, closeDB,
+                             configureHandler, makeAdmission, openDB, parseArgs, parseChangesQuery, releaseWaiters)
+
+WRITE_METHODS = frozenset(["POST", "PUT", "DELETE"])
+
+class ResponseWriter(io.RawIOBase):
+
+    def __init__(self, connection):
+        self._connection = connection
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._connection.sendall(data)
+        return len(data)
+
+class ResponseStream:
+
+    # Carries a streamed response from the handler's thread to the client.
+    # Each write is handed to the event loop and the thread waits for it to
+    # drain, so a slow client holds the handler back instead of the body
+    # piling up in memory.
+
+    def __init__(self, loop, writer, keepAlive):
+        self.loop = loop
+        self.writer = writer
+        self.keepAlive = keepAlive
+        self.started = False
+
+    def start(self, response):
+        # response holds the head and whatever of the body came with it
+        response, self.keepAlive = frameResponse(response, self.keepAlive, streaming=True)
+        self.started = True
+        self.write(response)
+
+    def write(self, data):
+        asyncio.run_coroutine_threadsafe(self._send(data), self.loop).result()
+
+    async def _send(self, data):
+        self.writer.write(data)
+        await self.writer.drain()
+
+class BufferedConnection:
+
+    # Stands in for the client socket so SquirrelServerHandler can process a
+    # request the event loop has already read, collecting the response bytes
+    # in memory instead of writing them to the network. Given a stream, a
+    # response whose head announces no Content-Length goes to the client as
+    # it is written instead, so streaming a large table stays streaming.
+
+    def __init__(self, request, stream=None):
+        self._request = request
+        self._chunks = []
+        self._stream = stream
+        # whether the head has been seen yet, when there is a stream
+        self._headSeen = stream is None
+
+    def makefile(self, mode, *args, **kwargs):
+        if mode == "rb":
+            return io.BytesIO(self._request)
+        return ResponseWriter(self)
+
+    def sendall(self, data):
+        if self._stream is not None and self._stream.started:
+            self._stream.write(bytes(data))
+            return
+        self._chunks.append(bytes(data))
+        if not self._headSeen:
+            response = b"".join(self._chunks)
+            streamed = streamsBody(response)
+            if streamed is not None:
+                self._headSeen = True
+                if streamed:
+                    self._chunks = []
+                    self._stream.start(response)
+
+    def settimeout(self, timeout):
+        pass
+
+    def setsockopt(self, *args):
+        pass
+
+    def response(self):
+        return b"".join(self._chunks)
+
+def wantsKeepAlive(version, headers):
+    connection = (headers.get("Connection") or "").lower()
+    if version == "HTTP/1.1":
+        return connection != "close"
+    return connection == "keep-alive"
+
+def dropInterim(response):
+    # drops interim "100 Continue" blocks; the engine already sent its own
+    while response.startswith(b"HTTP/1.1 100"):
+        response = response.partition(b"\r\n\r\n")[2]
+    return response
+
+def streamsBody(response):
+    # whether the head at the start of response announces a body without a
+    # Content-Length, to be streamed; None until the whole head is there
+    head, found, body = dropInterim(response).partition(b"\r\n\r\n")
+    if not found:
+        return None
+    lines = head.split(b"\r\n")
+    statusParts = lines[0].split()
+    if len(statusParts) < 2 or not statusParts[1].isdigit() or int(statusParts[1]) < 200:
+        return False
+    if int(statusParts[1]) in (204, 304):
+        return False
+    return not any(line.lower().startswith(b"content-length:") for line in lines[1:])
+
+def frameResponse(response, keepAlive, streaming=False):
+    # with streaming, response is only the start of a body that is either
+    # chunked or ends when the connection closes, so no length is added
+    response = dropInterim(response)
+    head, _, body = response.partition(b"\r\n\r\n")
+    lines = head.split(b"\r\n")
+    statusParts = lines[0].split()
+    status = int(statusParts[1]) if len(statusParts) > 1 and statusParts[1].isdigit() else 500
+    names = {}
+    for line in lines[1:]:
+        name, _, value = line.partition(b":")
+        names[name.strip().lower()] = value.strip().lower()
+    if names.get(b"connection") == b"close":
+        keepAlive = False
+    if b"content-length" not in names and b"transfer-encoding" not in names:
+        if streaming:
+            keepAlive = False
+        elif status >= 200 and status not in (204, 304):
+            lines.append(b"Content-Length: " + str(len(body)).encode("ascii"))
+    if b"connection" not in names:
+        lines.append(b"Connection: keep-alive" if keepAlive else b"Connection: close")
+    return b"\r\n".join(lines) + b"\r\n\r\n" + body, keepAlive
+
+class AsyncSquirrelServer:
+
+    def __init__(self, host="127.0.0.1", port=8080, readers=8, writers=1, handlerClass=SquirrelServerHandler,
+                 idleTimeout=60.0, maxHeaderBytes=65536, maxRequestsPerConnection=None, admission=None):
+        self.host = host
+        self.port = port
+        self.handlerClass = handlerClass
+        self.idleTimeout = idleTimeout
+        self.maxHeaderBytes = maxHeaderBytes
+        self.maxRequestsPerConnection = maxRequestsPerConnection
+        # requests are admitted here, before they queue for an executor,
+        # so refusing one never waits behind the work that overloads us
+        self.admission = admission
+        self.server_address = (host, port)
+        self.readExecutor = ThreadPoolExecutor(max_workers=readers, thread_name_prefix="squirrel-reader")
+        # by default a single writer thread serializes every commit
+        self.writeExecutor = ThreadPoolExecutor(max_workers=writers, thread_name_prefix="squirrel-writer")
+        self._server = None
+        self._connections = set()
+        self._idle = set()
+        # set, and replaced, whenever the change log grows or closes; change
+        # feed requests wait on it here instead of in a reader thread
+        self._changed = None
+        self._changesListener = None
+
+    async def start(self):
+        self._server = await asyncio.start_server(self.handleConnection, self.host, self.port,
+                                                  limit=self.maxHeaderBytes)
+        self.server_address = self._server.sockets[0].getsockname()[:2]
+        changeLog = self.handlerClass.changeLog
+        if changeLog is not None:
+            loop = asyncio.get_running_loop()
+            self._changed = asyncio.Event()
+            self._changesListener = lambda: loop.call_soon_threadsafe(self._changesAppended)
+            changeLog.subscribe(self._changesListener)
+
+    def _changesAppended(self):
+        changed, self._changed = self._changed, asyncio.Event()
+        changed.set()
+
+    async def close(self):
+        if self._changesListener is not None:
+            self.handlerClass.changeLog.unsubscribe(self._changesListener)
+            self._changesListener = None
+        self._server.close()
+        await self._server.wait_closed()
+        # idle keep-alive connections are dropped; in-flight requests finish
+        for task in list(self._idle):
+            task.cancel()
+        if self._connections:
+            await asyncio.gather(*self._connections, return_exceptions=True)
+        self.readExecutor.shutdown(wait=True)
+        self.writeExecutor.shutdown(wait=True)
+
+    def processRequest(self, request, clientAddress, stream=None):
+        # the buffered response; whatever went to the stream is not in it
+        connection = BufferedConnection(request, stream)
+        self.handlerClass(connection, clientAddress, self)
+        return connection.response()
+
+    async def handleConnection(self, reader, writer):
+        task = asyncio.current_task()
+        self._connections.add(task)
+        clientAddress = writer.get_extra_info("peername")[:2]
+        served = 0
+        try:
+            while True:
+                self._idle.add(task)
+                try:
+                    request = await self.readRequest(reader, writer)
+                finally:
+                    self._idle.discard(task)
+                if request is None:
+                    break
+                method, raw, keepAlive = request
+                served += 1
+                if self.maxRequestsPerConnection and served >= self.maxRequestsPerConnection:
+                    keepAlive = False
+                query = self.changesQuery(raw)
+                if query is not None:
+                    keepAlive = await self.serveChanges(writer, query, clientAddress, keepAlive)
+                    if not keepAlive:
+                        break
+                    continue
+                stream = ResponseStream(asyncio.get_running_loop(), writer, keepAlive)
+                if self.admission is None:
+                    response = await self.runRequest(method, raw, clientAddress, stream)
+                else:
+                    response = await self.admitRequest(method, raw, clientAddress, stream)
+                if stream.started:
+                    keepAlive = stream.keepAlive
+                else:
+                    response, keepAlive = frameResponse(response, keepAlive)
+                    writer.write(response)
+                    await writer.drain()
+                if not keepAlive:
+                    break
+        except (ConnectionError, asyncio.CancelledError):
+            pass
+        finally:
+            self._connections.discard(task)
+            writer.close()
+
+    async def admitRequest(self, method, raw, clientAddress, stream=None):
+        refused = self.admission.admit(clientAddress[0], method not in READ_METHODS)
+        if refused is not None:
+            return self.refuse(method, refused)
+        try:
+            return await self.runRequest(method, raw, clientAddress, stream)
+        finally:
+            self.admission.release()
+
+    def refuse(self, method, refused):
+        metrics = self.handlerClass.metrics
+        if metrics is not None:
+            metrics.requestFinished(metrics.requestStarted("handleRefused", method), refused["status"])
+        return refusal(refused["status"], refused["retryAfter"])
+
+    def runRequest(self, method, raw, clientAddress, stream=None):
+        executor = self.writeExecutor if method in WRITE_METHODS else self.readExecutor
+        return asyncio.get_running_loop().run_in_executor(executor, self.processRequest, raw, clientAddress, stream)
+
+    # CHANGE FEED
+    # A long-poll or event stream spends nearly all its time waiting for
+    # the next write, so GET /squirrels/changes is answered here on the loop
+    # rather than by parking a reader thread on ChangeLog.since.
+
+    def changesQuery(self, raw):
+        # (since, wait, stream, headers, version) of a change feed request
+        # the loop can answer itself; None leaves the request to the
+        # handler, which also gives the malformed ones their 400 or 404
+        handlerClass = self.handlerClass
+        changeLog = handlerClass.changeLog
+        if changeLog is None or not raw.startswith(b"GET "):
+            return None
+        requestLine, _, headerBlock = raw.partition(b"\r\n")
+        parts = requestLine.decode("latin-1").split()
+        if len(parts) != 3:
+            return None
+        target = urlsplit(parts[1])
+        matched = handlerClass.routes.match(target.path)
+        if matched is None or matched[0].get("GET") != "handleSquirrelsChanges":
+            return None
+        try:
+            headers = http.client.parse_headers(io.BytesIO(headerBlock))
+            params = {key: values[0] for key, values in parse_qs(target.query).items()}
+            since, wait, stream = parseChangesQuery(params, headers, changeLog)
+        except (http.client.HTTPException, ValueError):
+            return None
+        return since, wait, stream, headers, parts[2]
+
+    async def serveChanges(self, writer, query, clientAddress, keepAlive):
+        since, wait, stream, headers, version = query
+        if self.admission is not None:
+            refused = self.admission.admit(clientAddress[0], False)
+            if refused is not None:
+                response, keepAlive = frameResponse(self.refuse("GET", refused), keepAlive)
+                writer.write(response)
+                await writer.drain()
+                return keepAlive
+            # the wait holds no thread, so it holds no concurrency slot either
+            self.admission.release()
+        metrics = self.handlerClass.metrics
+        token = metrics.requestStarted("handleSquirrelsChanges", "GET") if metrics is not None else None
+        status = None
+        try:
+            if stream is None:
+                keepAlive = await self.pollChanges(writer, since, wait, headers, keepAlive)
+            else:
+                keepAlive = await self.streamChanges(writer, since, version, keepAlive)
+            status = 200
+        finally:
+            if metrics is not None:
+                metrics.requestFinished(token, status)
+        return keepAlive
+
+    async def waitForChanges(self, since, timeout):
+        # ChangeLog.since, waiting on the loop instead of in a thread
+        changeLog = self.handlerClass.changeLog
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        while True:
+            # taken before looking, so an append in between still wakes us
+            changed = self._changed
+            changes, lastSeq = changeLog.since(since, 0, self.handlerClass.maxPageSize)
+            remaining = deadline - loop.time()
+            if changes != [] or changeLog.closed or remaining <= 0:
+                return changes, lastSeq
+            try:
+                await asyncio.wait_for(changed.wait(), remaining)
+            except asyncio.TimeoutError:
+                pass
+
+    def changesHead(self, contentType, extraHeaders=()):
+        handlerClass = self.handlerClass
+        lines = ["{} 200 OK".format(handlerClass.protocol_version),
+                 "Server: {} {}".format(handlerClass.server_version, handlerClass.sys_version),
+                 "Date: " + formatdate(usegmt=True),
+                 "Content-Type: " + contentType,
+                 "Cache-Control: no-store"]
+        lines.extend(extraHeaders)
+        return bytes("\r\n".join(lines) + "\r\n\r\n", "latin-1")
+
+    async def pollChanges(self, writer, since, wait, headers, keepAlive):
+        changes, lastSeq = await self.waitForChanges(since, min(wait, self.handlerClass.maxChangesWait))
+        bodyFormat = chooseFormat(headers.get("Accept"))
+        body = changesBody(changes, lastSeq, bodyFormat)
+        head = self.changesHead(MEDIA_TYPES[bodyFormat], ["Content-Length: {}".format(len(body))])
+        response, keepAlive = frameResponse(head + body, keepAlive)
+        writer.write(response)
+        await writer.drain()
+        return keepAlive
+
+    async def streamChanges(self, writer, since, version, keepAlive):
+        # the same events as SquirrelServerHandler.streamChanges, each
+        # written as soon as it is committed
+        handlerClass = self.handlerClass
+        changeLog = handlerClass.changeLog
+        chunked = version == "HTTP/1.1"
+        head = self.changesHead("text/event-stream", ["Transfer-Encoding: chunked"] if chunked else [])
+        response, keepAlive = frameResponse(head, keepAlive, streaming=True)
+        writer.write(response)
+        await writer.drain()
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + handlerClass.changesStreamSeconds
+        while not changeLog.closed:
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                break
+            changes, lastSeq = await self.waitForChanges(since, min(handlerClass.changesKeepAlive, remaining))
+            data = changesEvents(changes, lastSeq)
+            writer.write(b"%x\r\n%s\r\n" % (len(data), data) if chunked else data)
+            await writer.drain()
+            if changes is None:
+                break
+            since = lastSeq
+        if chunked:
+            writer.write(b"0\r\n\r\n")
+            await writer.drain()
+        return keepAlive
+
+    async def readRequest(self, reader, writer):
+        try:
+            head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), self.idleTimeout)
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError):
+            return None
+        except asyncio.LimitOverrunError:
+            writer.write(b"HTTP/1.1 431 Request Header Fields Too Large\r\n"
+                         b"Content-Length: 0\r\nConnection: close\r\n\r\n")
+            return None
+        head = head.lstrip(b"\r\n")
+        requestLine, _, headerBlock = head.partition(b"\r\n")
+        parts = requestLine.decode("latin-1").split()
+        method = parts[0] if parts else ""
+        version = parts[2] if len(parts) == 3 else "HTTP/0.9"
+        try:
+            headers = http.client.parse_headers(io.BytesIO(headerBlock))
+            length = int(headers.get("Content-Length") or 0)
+        except (http.client.HTTPException, ValueError):
+            # let the handler produce its usual 400, then hang up
+            return (method, head, False)
+        if headers.get("Transfer-Encoding") or length > self.handlerClass.maxBodyBytes:
+            # the handler refuses the request without its body; hang up
+            # rather than read it
+            return (method, head, False)
+        if length and (headers.get("Expect") or "").lower() == "100-continue":
+            writer.write(b"HTTP/1.1 100 Continue\r\n\r\n")
+        body = await reader.readexactly(length) if length else b""
+        return (method, head + body, wantsKeepAlive(version, headers))
+
+def runAsync(config):
+    openDB(config, config.workers + 1)
+    configureHandler(config)
+    # the group committer can only coalesce writes that reach it concurrently
+    writers = config.workers if config.group_commit else 1
+    server = AsyncSquirrelServer(config.host, config.port, readers=config.workers, writers=writers,
+                                 idleTimeout=config.idle_timeout,
+                                 maxRequestsPerConnection=config.max_requests, admission=makeAdmission(config))
+
+    async def main():
+        stopped = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        loop.add_signal_handler(signal.SIGTERM, stopped.set)
+        loop.add_signal_handler(signal.SIGINT, stopped.set)
+        await server.start()
+        await stopped.wait()
+        releaseWaiters()
+        await server.close()
+
+    try:
+        asyncio.run(main())
+    finally:
+        closeDB()
+
+def run(argv=None):
+    config = parseArgs(argv)
+    print("squirrel_server running at {}:{} (asyncio engine)".format(config.host, config.port))
+    runAsync(config)
+
+if __name__ == '__main__':
+    run()
@@ -1,4 +1,17 @@
+import functools
+import json
+import queue
 import sqlite3
+import threading
+import time
+from operator import attrgetter, itemgetter
+from concurrent.futures import Future
+from collections import OrderedDict, deque
+from collections.abc import Sequence
+from contextlib import contextmanager
+from json.encoder import encode_basestring_ascii
+
+DB_FILENAME = "squirrel_db.db"
 
 def dict_factory(cursor, row):
     d = {}
@@ -6,36 +19,921 @@ def dict_factory(cursor, row):
         d[col[0]] = row[idx]
     return d
 
+def jsonValue(value):
+    # the text json.dumps gives for one column value
+    if type(value) is str:
+        return encode_basestring_ascii(value)
+    if type(value) is int:
+        return int.__repr__(value)
+    return json.dumps(value)
+
+def timedAs(operation):
+    # reports how long each call takes when the connection has metrics
+    def decorate(method):
+        @functools.wraps(method)
+        def timedMethod(self, *args, **kwargs):
+            if self.metrics is None:
+                return method(self, *args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return method(self, *args, **kwargs)
+            finally:
+                self.metrics.observeDB(operation, time.perf_counter() - start)
+        return timedMethod
+    return decorate
+
+def timed(method):
+    return timedAs(method.__name__)(method)
+
+class Squirrel:
+
+    # One squirrels row, without the per-row dict dict_factory builds. It is
+    # encoded to JSON from a per-class template, and indexing by column name,
+    # keys() and comparison with dicts keep it interchangeable with a dict
+    # row. Projections are subclasses that hold only some of the columns.
+
+    __slots__ = ("id", "name", "size")
+    fields = ("id", "name", "size")
+    template = '{"id": %s, "name": %s, "size": %s}'
+    _values = attrgetter("id", "name", "size")
+    _projections = {}
+
+    def __init__(self, id=None, name=None, size=None):
+        self.id = id
+        self.name = name
+        self.size = size
+
+    @classmethod
+    def projection(cls, fields):
+        # the record type for rows holding just these columns, in this order
+        fields = tuple(fields)
+        if fields == Squirrel.fields:
+            return Squirrel
+        record = Squirrel._projections.get(fields)
+        if record is None:
+            def __init__(self, *values):
+                for field, value in zip(fields, values):
+                    setattr(self, field, value)
+            values = attrgetter(*fields)
+            record = type("Squirrel", (Squirrel,), {
+                "__slots__": (),
+                "__init__": __init__,
+                "fields": fields,
+                "template": "{" + ", ".join(json.dumps(field) + ": %s" for field in fields) + "}",
+                "_values": values if len(fields) > 1 else staticmethod(lambda row: (values(row),)),
+            })
+            Squirrel._projections[fields] = record
+        return record
+
+    def __getitem__(self, field):
+        if field not in self.fields:
+            raise KeyError(field)
+        return getattr(self, field)
+
+    def keys(self):
+        return self.fields
+
+    def asDict(self):
+        return dict(zip(self.fields, self._values(self)))
+
+    def toJSON(self):
+        # the same text as json.dumps(self.asDict())
+        return self.template % tuple(map(jsonValue, self._values(self)))
+
+    def __eq__(self, other):
+        if isinstance(other, (Squirrel, dict)):
+            return self.asDict() == dict(other)
+        return NotImplemented
+
+    __hash__ = None
+
+    def __repr__(self):
+        return "Squirrel({})".format(", ".join("{}={!r}".format(field, self[field]) for field in self.fields))
+
+class SquirrelRows(Sequence):
+
+    # The rows of one listing, kept as the plain tuples sqlite returns
+    # together with the record type of the statement that read them, which
+    # maps column names to tuple positions. A record is only built for a row
+    # that is looked at; toJSON() formats the tuples directly.
+
+    __slots__ = ("record", "rows")
+
+    def __init__(self, record, rows):
+        self.record = record
+        self.rows = rows
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return SquirrelRows(self.record, self.rows[index])
+        return self.record(*self.rows[index])
+
+    def __eq__(self, other):
+        if isinstance(other, (SquirrelRows, list)):
+            return list(self) == list(other)
+        return NotImplemented
+
+    __hash__ = None
+
+    def __repr__(self):
+        return "SquirrelRows({!r})".format(list(self))
+
+    def project(self, fields):
+        # the same rows holding only the given columns
+        record = Squirrel.projection(fields)
+        pick = itemgetter(*[self.record.fields.index(field) for field in record.fields])
+        if len(record.fields) == 1:
+            return SquirrelRows(record, [(value,) for value in map(pick, self.rows)])
+        return SquirrelRows(record, list(map(pick, self.rows)))
+
+    def toJSON(self, batchSize=10000):
+        # the same text as json.dumps of the rows as dicts; joining a batch
+        # at a time keeps only one batch of per-row strings alive
+        template = self.record.template
+        pieces = []
+        for start in range(0, len(self.rows), batchSize):
+            batch = self.rows[start:start + batchSize]
+            if self.record is Squirrel:
+                batch = [template % (jsonValue(id), jsonValue(name), jsonValue(size)) for id, name, size in batch]
+            else:
+                batch = [template % tuple(map(jsonValue, row)) for row in batch]
+            pieces.append(", ".join(batch))
+        return "[" + ", ".join(pieces) + "]"
+
+class SquirrelCache:
+
+    # A bounded, thread-safe LRU map. Entries older than `ttl` seconds are
+    # treated as misses. Writes through this process invalidate exactly
+    # the rows they touch; with otherWriters, other processes write the
+    # same database too, and SquirrelDB checks every hit against the data
+    # version. Either way the ttl only bounds how stale a row can get when
+    # something writes the table without going through SquirrelDB.
+
+    def __init__(self, maxSize=10000, ttl=60.0, otherWriters=False):
+        self.maxSize = maxSize
+        self.ttl = ttl
+        self.otherWriters = otherWriters
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._generation = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            value, expires = entry
+            if expires is not None and expires < time.monotonic():
+                del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def token(self):
+        # take this before reading the db and hand it to put(); a put is
+        # dropped if anything was invalidated in between, so a slow reader
+        # can never cache a row a concurrent write has replaced
+        return self._generation
+
+    def put(self, key, value, token=None):
+        expires = time.monotonic() + self.ttl if self.ttl else None
+        with self._lock:
+            if token is not None and token != self._generation:
+                return
+            self._entries[key] = (value, expires)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxSize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, key):
+        with self._lock:
+            self._generation += 1
+            if self._entries.pop(key, None) is not None:
+                self.invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self.invalidations += len(self._entries)
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {"size": len(self._entries), "hits": self.hits, "misses": self.misses,
+                    "evictions": self.evictions, "invalidations": self.invalidations}
+
+class ChangeLog:
+
+    # A bounded, thread-safe record of committed writes in this process.
+    # Every change gets the next sequence number and only the newest
+    # `maxEntries` are kept; a reader that asks for changes which have
+    # already been dropped is told to resync instead.
+
+    def __init__(self, maxEntries=10000):
+        self.maxEntries = maxEntries
+        self.closed = False
+        # held by writers across commit and append, so changes are numbered
+        # in the order their transactions committed
+        self.commitLock = threading.Lock()
+        self._entries = deque()
+        self._lastSeq = 0
+        self._condition = threading.Condition()
+        self._listeners = []
+
+    def subscribe(self, listener):
+        # listener() is called, from the writer's thread and without any lock
+        # held, after every append and on close; it must not block
+        with self._condition:
+            self._listeners.append(listener)
+
+    def unsubscribe(self, listener):
+        with self._condition:
+            self._listeners.remove(listener)
+
+    def _notify(self):
+        with self._condition:
+            listeners = list(self._listeners)
+        for listener in listeners:
+            listener()
+
+    def lastSeq(self):
+        with self._condition:
+            return self._lastSeq
+
+    def append(self, changes):
+        # changes is a list of (op, squirrel id, row or None)
+        with self._condition:
+            for op, squirrelId, squirrel in changes:
+                self._lastSeq += 1
+                self._entries.append({"seq": self._lastSeq, "op": op, "id": squirrelId, "squirrel": squirrel})
+            while len(self._entries) > self.maxEntries:
+                self._entries.popleft()
+            self._condition.notify_all()
+        self._notify()
+
+    def since(self, seq, timeout=0, limit=None):
+        # (changes after seq, last seq), waiting up to timeout seconds for
+        # the first one; changes is None when seq is no longer covered by
+        # the log (or comes from before a restart) and the reader must resync
+        deadline = time.monotonic() + timeout
+        with self._condition:
+            while True:
+                if seq > self._lastSeq or (self._entries and self._entries[0]["seq"] > seq + 1):
+                    return (None, self._lastSeq)
+                if seq < self._lastSeq:
+                    start = seq - self._entries[0]["seq"] + 1
+                    stop = len(self._entries) if limit is None else min(start + limit, len(self._entries))
+                    changes = [self._entries[index] for index in range(start, stop)]
+                    return (changes, changes[-1]["seq"])
+                remaining = deadline - time.monotonic()
+                if self.closed or remaining <= 0:
+                    return ([], self._lastSeq)
+                self._condition.wait(remaining)
+
+    def close(self):
+        # wakes every waiting reader; later reads no longer wait
+        with self._condition:
+            self.closed = True
+            self._condition.notify_all()
+        self._notify()
+
+ROW_VERSION_MATCHES = ("COALESCE((SELECT version FROM squirrel_versions "
+                       "WHERE squirrel_versions.id = squirrels.id), 0) = ?")
+
+def cacheKey(squirrelId):
+    try:
+        return int(squirrelId)
+    except (TypeError, ValueError):
+        return None
+
 class SquirrelDB:
 
-    def __init__(self):
-        self.connection = sqlite3.connect("squirrel_db.db")
+    # WAL lets readers carry on while a write commits, and with
+    # synchronous=NORMAL a commit no longer waits for an fsync; only a
+    # checkpoint does
+    journalMode = "WAL"
+    synchronous = "NORMAL"
+    walAutocheckpoint = 1000
+    busyTimeout = 5.0
+    cache = None
+    changeLog = None
+    metrics = None
+    # the data version the last write on this connection stamped its rows with
+    writtenVersion = None
+    # every query shape is built from a fixed set of clauses, so a small
+    # per-connection statement cache holds all of them
+    cachedStatements = 256
+    columns = ("id", "name", "size")
+    _preparedFiles = set()
+    _prepareLock = threading.Lock()
+
+    def __init__(self, filename=DB_FILENAME, synchronous=None, cache=None, changeLog=None, metrics=None):
+        start = time.perf_counter()
+        # pooled connections are handed between threads one borrower at a
+        # time, so sqlite's same-thread check would only get in the way
+        self.connection = sqlite3.connect(filename, timeout=self.busyTimeout, check_same_thread=False,
+                                          cached_statements=self.cachedStatements)
+        self.connection.execute("PRAGMA journal_mode = {}".format(self.journalMode))
+        self.connection.execute("PRAGMA synchronous = {}".format(synchronous or self.synchronous))
+        self.connection.execute("PRAGMA wal_autocheckpoint = {:d}".format(self.walAutocheckpoint))
         self.connection.row_factory = dict_factory
         self.cursor = self.connection.cursor()
+        # listings build Squirrel records from plain tuples
+        self.rowCursor = self.connection.cursor()
+        self.rowCursor.row_factory = None
+        self._transactionDepth = 0
+        self._staleKeys = set()
+        # (op, id, row) for each write in the open transaction, published to
+        # the change log once it commits
+        self._pendingChanges = []
+        self.cache = cache
+        self.changeLog = changeLog
+        self.metrics = metrics
+        self._prepare(filename)
+        if metrics is not None:
+            metrics.observeDB("connect", time.perf_counter() - start)
+
+    def _prepare(self, filename):
+        # one-time schema additions, done by the first connection a process
+        # opens to each file
+        with self._prepareLock:
+            if filename in self._preparedFiles:
+                return
+            self.connection.execute("CREATE TABLE IF NOT EXISTS squirrels_meta (name TEXT PRIMARY KEY, value INTEGER)")
+            self.connection.execute("INSERT OR IGNORE INTO squirrels_meta (name, value) VALUES ('version', 0)")
+            # the data version each row was last written at; rows nobody has
+            # written since this table appeared count as version 0
+            self.connection.execute("CREATE TABLE IF NOT EXISTS squirrel_versions (id INTEGER PRIMARY KEY, version INTEGER NOT NULL)")
+            # an index entry is (value, rowid), so filtered pages come out
+            # already in id order
+            self.connection.execute("CREATE INDEX IF NOT EXISTS squirrels_name ON squirrels (name)")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS squirrels_size ON squirrels (size)")
+            self.connection.commit()
+            self._preparedFiles.add(filename)
+
+    @timed
+    def getDataVersion(self):
+        # bumped in the same transaction as every write, so it changes
+        # whenever the squirrels table does, whichever process wrote it
+        self.cursor.execute("SELECT value FROM squirrels_meta WHERE name = 'version'")
+        return self.cursor.fetchone()["value"]
 
-    def getSquirrels(self):
-        self.cursor.execute("SELECT * FROM squirrels ORDER BY id")
+    def _bumpVersion(self):
+        self.writtenVersion = self.connection.execute(
+            "UPDATE squirrels_meta SET value = value + 1 WHERE name = 'version' RETURNING value").fetchone()["value"]
+
+    def _stampRows(self, squirrelIds):
+        # call after _bumpVersion so the rows carry the version being written
+        self.connection.executemany(
+            "INSERT OR REPLACE INTO squirrel_versions (id, version) "
+            "SELECT ?, value FROM squirrels_meta WHERE name = 'version'",
+            [[squirrelId] for squirrelId in squirrelIds])
+
+    def _unstampRows(self, squirrelIds):
+        self.connection.executemany("DELETE FROM squirrel_versions WHERE id = ?",
+                                    [[squirrelId] for squirrelId in squirrelIds])
+
+    def isHealthy(self):
+        try:
+            self.connection.execute("SELECT 1").fetchone()
+            return True
+        except sqlite3.Error:
+            return False
+
+    def close(self):
+        self.connection.close()
+
+    @contextmanager
+    def transaction(self):
+        # nested transactions join the outermost one, which commits once
+        if self._transactionDepth == 0:
+            self.connection.execute("BEGIN IMMEDIATE")
+        self._transactionDepth += 1
+        try:
+            yield self
+        except BaseException:
+            self._transactionDepth -= 1
+            if self._transactionDepth == 0:
+                self.connection.rollback()
+                self._pendingChanges = []
+                self._afterCommit()
+            raise
+        self._transactionDepth -= 1
+        if self._transactionDepth == 0:
+            self._commitChanges()
+            self._afterCommit()
+
+    def _commit(self):
+        if self._transactionDepth == 0:
+            self._commitChanges()
+            self._afterCommit()
+
+    @timedAs("commit")
+    def _commitChanges(self):
+        if self.changeLog is None or not self._pendingChanges:
+            self._pendingChanges = []
+            self.connection.commit()
+            return
+        with self.changeLog.commitLock:
+            self.connection.commit()
+            self.changeLog.append(self._pendingChanges)
+        self._pendingChanges = []
+
+    def _changed(self, squirrelId):
+        self._staleKeys.add(cacheKey(squirrelId))
+
+    def _logChange(self, op, squirrelId, squirrel=None):
+        if self.changeLog is not None:
+            self._pendingChanges.append((op, squirrelId, squirrel))
+
+    def _afterCommit(self):
+        # cached rows are dropped only once the change is visible to other
+        # connections, otherwise a reader could cache the old row again
+        if self.cache is not None:
+            for key in self._staleKeys:
+                self.cache.invalidate(key)
+        self._staleKeys.clear()
+
+    @timed
+    def getSquirrels(self, limit=None, afterId=None, name=None, size=None, fields=None):
+        # a list of dict rows; name and size filter on equality, fields
+        # picks the columns returned
+        self.cursor.execute(*self._pageQuery(limit, afterId, name, size, fields))
         return self.cursor.fetchall()
 
+    @timed
+    def getSquirrelRows(self, limit=None, afterId=None, name=None, size=None, fields=None):
+        # like getSquirrels, as SquirrelRows of tuples that encode straight
+        # to JSON without a dict per row
+        record = Squirrel.projection(fields or self.columns)
+        self.rowCursor.execute(*self._pageQuery(limit, afterId, name, size, record.fields))
+        return SquirrelRows(record, self.rowCursor.fetchall())
+
+    def iterSquirrels(self, limit=None, afterId=None, name=None, size=None, fields=None, batchSize=500):
+        # dict rows, read batchSize at a time
+        return self._iterRows(self._pageQuery(limit, afterId, name, size, fields), None, batchSize)
+
+    def iterSquirrelRows(self, limit=None, afterId=None, name=None, size=None, fields=None, batchSize=500):
+        # like iterSquirrels, as Squirrel records
+        record = Squirrel.projection(fields or self.columns)
+        return self._iterRows(self._pageQuery(limit, afterId, name, size, record.fields), record, batchSize)
+
+    def _iterRows(self, query, record, batchSize):
+        # a private cursor keeps the stream independent of self.cursor
+        cursor = self.connection.cursor()
+        if record is not None:
+            cursor.row_factory = None
+        try:
+            cursor.execute(*query)
+            rows = cursor.fetchmany(batchSize)
+            while rows:
+                if record is None:
+                    yield from rows
+                else:
+                    for row in rows:
+                        yield record(*row)
+                rows = cursor.fetchmany(batchSize)
+        finally:
+            cursor.close()
+
+    @timed
+    def getPageEnd(self, limit, afterId=None, name=None, size=None):
+        # the id the next page starts after, or None on the last page
+        sql, data = self._pageQuery(2, afterId, name, size, ("id",))
+        rows = self.connection.execute(sql + " OFFSET ?", data + [limit - 1]).fetchall()
+        if len(rows) == 2:
+            return rows[0]["id"]
+        return None
+
+    def _pageQuery(self, limit, afterId, name=None, size=None, fields=None):
+        if fields:
+            unknown = set(fields) - set(self.columns)
+            if unknown:
+                raise ValueError("unknown squirrel fields: " + ", ".join(sorted(unknown)))
+            sql = "SELECT {} FROM squirrels".format(", ".join(fields))
+        else:
+            sql = "SELECT * FROM squirrels"
+        conditions = []
+        data = []
+        if name is not None:
+            conditions.append("name = ?")
+            data.append(name)
+        if size is not None:
+            conditions.append("size = ?")
+            data.append(size)
+        if afterId is not None:
+            conditions.append("id > ?")
+            data.append(afterId)
+        if conditions:
+            sql += " WHERE " + " AND ".join(conditions)
+        sql += " ORDER BY id"
+        if limit is not None:
+            sql += " LIMIT ?"
+            data.append(limit)
+        return (sql, data)
+
+    @timed
     def getSquirrel(self, squirrelId):
+        if self.cache is not None:
+            entry = self._getCachedEntry(squirrelId)
+            return entry[0] if entry else None
         data = [squirrelId]
         self.cursor.execute("SELECT * FROM squirrels WHERE id = ?", data)
         return self.cursor.fetchone()
 
+    def getSquirrelJSON(self, squirrelId):
+        entry = self.getSquirrelEntry(squirrelId)
+        return entry[1] if entry else None
+
+    @timed
+    def getRowVersion(self, squirrelId):
+        # the data version the row was last written at
+        self.cursor.execute("SELECT version FROM squirrel_versions WHERE id = ?", [squirrelId])
+        row = self.cursor.fetchone()
+        return row["version"] if row else 0
+
+    def getSquirrelEntry(self, squirrelId):
+        # (row, encoded row, row version), or None
+        if self.cache is not None:
+            return self._getCachedEntry(squirrelId)
+        # the version is read first, so a write in between can only leave it
+        # older than the row, never newer
+        version = self.getRowVersion(squirrelId)
+        return self._makeEntry(self.getSquirrel(squirrelId), version)
+
+    @timed
+    def getLiveRowVersion(self, squirrelId):
+        # like getRowVersion, but None once the row is gone
+        self.cursor.execute("SELECT v.version FROM squirrels s LEFT JOIN squirrel_versions v ON v.id = s.id "
+                            "WHERE s.id = ?", [squirrelId])
+        row = self.cursor.fetchone()
+        if row is None:
+            return None
+        return row["version"] or 0
+
+    def _getCachedEntry(self, squirrelId):
+        # the cache holds (entry, data version it was checked at). Other
+        # processes write without invalidating this cache, but every write
+        # bumps the data version: an entry checked at the current one is
+        # fresh, and an older one is kept only while its row version holds.
+        # Without other writers there is nothing to check, and a hit costs
+        # no query at all.
+        key = cacheKey(squirrelId)
+        if key is None:
+            return None
+        dataVersion = self.getDataVersion() if self.cache.otherWriters else None
+        cached = self.cache.get(key)
+        if cached is not None:
+            entry, checkedAt = cached
+            if checkedAt == dataVersion:
+                return entry
+            token = self.cache.token()
+            if self.getLiveRowVersion(key) == entry[2]:
+                self.cache.put(key, (entry, dataVersion), token)
+                return entry
+        token = self.cache.token()
+        version = self.getRowVersion(key)
+        entry = self._makeEntry(self._selectSquirrel(key), version)
+        if entry is not None:
+            self.cache.put(key, (entry, dataVersion), token)
+        elif cached is not None:
+            self.cache.invalidate(key)
+        return entry
+
+    @timedAs("selectSquirrel")
+    def _selectSquirrel(self, squirrelId):
+        # the row read on a cache miss, timed on its own since getSquirrel
+        # is not what the server calls
+        self.cursor.execute("SELECT * FROM squirrels WHERE id = ?", [squirrelId])
+        return self.cursor.fetchone()
+
+    def _makeEntry(self, squirrel, version):
+        if squirrel is None:
+            return None
+        return (squirrel, bytes(json.dumps(squirrel), "utf-8"), version)
+
+    @timed
     def createSquirrel(self, name, size):
+        # returns the new row
         data = [name, size]
-        self.cursor.execute("INSERT INTO squirrels (name, size) VALUES (?, ?)", data)
-        self.connection.commit()
-        return None
+        self.cursor.execute("INSERT INTO squirrels (name, size) VALUES (?, ?) RETURNING *", data)
+        squirrel = self._returnedRow()
+        self._bumpVersion()
+        self._stampRows([squirrel["id"]])
+        self._logChange("create", squirrel["id"], squirrel)
+        self._commit()
+        return squirrel
 
-    def updateSquirrel(self, squirrelId, name, size):
+    @timed
+    def updateSquirrel(self, squirrelId, name, size, expectedVersion=None):
+        # returns the updated row, or None if there is no such squirrel or,
+        # with expectedVersion, it is no longer at that version
+        sql = "UPDATE squirrels SET name = ?, size = ? WHERE id = ?"
         data = [name, size, squirrelId]
-        self.cursor.execute("UPDATE squirrels SET name = ?, size = ? WHERE id = ?", data)
-        self.connection.commit()
-        return None
+        if expectedVersion is not None:
+            sql += " AND " + ROW_VERSION_MATCHES
+            data.append(expectedVersion)
+        self.cursor.execute(sql + " RETURNING *", data)
+        squirrel = self._returnedRow()
+        if squirrel is not None:
+            self._bumpVersion()
+            self._stampRows([squirrelId])
+            self._changed(squirrelId)
+            self._logChange("update", squirrel["id"], squirrel)
+        self._commit()
+        return squirrel
+
+    def createSquirrelWithVersion(self, name, size):
+        # (new row, the row version it was written at)
+        squirrel = self.createSquirrel(name, size)
+        return (squirrel, self.writtenVersion)
+
+    def updateSquirrelWithVersion(self, squirrelId, name, size, expectedVersion=None):
+        # (updated row, its new row version), or (None, None) like updateSquirrel
+        squirrel = self.updateSquirrel(squirrelId, name, size, expectedVersion)
+        return (squirrel, self.writtenVersion if squirrel is not None else None)
 
-    def deleteSquirrel(self, squirrelId):
+    @timed
+    def deleteSquirrel(self, squirrelId, expectedVersion=None):
+        # returns the deleted row, or None like updateSquirrel
+        sql = "DELETE FROM squirrels WHERE id = ?"
         data = [squirrelId]
-        self.cursor.execute("DELETE FROM squirrels WHERE id = ?", data)
-        self.connection.commit()
-        return None
+        if expectedVersion is not None:
+            sql += " AND " + ROW_VERSION_MATCHES
+            data.append(expectedVersion)
+        self.cursor.execute(sql + " RETURNING *", data)
+        squirrel = self._returnedRow()
+        if squirrel is not None:
+            self._bumpVersion()
+            self._unstampRows([squirrelId])
+            self._changed(squirrelId)
+            self._logChange("delete", squirrel["id"])
+        self._commit()
+        return squirrel
+
+    def _returnedRow(self):
+        # fetchall finishes the statement, which sqlite needs before a commit
+        rows = self.cursor.fetchall()
+        return rows[0] if rows else None
+
+    @timed
+    def createSquirrels(self, squirrels):
+        # squirrels is a list of (name, size); returns the new ids in order
+        if not squirrels:
+            return []
+        with self.transaction():
+            self.cursor.executemany("INSERT INTO squirrels (name, size) VALUES (?, ?)", squirrels)
+            lastId = self.connection.execute("SELECT last_insert_rowid() AS id").fetchone()["id"]
+            # the write lock is held for the whole transaction, so the rowids
+            # sqlite picked for this batch are consecutive
+            squirrelIds = list(range(lastId - len(squirrels) + 1, lastId + 1))
+            self._bumpVersion()
+            self._stampRows(squirrelIds)
+            for squirrelId, (name, size) in zip(squirrelIds, squirrels):
+                self._logChange("create", squirrelId, {"id": squirrelId, "name": name, "size": size})
+        return squirrelIds
+
+    @timed
+    def updateSquirrels(self, squirrels):
+        # squirrels is a list of (id, name, size); returns whether each existed
+        with self.transaction():
+            found = self._existingIds([squirrelId for squirrelId, name, size in squirrels])
+            data = [(name, size, squirrelId) for squirrelId, name, size in squirrels if squirrelId in found]
+            # a batch that changes nothing leaves the version, and so every
+            # cached list and ETag, alone
+            if data:
+                self.cursor.executemany("UPDATE squirrels SET name = ?, size = ? WHERE id = ?", data)
+                self._bumpVersion()
+                self._stampRows(found)
+            for name, size, squirrelId in data:
+                self._changed(squirrelId)
+                self._logChange("update", squirrelId, {"id": squirrelId, "name": name, "size": size})
+        return [squirrelId in found for squirrelId, name, size in squirrels]
+
+    @timed
+    def deleteSquirrels(self, squirrelIds):
+        # returns whether each id existed
+        with self.transaction():
+            found = self._existingIds(squirrelIds)
+            if found:
+                self.cursor.executemany("DELETE FROM squirrels WHERE id = ?", [[squirrelId] for squirrelId in found])
+                self._bumpVersion()
+                self._unstampRows(found)
+            for squirrelId in found:
+                self._changed(squirrelId)
+            for squirrelId in dict.fromkeys(squirrelIds):
+                if squirrelId in found:
+                    self._logChange("delete", squirrelId)
+        return [squirrelId in found for squirrelId in squirrelIds]
+
+    def _existingIds(self, squirrelIds):
+        found = set()
+        unique = list(set(squirrelIds))
+        # stay well under sqlite's limit on bound parameters
+        for start in range(0, len(unique), 500):
+            chunk = unique[start:start + 500]
+            sql = "SELECT id FROM squirrels WHERE id IN ({})".format(", ".join("?" * len(chunk)))
+            found.update(row["id"] for row in self.connection.execute(sql, chunk))
+        return found
+
+class PoolClosedError(Exception):
+    pass
+
+class SquirrelDBPool:
+
+    def __init__(self, size=4, filename=DB_FILENAME, timeout=None, healthCheckAfter=30.0, cache=None, changeLog=None,
+                 metrics=None):
+        self.size = size
+        self.filename = filename
+        # shared by every pooled connection
+        self.cache = cache
+        self.changeLog = changeLog
+        self.metrics = metrics
+        self.timeout = timeout
+        # connections idle for less than this are handed out unchecked
+        self.healthCheckAfter = healthCheckAfter
+        self._idle = queue.LifoQueue()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._open = 0
+        self._closed = False
+
+    def acquire(self):
+        # a thread that already holds a connection keeps using it, so nested
+        # borrows inside one request never wait on the pool
+        db = getattr(self._local, "db", None)
+        if db is not None:
+            self._local.depth += 1
+            return db
+        db = self._checkout()
+        self._local.db = db
+        self._local.depth = 1
+        return db
+
+    def release(self, db):
+        if getattr(self._local, "db", None) is not db:
+            raise ValueError("connection was not borrowed by this thread")
+        self._local.depth -= 1
+        if self._local.depth > 0:
+            return
+        self._local.db = None
+        with self._lock:
+            if not self._closed:
+                self._idle.put((db, time.monotonic()))
+                return
+            self._open -= 1
+        db.close()
+
+    @contextmanager
+    def connection(self):
+        db = self.acquire()
+        try:
+            yield db
+        finally:
+            self.release(db)
+
+    def close(self):
+        with self._lock:
+            self._closed = True
+        while True:
+            try:
+                db, releasedAt = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            with self._lock:
+                self._open -= 1
+            db.close()
+
+    def _checkout(self):
+        while True:
+            with self._lock:
+                if self._closed:
+                    raise PoolClosedError("squirrel db pool is closed")
+                try:
+                    db, releasedAt = self._idle.get_nowait()
+                except queue.Empty:
+                    db = None
+                    if self._open < self.size:
+                        self._open += 1
+                        break
+            if db is None:
+                try:
+                    db, releasedAt = self._idle.get(timeout=self.timeout)
+                except queue.Empty:
+                    raise TimeoutError("no squirrel db connection available")
+            if time.monotonic() - releasedAt < self.healthCheckAfter or db.isHealthy():
+                return db
+            with self._lock:
+                self._open -= 1
+            db.close()
+        try:
+            return SquirrelDB(self.filename, cache=self.cache, changeLog=self.changeLog, metrics=self.metrics)
+        except Exception:
+            with self._lock:
+                self._open -= 1
+            raise
+
+class GroupCommitter:
+
+    # Runs writes from many threads on one connection, folding every write
+    # that arrives within `window` seconds (or `maxBatch` writes) into a
+    # single transaction. Each write runs under its own savepoint, so one
+    # failing write does not undo its neighbours, and its caller is only
+    # answered once the shared commit has finished.
+
+    def __init__(self, filename=DB_FILENAME, window=0.002, maxBatch=256, synchronous="FULL", cache=None,
+                 changeLog=None, metrics=None):
+        self.filename = filename
+        self.cache = cache
+        self.changeLog = changeLog
+        self.metrics = metrics
+        self.window = window
+        self.maxBatch = maxBatch
+        self.synchronous = synchronous
+        self._queue = queue.Queue()
+        self._started = threading.Event()
+        self._startError = None
+        self._thread = threading.Thread(target=self._run, name="squirrel-group-commit", daemon=True)
+        self._thread.start()
+        self._started.wait()
+        if self._startError is not None:
+            raise self._startError
+
+    def submit(self, method, *args):
+        future = Future()
+        self._queue.put((future, method, args))
+        return future
+
+    def call(self, method, *args):
+        return self.submit(method, *args).result()
+
+    def close(self):
+        self._queue.put(None)
+        self._thread.join()
+
+    def _run(self):
+        try:
+            db = SquirrelDB(self.filename, synchronous=self.synchronous, cache=self.cache, changeLog=self.changeLog,
+                            metrics=self.metrics)
+        except Exception as e:
+            self._startError = e
+            self._started.set()
+            return
+        self._started.set()
+        stopping = False
+        while not stopping:
+            item = self._queue.get()
+            if item is None:
+                break
+            batch = [item]
+            deadline = time.monotonic() + self.window
+            while len(batch) < self.maxBatch:
+                remaining = deadline - time.monotonic()
+                try:
+                    item = self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+            self._commitBatch(db, batch)
+        db.close()
+
+    def _commitBatch(self, db, batch):
+        batch = [item for item in batch if item[0].set_running_or_notify_cancel()]
+        outcomes = []
+        try:
+            with db.transaction():
+                for future, method, args in batch:
+                    db.connection.execute("SAVEPOINT squirrel_write")
+                    pending = len(db._pendingChanges)
+                    try:
+                        result = getattr(db, method)(*args)
+                    except Exception as e:
+                        db.connection.execute("ROLLBACK TO squirrel_write")
+                        del db._pendingChanges[pending:]
+                        outcomes.append((False, e))
+                    else:
+                        outcomes.append((True, result))
+                    db.connection.execute("RELEASE squirrel_write")
+        except Exception as e:
+            for future, method, args in batch:
+                future.set_exception(e)
+            return
+        for (future, method, args), (ok, value) in zip(batch, outcomes):
+            if ok:
+                future.set_result(value)
+            else:
+                future.set_exception(value)
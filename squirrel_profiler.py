@@ -0,0 +1,170 @@
+import cProfile
+import marshal
+import pstats
+import random
+import sys
+import threading
+import time
+
+PROFILE_HEADER = "X-Squirrel-Profile"
+MODES = ("cprofile", "stacks")
+
+def frameName(frame):
+    return "{}.{}".format(frame.f_globals.get("__name__", "?"), frame.f_code.co_qualname)
+
+def builtinName(function):
+    owner = getattr(function, "__self__", None)
+    module = getattr(function, "__module__", None)
+    if module is None and owner is not None:
+        module = type(owner).__module__
+    name = getattr(function, "__qualname__", None) or repr(function)
+    return "{}.{}".format(module, name) if module else name
+
+class StackTracer:
+
+    # A sys.setprofile hook that charges the wall-clock time between events
+    # to the exact call stack it was spent in, which is what flame graph
+    # tools read. Time spent waiting in C calls (sqlite, socket writes)
+    # counts too, unlike with a CPU sampler.
+
+    def __init__(self):
+        self.stacks = {}
+        self._names = []
+        self._started = []
+
+    def __call__(self, frame, event, arg):
+        now = time.perf_counter()
+        if event == "call" or event == "c_call":
+            if self._names:
+                self._charge(now)
+            self._names.append(frameName(frame) if event == "call" else builtinName(arg))
+            self._started.append(now)
+        elif self._names:
+            # return, c_return or c_exception; returns from frames entered
+            # before tracing started are ignored
+            self._charge(now)
+            self._names.pop()
+            self._started.pop()
+            if self._started:
+                self._started[-1] = now
+
+    def _charge(self, now):
+        key = ";".join(self._names)
+        self.stacks[key] = self.stacks.get(key, 0.0) + now - self._started[-1]
+        self._started[-1] = now
+
+    def run(self, function, *args):
+        sys.setprofile(self)
+        try:
+            return function(*args)
+        finally:
+            sys.setprofile(None)
+
+class RequestProfiler:
+
+    # Profiles chosen requests on the thread that serves them: any request
+    # sending the X-Squirrel-Profile header (while allowHeader is set) and
+    # a random sampleRate share of all requests. Results are aggregated
+    # across requests, as pstats data in "cprofile" mode or as collapsed
+    # stacks in "stacks" mode. Every setting can be changed while the
+    # server runs; requests that are not profiled pay for one random().
+
+    def __init__(self, sampleRate=0.0, mode="cprofile", allowHeader=True):
+        self.enabled = True
+        self.sampleRate = 0.0
+        self.mode = "cprofile"
+        self.allowHeader = True
+        self.profiled = 0
+        self._lock = threading.Lock()
+        # from Python 3.12 on only one cProfile may be enabled at a time,
+        # in any thread
+        self._cprofileLock = threading.Lock()
+        self._stats = None
+        self._stacks = {}
+        self.configure({"sampleRate": sampleRate, "mode": mode, "allowHeader": allowHeader})
+
+    def shouldProfile(self, headerValue=None):
+        if not self.enabled:
+            return False
+        if headerValue is not None and self.allowHeader and headerValue not in ("", "0"):
+            return True
+        return self.sampleRate > 0 and random.random() < self.sampleRate
+
+    def profile(self, function, *args):
+        if self.mode == "stacks":
+            tracer = StackTracer()
+            try:
+                return tracer.run(function, *args)
+            finally:
+                with self._lock:
+                    self.profiled += 1
+                    for stack, seconds in tracer.stacks.items():
+                        self._stacks[stack] = self._stacks.get(stack, 0.0) + seconds
+        if not self._cprofileLock.acquire(blocking=False):
+            # another request is being profiled; this one just runs
+            return function(*args)
+        try:
+            profile = cProfile.Profile()
+            try:
+                profile.enable()
+            except ValueError:
+                # another profiling tool, such as a debugger, holds the hook
+                return function(*args)
+            try:
+                return function(*args)
+            finally:
+                profile.disable()
+                with self._lock:
+                    self.profiled += 1
+                    if self._stats is None:
+                        self._stats = pstats.Stats(profile)
+                    else:
+                        self._stats.add(profile)
+        finally:
+            self._cprofileLock.release()
+
+    def configure(self, settings):
+        # applies a dict of new settings; raises ValueError on a bad one
+        # without changing anything
+        enabled = settings.get("enabled", self.enabled)
+        sampleRate = settings.get("sampleRate", self.sampleRate)
+        mode = settings.get("mode", self.mode)
+        allowHeader = settings.get("allowHeader", self.allowHeader)
+        if not isinstance(enabled, bool) or not isinstance(allowHeader, bool):
+            raise ValueError("enabled and allowHeader must be true or false")
+        if isinstance(sampleRate, bool) or not isinstance(sampleRate, (int, float)) or not 0 <= sampleRate <= 1:
+            raise ValueError("sampleRate must be a number from 0 to 1")
+        if mode not in MODES:
+            raise ValueError("mode must be one of " + ", ".join(MODES))
+        with self._lock:
+            self.enabled = enabled
+            self.sampleRate = float(sampleRate)
+            self.mode = mode
+            self.allowHeader = allowHeader
+
+    def settings(self):
+        with self._lock:
+            return {"enabled": self.enabled, "sampleRate": self.sampleRate, "mode": self.mode,
+                    "allowHeader": self.allowHeader, "profiled": self.profiled}
+
+    def reset(self):
+        with self._lock:
+            self.profiled = 0
+            self._stats = None
+            self._stacks = {}
+
+    def pstatsData(self):
+        # the aggregated cProfile results in the file format pstats and
+        # snakeviz load, or None before any request was profiled
+        with self._lock:
+            if self._stats is None:
+                return None
+            return marshal.dumps(self._stats.stats)
+
+    def collapsedStacks(self):
+        # "frame;frame;frame microseconds" lines for flamegraph.pl,
+        # speedscope and friends
+        with self._lock:
+            stacks = sorted(self._stacks.items())
+        return "".join("{} {}\n".format(stack, round(seconds * 1e6)) for stack, seconds in stacks
+                       if round(seconds * 1e6) > 0)
@@ -0,0 +1,84 @@
+from urllib.parse import unquote
+
+def splitPath(path):
+    # the segments of an absolute path, ignoring one trailing slash, or None
+    if not path.startswith("/"):
+        return None
+    segments = path.split("/")[1:]
+    if segments and segments[-1] == "":
+        segments.pop()
+    return segments
+
+class RouteNode:
+
+    __slots__ = ("children", "param", "paramName", "handlers")
+
+    def __init__(self):
+        self.children = {}
+        self.param = None
+        self.paramName = None
+        self.handlers = {}
+
+class Router:
+
+    # Routes (method, path template) pairs to handler names. Templates such as
+    # "/squirrels/{squirrelId}" are compiled into a trie of path segments when
+    # they are added, so matching a path costs one dict lookup per segment
+    # however many routes are registered. A literal segment wins over a
+    # "{name}" one at the same position. Templates without parameters are
+    # also kept in a dict by their exact path, so the most common requests
+    # are matched with one lookup and no splitting.
+
+    def __init__(self):
+        self._root = RouteNode()
+        # path -> the handlers dict of its trie node, with and without one
+        # trailing slash
+        self._static = {}
+
+    def add(self, method, template, handlerName):
+        segments = splitPath(template)
+        if segments is None:
+            raise ValueError("route templates must start with /: " + template)
+        node = self._root
+        static = True
+        for segment in segments:
+            if segment.startswith("{") and segment.endswith("}"):
+                static = False
+                name = segment[1:-1]
+                if node.param is None:
+                    node.param = RouteNode()
+                    node.paramName = name
+                elif node.paramName != name:
+                    raise ValueError("{} conflicts with {{{}}}".format(template, node.paramName))
+                node = node.param
+            else:
+                node = node.children.setdefault(segment, RouteNode())
+        node.handlers[method] = handlerName
+        if static:
+            path = "/" + "/".join(segments)
+            self._static[path] = node.handlers
+            if segments:
+                self._static[path + "/"] = node.handlers
+
+    def match(self, path):
+        # (handler names by method, path parameters), or None when no
+        # template fits the path
+        handlers = self._static.get(path)
+        if handlers is not None:
+            return (handlers, {})
+        segments = splitPath(path)
+        if segments is None:
+            return None
+        node = self._root
+        params = {}
+        for segment in segments:
+            child = node.children.get(segment)
+            if child is None:
+                if node.param is None or segment == "":
+                    return None
+                params[node.paramName] = unquote(segment) if "%" in segment else segment
+                child = node.param
+            node = child
+        if not node.handlers:
+            return None
+        return (node.handlers, params)
@@ -1,133 +1,1310 @@
+import argparse
 import json
+import os
+import signal
+import socket
+import threading
+import time
+import traceback
+import zlib
+from contextlib import closing
+from concurrent.futures import ThreadPoolExecutor
 from http.server import BaseHTTPRequestHandler, HTTPServer
-from urllib.parse import parse_qs
-from squirrel_db import SquirrelDB
+from urllib.parse import parse_qs, urlencode, urlsplit
+from squirrel_admission import READ_METHODS, AdmissionController, refusal
+from squirrel_db import DB_FILENAME, ChangeLog, GroupCommitter, Squirrel, SquirrelCache, SquirrelDB, SquirrelDBPool, SquirrelRows
+from squirrel_metrics import Metrics
+from squirrel_profiler import MODES as PROFILE_MODES, PROFILE_HEADER, RequestProfiler
+from squirrel_router import Router
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+FORM = "application/x-www-form-urlencoded"
+VARY_ENCODING = ("Vary", "Accept, Accept-Encoding")
+
+class ResponseCache:
+
+    # Encoded response bodies for one data version at a time, under any
+    # hashable key (a page, a content encoding). The first body stored for a
+    # newer version drops everything kept for older ones. Keys come from the
+    # query string, so clients choose them: at most maxEntries bodies and
+    # maxBytes bytes of them are kept, and bodies past either are served
+    # without being stored.
+
+    def __init__(self, maxEntries=256, maxBytes=64 << 20):
+        self.maxEntries = maxEntries
+        self.maxBytes = maxBytes
+        self._lock = threading.Lock()
+        self._version = None
+        self._bodies = {}
+        self._bytes = 0
+
+    def get(self, version, key):
+        with self._lock:
+            if version != self._version:
+                return None
+            return self._bodies.get(key)
+
+    def put(self, version, key, body, size=None):
+        # size is what body costs, its length unless given
+        size = len(body) if size is None else size
+        with self._lock:
+            if self._version is None or version > self._version:
+                self._version = version
+                self._bodies = {}
+                self._bytes = 0
+            if version != self._version or key in self._bodies:
+                return
+            if len(self._bodies) < self.maxEntries and self._bytes + size <= self.maxBytes:
+                self._bodies[key] = body
+                self._bytes += size
+
+def isSquirrelId(value):
+    return isinstance(value, int) and not isinstance(value, bool)
+
+def parseETags(value):
+    # the entity tags listed in an If-Match or If-None-Match header
+    return [tag.strip() for tag in value.split(",") if tag.strip()]
+
+def parseRowETag(tag):
+    # the row version in an ETag made by rowETag, or None
+    if len(tag) > 3 and tag.startswith('"r') and tag.endswith('"'):
+        version = tag[2:-1].partition("-")[0]
+        if version.isdigit():
+            return int(version)
+    return None
+
+def qValue(params):
+    # the weight in the parameters of one Accept-Encoding item
+    for param in params.split(";"):
+        name, _, value = param.strip().partition("=")
+        if name.strip().lower() == "q":
+            try:
+                return float(value)
+            except ValueError:
+                return 0.0
+    return 1.0
+
+def makeCompressor(encoding, level):
+    # a streaming compressor with compress() and flush()
+    if encoding == "gzip":
+        return zlib.compressobj(min(level, 9), zlib.DEFLATED, 31)
+    if encoding == "deflate":
+        return zlib.compressobj(min(level, 9))
+    if encoding == "zstd":
+        return zstandard.ZstdCompressor(level=level).compressobj()
+    raise ValueError("unknown content encoding " + encoding)
+
+def compressBody(data, encoding, level):
+    compressor = makeCompressor(encoding, level)
+    return compressor.compress(data) + compressor.flush()
+
+def representationTag(prefix, version, variants):
+    # strong validators have to differ between formats and content encodings
+    suffix = "".join("-" + variant for variant in variants if variant not in ("json", "identity"))
+    return '"{}{}{}"'.format(prefix, version, suffix)
+
+def collectionETag(version, *variants):
+    return representationTag("v", version, variants)
+
+def rowETag(version, *variants):
+    return representationTag("r", version, variants)
+
+def decodeForm(body):
+    # repeated fields keep every value, in order
+    fields = parse_qs(body.decode("utf-8"), keep_blank_values=True)
+    return {key: values[0] if len(values) == 1 else values for key, values in fields.items()}
+
+def decodeMessagePack(body):
+    return msgpack.unpackb(body, raw=False)
+
+BODY_DECODERS = {
+    "application/json": json.loads,
+    FORM: decodeForm,
+}
+if msgpack is not None:
+    BODY_DECODERS["application/msgpack"] = decodeMessagePack
+    BODY_DECODERS["application/x-msgpack"] = decodeMessagePack
+
+# response formats and their content types
+MEDIA_TYPES = {"json": "application/json", "msgpack": "application/msgpack"}
+
+def encodeRow(row):
+    # Squirrel records skip json.dumps and the dict it would need
+    if isinstance(row, Squirrel):
+        return row.toJSON()
+    return json.dumps(row)
+
+def encodeData(data, bodyFormat):
+    if bodyFormat == "msgpack":
+        if isinstance(data, SquirrelRows):
+            data = list(data)
+        return msgpack.packb(data, default=Squirrel.asDict)
+    if isinstance(data, SquirrelRows):
+        # formatted straight from the rows sqlite returned
+        return bytes(data.toJSON(), "utf-8")
+    return bytes(json.dumps(data), "utf-8")
+
+def serverSentEvent(eventId, data, event=None):
+    lines = ["id: {}".format(eventId)]
+    if event is not None:
+        lines.append("event: " + event)
+    lines.append("data: " + json.dumps(data))
+    return bytes("\n".join(lines) + "\n\n", "utf-8")
+
+def chooseFormat(accept):
+    accept = (accept or "").lower()
+    if msgpack is not None and ("application/msgpack" in accept or "application/x-msgpack" in accept):
+        return "msgpack"
+    return "json"
+
+def parseChangesQuery(params, headers, changeLog):
+    # (since, wait, stream) asked for by GET /squirrels/changes; raises
+    # ValueError with the message to answer 400 with
+    since = params.get("since", headers.get("Last-Event-ID"))
+    try:
+        since = int(since) if since is not None else changeLog.lastSeq()
+        wait = float(params.get("wait", 0))
+    except ValueError:
+        raise ValueError("since must be an integer and wait a number of seconds")
+    if since < 0 or not 0 <= wait:
+        raise ValueError("since and wait must not be negative")
+    stream = params.get("stream")
+    if stream is None and "text/event-stream" in (headers.get("Accept") or ""):
+        stream = "sse"
+    if stream is not None and stream != "sse":
+        raise ValueError("stream must be sse")
+    return since, wait, stream
+
+def changesBody(changes, lastSeq, bodyFormat):
+    # a long-poll's answer to what ChangeLog.since returned
+    if changes is None:
+        return encodeData({"resync": True, "next": lastSeq}, bodyFormat)
+    return encodeData({"changes": changes, "next": lastSeq}, bodyFormat)
+
+def changesEvents(changes, lastSeq):
+    # an event stream's next piece for what ChangeLog.since returned: the
+    # events, a resync that ends the stream, or a comment to keep it open
+    if changes is None:
+        return serverSentEvent(lastSeq, {"next": lastSeq}, "resync")
+    if changes:
+        return b"".join(serverSentEvent(change["seq"], change) for change in changes)
+    return b": keep-alive\n\n"
 
 class SquirrelServerHandler(BaseHTTPRequestHandler):
 
+    protocol_version = "HTTP/1.1"
+    # headers and body go out in separate writes; with Nagle on, a
+    # keep-alive client's delayed ACK holds the body back for ~40ms
+    disable_nagle_algorithm = True
+    dbPool = SquirrelDBPool()
+    # when set, single-row writes are coalesced into shared transactions
+    groupCommitter = None
+    # when set, the full GET /squirrels body is reused until the data changes
+    indexCache = None
+    # when set, committed writes are served by GET /squirrels/changes
+    changeLog = None
+    # the longest a long-poll for changes waits, and how long an event
+    # stream stays open before its client has to reconnect
+    maxChangesWait = 30.0
+    changesStreamSeconds = 300.0
+    # an idle event stream sends a comment this often
+    changesKeepAlive = 15.0
+    # when set, request and db timings are served by GET /metrics
+    metrics = None
+    # when set, chosen requests are profiled and /debug/profile controls
+    # and serves the results
+    profiler = None
+    # when set, decides whether each request is handled or refused with
+    # 503 or 429 before any handler runs
+    admission = None
+    # one line on stderr per request; written synchronously, so it costs
+    # every request a write call
+    accessLog = True
+    # the status sent for the current request, for metrics
+    responseStatus = None
+    # offered in order of preference to clients that accept them
+    compressEncodings = ("zstd", "gzip", "deflate") if zstandard is not None else ("gzip", "deflate")
+    compressionLevel = 6
+    # smaller bodies are sent as they are; compressing them saves nothing
+    compressMinBytes = 1024
+    # seconds a keep-alive connection may sit idle between requests
+    timeout = 15
+    maxRequestsPerConnection = 100
+    # unread request bodies larger than this close the connection instead
+    # of being drained
+    maxDiscardBytes = 1 << 20
+    routes = Router()
+    # replaced by the parsed request headers for every request
+    headers = {}
+    queryParams = {}
+    requestCount = 0
+    # the server that accepted the connection, when there is one
+    server = None
+    bodyConsumed = False
+    chunked = False
+    maxPageSize = 1000
+    maxBatchItems = 100000
+    # larger request bodies are refused with 413 before being read
+    maxBodyBytes = 16 << 20
+    streamChunkBytes = 16384
+
+    def handle_one_request(self):
+        if not self.awaitRequest():
+            self.close_connection = True
+            return
+        self.requestCount += 1
+        self.bodyConsumed = False
+        super().handle_one_request()
+        if not self.close_connection and not self.bodyConsumed:
+            self.discardRequestBody()
+
+    def awaitRequest(self):
+        # waits for the next request to arrive; False when the connection
+        # closed, timed out, or was cut short because the server is stopping
+        connectionIdle = getattr(self.server, "connectionIdle", None)
+        if connectionIdle is None:
+            return True
+        if not connectionIdle(self.connection):
+            return False
+        try:
+            return bool(self.rfile.peek(1))
+        except (TimeoutError, OSError):
+            return False
+        finally:
+            self.server.connectionBusy(self.connection)
+
+    def closingAfterResponse(self):
+        return (self.requestCount >= self.maxRequestsPerConnection or getattr(self.server, "stopping", False)
+                or not getattr(self.server, "keepAlive", True))
+
     # HTTP METHODS
 
-    def do_GET(self):
-        resourceName, resourceId = self.parsePath()
-        if resourceName == "squirrels":
-            if resourceId:
-                self.handleSquirrelsRetrieve(resourceId)
-            else:
-                self.handleSquirrelsIndex()
+    def dispatch(self):
+        # a profiled request is profiled from here, so routing counts too
+        profiler = self.profiler
+        if profiler is not None and profiler.shouldProfile(self.headers.get(PROFILE_HEADER)):
+            profiler.profile(self.routeRequest)
         else:
-            self.handle404()
+            self.routeRequest()
 
-    def do_POST(self):
-        resourceName, resourceId = self.parsePath()
-        if resourceName == "squirrels":
-            if resourceId:
-                self.handle404()
-            else:
-                self.handleSquirrelsCreate()
+    do_GET = do_POST = do_PUT = do_DELETE = do_PATCH = dispatch
+
+    def routeRequest(self):
+        parts = urlsplit(self.path)
+        # parsed once here; handlers read self.queryParams
+        self.queryParams = {key: values[0] for key, values in parse_qs(parts.query).items()}
+        matched = self.routes.match(parts.path)
+        if matched is None:
+            handlerName, params = "handle404", {}
         else:
-            self.handle404()
+            handlers, params = matched
+            handlerName = handlers.get(self.command)
+            if handlerName is None:
+                handlerName, params = "handle405", {"allowed": sorted(handlers)}
+        admission = self.admission
+        if admission is None:
+            self.runHandler(handlerName, params)
+            return
+        refused = admission.admit(self.client_address[0], self.command not in READ_METHODS)
+        if refused is not None:
+            self.runHandler("handleRefused", refused)
+            return
+        try:
+            self.runHandler(handlerName, params)
+        finally:
+            admission.release()
 
-    def do_PUT(self):
-        resourceName, resourceId = self.parsePath()
-        if resourceName == "squirrels":
-            if resourceId:
-                self.handleSquirrelsUpdate(resourceId)
-            else:
-                self.handle404()
+    def runHandler(self, handlerName, params):
+        if self.metrics is None:
+            getattr(self, handlerName)(**params)
+            return
+        self.responseStatus = None
+        token = self.metrics.requestStarted(handlerName, self.command)
+        try:
+            getattr(self, handlerName)(**params)
+        finally:
+            self.metrics.requestFinished(token, self.responseStatus)
+
+    # HELPERS
+
+    def send_response(self, code, message=None):
+        self.responseStatus = code
+        super().send_response(code, message)
+
+    def log_request(self, code="-", size="-"):
+        # errors still go through log_message whatever accessLog says
+        if self.accessLog:
+            super().log_request(code, size)
+
+    def sendHeaders(self, status, contentType=None, contentLength=0, extraHeaders=()):
+        # a contentLength of None streams the body: chunked for HTTP/1.1
+        # clients, delimited by closing the connection for HTTP/1.0 ones
+        self.send_response(status)
+        if contentType:
+            self.send_header("Content-Type", contentType)
+        for name, value in extraHeaders:
+            self.send_header(name, value)
+        self.chunked = False
+        if status in (204, 304):
+            # never have a body, and must not announce one; a 304's
+            # Content-Length would describe the 200's
+            pass
+        elif contentLength is not None:
+            self.send_header("Content-Length", str(contentLength))
+        elif self.request_version == "HTTP/1.1":
+            self.chunked = True
+            self.send_header("Transfer-Encoding", "chunked")
         else:
-            self.handle404()
+            self.close_connection = True
+        if self.closingAfterResponse() or (contentLength is None and not self.chunked):
+            self.send_header("Connection", "close")
+        self.end_headers()
 
-    def do_DELETE(self):
-        resourceName, resourceId = self.parsePath()
-        if resourceName == "squirrels":
-            if resourceId:
-                self.handleSquirrelsDelete(resourceId)
-            else:
-                self.handle404()
+    def writeStream(self, pieces):
+        # coalesce small pieces so each chunk is worth a write call
+        buffered = []
+        size = 0
+        for piece in pieces:
+            buffered.append(piece)
+            size += len(piece)
+            if size >= self.streamChunkBytes:
+                self.writeChunk(b"".join(buffered))
+                buffered = []
+                size = 0
+        if buffered:
+            self.writeChunk(b"".join(buffered))
+        if self.chunked:
+            self.wfile.write(b"0\r\n\r\n")
+
+    def writeChunk(self, data):
+        if self.chunked:
+            self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
         else:
-            self.handle404()
+            self.wfile.write(data)
 
-    # HELPERS
+    def discardRequestBody(self):
+        # whatever the handler did not read would otherwise be parsed as the
+        # next pipelined request
+        try:
+            length = int(self.headers.get("Content-Length") or 0)
+        except ValueError:
+            length = -1
+        if length < 0 or length > self.maxDiscardBytes:
+            self.close_connection = True
+            return
+        while length > 0:
+            chunk = self.rfile.read(min(length, 65536))
+            if not chunk:
+                self.close_connection = True
+                return
+            length -= len(chunk)
+        self.bodyConsumed = True
+
+    def getRequestData(self, defaultType=FORM):
+        # the decoded body, chosen by Content-Type, or None after answering
+        # the error; clients that send no Content-Type get defaultType
+        contentType = (self.headers.get("Content-Type") or defaultType).partition(";")[0].strip().lower()
+        decode = BODY_DECODERS.get(contentType)
+        if decode is None:
+            self.handle415()
+            return None
+        body = self.readRequestBody()
+        if body is None:
+            return None
+        try:
+            return decode(body)
+        except (ValueError, UnicodeDecodeError):
+            self.handle400("body is not valid " + contentType)
+            return None
 
-    def getRequestData(self):
-        length = int(self.headers["Content-Length"])
-        body = self.rfile.read(length).decode("utf-8")
-        data = parse_qs(body)
-        for key in data:
-            data[key] = data[key][0]
-        return data
-
-    def parsePath(self):
-        if self.path.startswith("/"):
-            parts = self.path[1:].split("/")
-            resourceName = parts[0]
-            resourceId = None
-            if len(parts) > 1:
-                resourceId = parts[1]
-            return (resourceName, resourceId)
-        return False
+    def readRequestBody(self):
+        # the raw body in one read, or None after answering 400 or 413
+        try:
+            length = int(self.headers.get("Content-Length") or 0)
+        except ValueError:
+            length = -1
+        if length < 0:
+            self.close_connection = True
+            self.handle400("bad Content-Length")
+            return None
+        if length > self.maxBodyBytes:
+            self.handle413()
+            return None
+        body = self.rfile.read(length)
+        self.bodyConsumed = True
+        if len(body) < length:
+            self.close_connection = True
+            self.handle400("body ended early")
+            return None
+        return body
+
+    def readSquirrelFields(self):
+        # the name and size fields of the body, or None after answering
+        body = self.getRequestData()
+        if body is None:
+            return None
+        if not isinstance(body, dict) or not isinstance(body.get("name"), str) or not isinstance(body.get("size"), str):
+            self.handle400("name and size are required")
+            return None
+        return body
+
+    def chooseFormat(self):
+        return chooseFormat(self.headers.get("Accept"))
+
+    def notModified(self, etags, extraHeaders=()):
+        # answers 304 and returns True when the client already has one of
+        # etags, the tags of every current representation
+        ifNoneMatch = self.headers.get("If-None-Match")
+        if ifNoneMatch is None:
+            return False
+        tags = [tag[2:] if tag.startswith("W/") else tag for tag in parseETags(ifNoneMatch)]
+        matched = [etag for etag in etags if "*" in tags or etag in tags]
+        if not matched:
+            return False
+        self.sendHeaders(304, extraHeaders=[("ETag", matched[0])] + list(extraHeaders))
+        return True
+
+    def matchRowVersion(self, squirrelId):
+        # the row version an If-Match header allows writing over, or None
+        # when it matches nothing; If-Match compares strong tags only
+        tags = parseETags(self.headers.get("If-Match"))
+        if len(tags) == 1 and tags[0] != "*":
+            return parseRowETag(tags[0])
+        with self.dbPool.connection() as db:
+            entry = db.getSquirrelEntry(squirrelId)
+        if entry is not None and ("*" in tags or any(parseRowETag(tag) == entry[2] for tag in tags)):
+            return entry[2]
+        return None
+
+    def writeDB(self, method, *args):
+        if self.groupCommitter is not None:
+            return self.groupCommitter.call(method, *args)
+        with self.dbPool.connection() as db:
+            return getattr(db, method)(*args)
 
     # ACTIONS
 
     def handleSquirrelsIndex(self):
-        db = SquirrelDB()
-        squirrelsList = db.getSquirrels()
-        self.send_response(200)
-        self.send_header("Content-Type", "application/json")
-        self.end_headers()
-        self.wfile.write(bytes(json.dumps(squirrelsList), "utf-8"))
+        params = self.queryParams
+        try:
+            limit = int(params["limit"]) if "limit" in params else None
+            afterId = int(params["after_id"]) if "after_id" in params else None
+        except ValueError:
+            self.handle400("limit and after_id must be integers")
+            return
+        if limit is not None and not 0 < limit <= self.maxPageSize:
+            self.handle400("limit must be between 1 and {}".format(self.maxPageSize))
+            return
+        filters = {key: params[key] for key in ("name", "size") if key in params}
+        fields = None
+        if "fields" in params:
+            fields = tuple(field.strip() for field in params["fields"].split(",") if field.strip())
+            if not fields or not set(fields) <= set(SquirrelDB.columns):
+                self.handle400("fields must list some of " + ", ".join(SquirrelDB.columns))
+                return
+        stream = params.get("stream")
+        if stream is None and "application/x-ndjson" in (self.headers.get("Accept") or ""):
+            stream = "ndjson"
+        if stream is not None:
+            if stream not in ("ndjson", "json"):
+                self.handle400("stream must be ndjson or json")
+                return
+            self.handleSquirrelsStream(stream, limit, afterId, filters, fields)
+            return
+        bodyFormat = self.chooseFormat()
+        encoding = self.chooseEncoding()
+        page = (limit, afterId, tuple(sorted(filters.items())), fields, bodyFormat)
+        with self.dbPool.connection() as db:
+            # read before the rows, so a write in between can only make the
+            # tag older than the body, never newer
+            version = db.getDataVersion()
+            if self.notModified(self.collectionETags(version, bodyFormat, encoding), [VARY_ENCODING]):
+                return
+            cached = self.indexCache.get(version, page) if self.indexCache is not None else None
+            if cached is None:
+                cached = self.readIndexPage(db, limit, afterId, bodyFormat, filters, fields)
+                if self.indexCache is not None:
+                    self.indexCache.put(version, page, cached, len(cached[0]))
+        body, headers = cached
+        encoding, body = self.encodeBody(body, encoding, version, page)
+        headers = [("ETag", collectionETag(version, bodyFormat, encoding)), VARY_ENCODING] + headers
+        if encoding != "identity":
+            headers.append(("Content-Encoding", encoding))
+        self.sendHeaders(200, MEDIA_TYPES[bodyFormat], len(body), headers)
+        self.wfile.write(body)
 
-    def handleSquirrelsRetrieve(self, squirrelId):
-        db = SquirrelDB()
-        squirrel = db.getSquirrel(squirrelId)
-        if squirrel:
-            self.send_response(200)
-            self.send_header("Content-Type", "application/json")
-            self.end_headers()
-            self.wfile.write(bytes(json.dumps(squirrel), "utf-8"))
+    def readIndexPage(self, db, limit, afterId, bodyFormat="json", filters=None, fields=None):
+        # the uncompressed body of one page and its Link header, if any
+        query = dict(filters or {})
+        if fields:
+            # the last id is needed for the next page link even when the
+            # client did not ask for it
+            query["fields"] = fields if "id" in fields else ("id",) + fields
+        if limit is not None:
+            # one row past the page tells whether another page follows
+            query["limit"] = limit + 1
+        if afterId is not None:
+            query["afterId"] = afterId
+        squirrelsList = db.getSquirrelRows(**query)
+        headers = []
+        if limit is not None and len(squirrelsList) > limit:
+            squirrelsList = squirrelsList[:limit]
+            headers.append(self.nextPageLink(limit, squirrelsList[-1]["id"], carry=self.pageParams(filters, fields)))
+        if fields and "id" not in fields:
+            squirrelsList = squirrelsList.project(fields)
+        return (encodeData(squirrelsList, bodyFormat), headers)
+
+    def pageParams(self, filters, fields):
+        # the query parameters every page of a listing shares
+        params = dict(filters or {})
+        if fields:
+            params["fields"] = ",".join(fields)
+        return params
+
+    def chooseEncoding(self):
+        for encoding in self.compressEncodings:
+            if self.acceptsEncoding(encoding):
+                return encoding
+        return "identity"
+
+    def collectionETags(self, version, bodyFormat, encoding):
+        # small bodies go out uncompressed, so either tag may be current
+        return [collectionETag(version, bodyFormat), collectionETag(version, bodyFormat, encoding)]
+
+    def encodeBody(self, body, encoding, version, page):
+        # (encoding, body) as sent; compressed bodies are kept per version
+        if encoding == "identity" or len(body) < self.compressMinBytes:
+            return ("identity", body)
+        key = page + (encoding,)
+        compressed = self.indexCache.get(version, key) if self.indexCache is not None else None
+        if compressed is None:
+            compressed = compressBody(body, encoding, self.compressionLevel)
+            if self.indexCache is not None:
+                self.indexCache.put(version, key, compressed)
+        return (encoding, compressed)
+
+    def acceptsEncoding(self, encoding):
+        # an explicit entry wins over "*"; q=0 refuses the encoding
+        accepted = False
+        for item in (self.headers.get("Accept-Encoding") or "").split(","):
+            name, _, params = item.strip().partition(";")
+            name = name.strip().lower()
+            if name == encoding:
+                return qValue(params) > 0
+            if name == "*":
+                accepted = qValue(params) > 0
+        return accepted
+
+    def handleSquirrelsStream(self, stream, limit, afterId, filters=None, fields=None):
+        # rows go from the cursor to the socket as they are read, so memory
+        # use does not grow with the size of the table
+        encoding = self.chooseEncoding()
+        with self.dbPool.connection() as db:
+            version = db.getDataVersion()
+            # a json stream is byte for byte the listing's body, but an
+            # ndjson one is a different representation of the same URL
+            if self.notModified(self.collectionETags(version, stream, encoding), [VARY_ENCODING]):
+                return
+            # the size is unknown up front, so streams are always compressed
+            # when the client allows it
+            headers = [("ETag", collectionETag(version, stream, encoding)), VARY_ENCODING]
+            if encoding != "identity":
+                headers.append(("Content-Encoding", encoding))
+            if limit is not None:
+                pageEnd = db.getPageEnd(limit, afterId, **(filters or {}))
+                if pageEnd is not None:
+                    headers.append(self.nextPageLink(limit, pageEnd, stream, self.pageParams(filters, fields)))
+            rows = db.iterSquirrelRows(limit=limit, afterId=afterId, fields=fields, **(filters or {}))
+            with closing(rows):
+                self.writeSquirrelsStream(stream, rows, headers, encoding)
+
+    def writeSquirrelsStream(self, stream, rows, headers, encoding="identity"):
+        if stream == "ndjson":
+            contentType = "application/x-ndjson"
+            pieces = (bytes(encodeRow(row) + "\n", "utf-8") for row in rows)
         else:
+            contentType = "application/json"
+            pieces = self.iterJSONArray(rows)
+        if encoding != "identity":
+            pieces = self.compressStream(pieces, encoding)
+        self.sendHeaders(200, contentType, None, headers)
+        self.writeStream(pieces)
+
+    def compressStream(self, pieces, encoding):
+        compressor = makeCompressor(encoding, self.compressionLevel)
+        for piece in pieces:
+            data = compressor.compress(piece)
+            # an empty chunk would end a chunked body early
+            if data:
+                yield data
+        yield compressor.flush()
+
+    def iterJSONArray(self, rows):
+        yield b"["
+        separator = b""
+        for row in rows:
+            yield separator + bytes(encodeRow(row), "utf-8")
+            separator = b", "
+        yield b"]"
+
+    def nextPageLink(self, limit, lastId, stream=None, carry=None):
+        params = {"limit": limit, "after_id": lastId}
+        params.update(carry or {})
+        if stream is not None:
+            params["stream"] = stream
+        query = urlencode(params)
+        return ("Link", '</squirrels?{}>; rel="next"'.format(query))
+
+    def handleSquirrelsRetrieve(self, squirrelId):
+        with self.dbPool.connection() as db:
+            entry = db.getSquirrelEntry(squirrelId)
+        if entry is None:
             self.handle404()
+            return
+        squirrel, body, version = entry
+        bodyFormat = self.chooseFormat()
+        etag = rowETag(version, bodyFormat)
+        if self.notModified([etag], [("Vary", "Accept")]):
+            return
+        if bodyFormat != "json":
+            body = encodeData(squirrel, bodyFormat)
+        self.sendHeaders(200, MEDIA_TYPES[bodyFormat], len(body), [("ETag", etag), ("Vary", "Accept")])
+        self.wfile.write(body)
 
     def handleSquirrelsCreate(self):
-        db = SquirrelDB()
-        body = self.getRequestData()
-        db.createSquirrel(body["name"], body["size"])
-        self.send_response(201)
-        self.end_headers()
+        body = self.readSquirrelFields()
+        if body is None:
+            return
+        squirrel, version = self.writeDB("createSquirrelWithVersion", body["name"], body["size"])
+        self.writeSquirrel(201, squirrel, version, [("Location", "/squirrels/{}".format(squirrel["id"]))])
 
     def handleSquirrelsUpdate(self, squirrelId):
-        db = SquirrelDB()
-        squirrel = db.getSquirrel(squirrelId)
-        if squirrel:
-            body = self.getRequestData()
-            db.updateSquirrel(squirrelId, body["name"], body["size"])
-            self.send_response(204)
-            self.end_headers()
+        # the write itself reports whether the squirrel exists, so there is
+        # no read beforehand
+        expectedVersion = None
+        if self.headers.get("If-Match") is not None:
+            expectedVersion = self.matchRowVersion(squirrelId)
+            if expectedVersion is None:
+                self.handle412()
+                return
+        body = self.readSquirrelFields()
+        if body is None:
+            return
+        squirrel, version = self.writeDB("updateSquirrelWithVersion", squirrelId, body["name"], body["size"],
+                                         expectedVersion)
+        if squirrel is not None:
+            self.writeSquirrel(200, squirrel, version)
+        elif expectedVersion is not None:
+            self.handle412()
         else:
             self.handle404()
 
     def handleSquirrelsDelete(self, squirrelId):
-        db = SquirrelDB()
-        squirrel = db.getSquirrel(squirrelId)
-        if squirrel:
-            db.deleteSquirrel(squirrelId)
-            self.send_response(204)
-            self.end_headers()
+        expectedVersion = None
+        if self.headers.get("If-Match") is not None:
+            expectedVersion = self.matchRowVersion(squirrelId)
+            if expectedVersion is None:
+                self.handle412()
+                return
+        if self.writeDB("deleteSquirrel", squirrelId, expectedVersion) is not None:
+            self.sendHeaders(204)
+        elif expectedVersion is not None:
+            self.handle412()
         else:
             self.handle404()
 
+    def handleSquirrelsChanges(self):
+        if self.changeLog is None:
+            self.handle404()
+            return
+        try:
+            since, wait, stream = parseChangesQuery(self.queryParams, self.headers, self.changeLog)
+        except ValueError as e:
+            self.handle400(str(e))
+            return
+        if stream is not None:
+            self.streamChanges(since)
+            return
+        # no db connection is held while the long-poll waits
+        changes, lastSeq = self.changeLog.since(since, min(wait, self.maxChangesWait), self.maxPageSize)
+        bodyFormat = self.chooseFormat()
+        body = changesBody(changes, lastSeq, bodyFormat)
+        self.sendHeaders(200, MEDIA_TYPES[bodyFormat], len(body), [("Cache-Control", "no-store")])
+        self.wfile.write(body)
+
+    def streamChanges(self, since):
+        # server-sent events until the stream times out, the server shuts
+        # down or the client goes away; EventSource clients reconnect with
+        # Last-Event-ID and carry on where they left off
+        self.sendHeaders(200, "text/event-stream", None, [("Cache-Control", "no-store")])
+        deadline = time.monotonic() + self.changesStreamSeconds
+        try:
+            while not self.changeLog.closed:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                changes, lastSeq = self.changeLog.since(since, min(self.changesKeepAlive, remaining), self.maxPageSize)
+                self.writeChunk(changesEvents(changes, lastSeq))
+                if changes is None:
+                    break
+                since = lastSeq
+            if self.chunked:
+                self.wfile.write(b"0\r\n\r\n")
+        except ConnectionError:
+            self.close_connection = True
+
+    def handleMetrics(self):
+        if self.metrics is None:
+            self.handle404()
+            return
+        body = bytes(self.metrics.render(), "utf-8")
+        self.sendHeaders(200, "text/plain; version=0.0.4; charset=utf-8", len(body))
+        self.wfile.write(body)
+
+    def handleProfile(self):
+        if self.profiler is None:
+            self.handle404()
+            return
+        self.writeProfileSettings()
+
+    def handleProfileUpdate(self):
+        # takes any of enabled, sampleRate, mode and allowHeader; the
+        # change applies from the next request on
+        if self.profiler is None:
+            self.handle404()
+            return
+        settings = self.getRequestData(defaultType="application/json")
+        if settings is None:
+            return
+        if not isinstance(settings, dict):
+            self.handle400("body must be an object")
+            return
+        try:
+            self.profiler.configure(settings)
+        except ValueError as error:
+            self.handle400(str(error))
+            return
+        self.writeProfileSettings()
+
+    def handleProfileReset(self):
+        if self.profiler is None:
+            self.handle404()
+            return
+        self.profiler.reset()
+        self.sendHeaders(204)
+
+    def handleProfileStats(self):
+        body = self.profiler.pstatsData() if self.profiler is not None else None
+        if body is None:
+            self.handle404()
+            return
+        self.sendHeaders(200, "application/octet-stream", len(body),
+                         [("Content-Disposition", 'attachment; filename="squirrel.pstats"'), ("Cache-Control", "no-store")])
+        self.wfile.write(body)
+
+    def handleProfileStacks(self):
+        if self.profiler is None:
+            self.handle404()
+            return
+        body = bytes(self.profiler.collapsedStacks(), "utf-8")
+        self.sendHeaders(200, "text/plain; charset=utf-8", len(body), [("Cache-Control", "no-store")])
+        self.wfile.write(body)
+
+    def writeProfileSettings(self):
+        body = bytes(json.dumps(self.profiler.settings()), "utf-8")
+        self.sendHeaders(200, "application/json", len(body), [("Cache-Control", "no-store")])
+        self.wfile.write(body)
+
+    def writeSquirrel(self, status, squirrel, version=None, extraHeaders=()):
+        # with the row version the write stamped, the response carries the
+        # ETag a following If-Match write needs
+        bodyFormat = self.chooseFormat()
+        body = encodeData(squirrel, bodyFormat)
+        headers = [("Vary", "Accept")]
+        if version is not None:
+            headers.append(("ETag", rowETag(version, bodyFormat)))
+        self.sendHeaders(status, MEDIA_TYPES[bodyFormat], len(body), headers + list(extraHeaders))
+        self.wfile.write(body)
+
+    def readBatch(self):
+        # the decoded array, or None after answering the error
+        items = self.getRequestData(defaultType="application/json")
+        if items is None:
+            return None
+        if not isinstance(items, list):
+            self.handle400("body must be an array")
+            return None
+        if len(items) > self.maxBatchItems:
+            self.handle400("at most {} items per batch".format(self.maxBatchItems))
+            return None
+        return items
+
+    def writeBatchResults(self, results):
+        bodyFormat = self.chooseFormat()
+        body = encodeData(results, bodyFormat)
+        self.sendHeaders(200, MEDIA_TYPES[bodyFormat], len(body), [("Vary", "Accept")])
+        self.wfile.write(body)
+
+    def handleSquirrelsBatchCreate(self):
+        items = self.readBatch()
+        if items is None:
+            return
+        results = [None] * len(items)
+        valid = []
+        for index, item in enumerate(items):
+            if isinstance(item, dict) and isinstance(item.get("name"), str) and isinstance(item.get("size"), str):
+                valid.append(index)
+            else:
+                results[index] = {"status": 400, "error": "name and size are required"}
+        # no write transaction is opened for a batch with nothing to write
+        ids = []
+        if valid:
+            with self.dbPool.connection() as db:
+                ids = db.createSquirrels([(items[index]["name"], items[index]["size"]) for index in valid])
+        for index, squirrelId in zip(valid, ids):
+            results[index] = {"status": 201, "id": squirrelId}
+        self.writeBatchResults(results)
+
+    def handleSquirrelsBatchUpdate(self):
+        items = self.readBatch()
+        if items is None:
+            return
+        results = [None] * len(items)
+        valid = []
+        for index, item in enumerate(items):
+            if (isinstance(item, dict) and isSquirrelId(item.get("id"))
+                    and isinstance(item.get("name"), str) and isinstance(item.get("size"), str)):
+                valid.append(index)
+            else:
+                results[index] = {"status": 400, "error": "id, name and size are required"}
+        found = []
+        if valid:
+            with self.dbPool.connection() as db:
+                found = db.updateSquirrels([(items[index]["id"], items[index]["name"], items[index]["size"])
+                                            for index in valid])
+        for index, exists in zip(valid, found):
+            results[index] = {"status": 204 if exists else 404, "id": items[index]["id"]}
+        self.writeBatchResults(results)
+
+    def handleSquirrelsBatchDelete(self):
+        items = self.readBatch()
+        if items is None:
+            return
+        results = [None] * len(items)
+        valid = []
+        for index, item in enumerate(items):
+            squirrelId = item.get("id") if isinstance(item, dict) else item
+            if isSquirrelId(squirrelId):
+                valid.append((index, squirrelId))
+            else:
+                results[index] = {"status": 400, "error": "id is required"}
+        found = []
+        if valid:
+            with self.dbPool.connection() as db:
+                found = db.deleteSquirrels([squirrelId for index, squirrelId in valid])
+        for (index, squirrelId), exists in zip(valid, found):
+            results[index] = {"status": 204 if exists else 404, "id": squirrelId}
+        self.writeBatchResults(results)
+
+    def handle400(self, message="Bad Request"):
+        body = bytes("400 Bad Request: " + message, "utf-8")
+        self.sendHeaders(400, "text/plain", len(body))
+        self.wfile.write(body)
+
     def handle404(self):
-        self.send_response(404)
-        self.send_header("Content-Type", "text/plain")
-        self.end_headers()
-        self.wfile.write(bytes("404 Not Found", "utf-8"))
+        body = bytes("404 Not Found", "utf-8")
+        self.sendHeaders(404, "text/plain", len(body))
+        self.wfile.write(body)
 
-def run():
-    print("squirrel_server running at 127.0.0.1:8080")
-    listen = ("127.0.0.1", 8080)
-    server = HTTPServer(listen, SquirrelServerHandler)
-    server.serve_forever()
+    def handle405(self, allowed):
+        body = bytes("405 Method Not Allowed", "utf-8")
+        self.sendHeaders(405, "text/plain", len(body), [("Allow", ", ".join(allowed))])
+        self.wfile.write(body)
+
+    def handle413(self):
+        body = bytes("413 Payload Too Large: at most {} bytes".format(self.maxBodyBytes), "utf-8")
+        self.sendHeaders(413, "text/plain", len(body))
+        self.wfile.write(body)
+
+    def handle415(self):
+        body = bytes("415 Unsupported Media Type: send " + ", ".join(sorted(BODY_DECODERS)), "utf-8")
+        self.sendHeaders(415, "text/plain", len(body))
+        self.wfile.write(body)
+
+    def handleRefused(self, status, retryAfter):
+        extraHeaders = [("Retry-After", str(retryAfter))]
+        if status == 503:
+            # hang up as well, so the worker thread this connection holds
+            # can take one that is waiting
+            self.discardRequestBody()
+            self.close_connection = True
+            if not self.closingAfterResponse():
+                extraHeaders.append(("Connection", "close"))
+        body = bytes("{} {}".format(status, self.responses[status][0]), "utf-8")
+        self.sendHeaders(status, "text/plain", len(body), extraHeaders)
+        self.wfile.write(body)
+
+    def handle412(self):
+        body = bytes("412 Precondition Failed", "utf-8")
+        self.sendHeaders(412, "text/plain", len(body))
+        self.wfile.write(body)
+
+# other resources register their handlers the same way
+SquirrelServerHandler.routes.add("GET", "/squirrels", "handleSquirrelsIndex")
+SquirrelServerHandler.routes.add("POST", "/squirrels", "handleSquirrelsCreate")
+SquirrelServerHandler.routes.add("GET", "/squirrels/changes", "handleSquirrelsChanges")
+SquirrelServerHandler.routes.add("GET", "/squirrels/{squirrelId}", "handleSquirrelsRetrieve")
+SquirrelServerHandler.routes.add("PUT", "/squirrels/{squirrelId}", "handleSquirrelsUpdate")
+SquirrelServerHandler.routes.add("DELETE", "/squirrels/{squirrelId}", "handleSquirrelsDelete")
+SquirrelServerHandler.routes.add("POST", "/squirrels:batch", "handleSquirrelsBatchCreate")
+SquirrelServerHandler.routes.add("PUT", "/squirrels:batch", "handleSquirrelsBatchUpdate")
+SquirrelServerHandler.routes.add("DELETE", "/squirrels:batch", "handleSquirrelsBatchDelete")
+SquirrelServerHandler.routes.add("GET", "/metrics", "handleMetrics")
+SquirrelServerHandler.routes.add("GET", "/debug/profile", "handleProfile")
+SquirrelServerHandler.routes.add("PUT", "/debug/profile", "handleProfileUpdate")
+SquirrelServerHandler.routes.add("DELETE", "/debug/profile", "handleProfileReset")
+SquirrelServerHandler.routes.add("GET", "/debug/profile/pstats", "handleProfileStats")
+SquirrelServerHandler.routes.add("GET", "/debug/profile/stacks", "handleProfileStacks")
+
+class SingleHTTPServer(HTTPServer):
+
+    # One connection at a time, like the original server. A connection
+    # left open between requests would keep every other client waiting,
+    # so each one is closed after its response.
+    keepAlive = False
+
+class ThreadPoolHTTPServer(HTTPServer):
+
+    # Connections wait in the executor's queue until a worker thread is
+    # free. With maxQueued, at most that many wait; the ones after them get
+    # a 503 straight from the accepting thread. The listen backlog stays
+    # deep so that a burst reaches the accepting thread to be refused,
+    # rather than having its SYNs dropped and retried a second later.
+    # A keep-alive connection holds its worker while it waits for its next
+    # request, so whenever connections are queued with no worker free for
+    # them, idle ones are hung up to make room.
+    request_queue_size = 1024
+
+    def __init__(self, serverAddress, handlerClass, workers=8, reusePort=False, maxQueued=0, retryAfter=1):
+        self.workers = workers
+        self.reusePort = reusePort
+        self.maxQueued = maxQueued
+        self.retryAfter = retryAfter
+        self.queued = 0
+        # connections workers are handling, idle ones included
+        self.active = 0
+        self.stopping = False
+        # connections whose handlers are waiting for their next request
+        self._idle = set()
+        # connections being hung up to make room, whose workers are about
+        # to be free
+        self._hangingUp = set()
+        self._queueLock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="squirrel-worker")
+        super().__init__(serverAddress, handlerClass)
+
+    def server_bind(self):
+        if self.reusePort:
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        super().server_bind()
+
+    def process_request(self, request, client_address):
+        with self._queueLock:
+            full = self.maxQueued and self.queued >= self.maxQueued
+            if not full:
+                self.queued += 1
+                idle = [self._idle.pop() for i in range(min(self._waiting(), len(self._idle)))]
+                self._hangingUp.update(idle)
+        if full:
+            self.refuseRequest(request)
+            return
+        self.executor.submit(self.processRequestWorker, request, client_address)
+        for connection in idle:
+            self.hangUp(connection)
+
+    def refuseRequest(self, request):
+        # whatever the client already sent is read first; closing a socket
+        # with unread data resets it, which can lose the response
+        received = b""
+        try:
+            request.setblocking(False)
+            try:
+                received = request.recv(65536)
+            except BlockingIOError:
+                pass
+            request.setblocking(True)
+            request.sendall(refusal(503, self.retryAfter, close=True))
+        except OSError:
+            pass
+        self.shutdown_request(request)
+        metrics = self.RequestHandlerClass.metrics
+        if metrics is not None:
+            # counted with the refusals handlers make, under the method of
+            # the request line when one arrived and is one the server knows
+            method = received.split(b" ", 1)[0].decode("ascii", "replace")
+            if not hasattr(self.RequestHandlerClass, "do_" + method):
+                method = "-"
+            metrics.requestFinished(metrics.requestStarted("handleRefused", method), 503)
+
+    def processRequestWorker(self, request, client_address):
+        with self._queueLock:
+            self.queued -= 1
+            self.active += 1
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            with self._queueLock:
+                self.active -= 1
+                self._hangingUp.discard(request)
+            self.shutdown_request(request)
+
+    def _waiting(self):
+        # queued connections no free worker will pick up; called with
+        # _queueLock held
+        return self.queued - (self.workers - self.active + len(self._hangingUp))
+
+    def connectionIdle(self, connection):
+        # False once the server is stopping or connections are waiting for
+        # a worker, so the handler hangs up instead of waiting for another
+        # request
+        with self._queueLock:
+            if self.stopping:
+                return False
+            if self._waiting() > 0:
+                self._hangingUp.add(connection)
+                return False
+            self._idle.add(connection)
+            return True
+
+    def connectionBusy(self, connection):
+        with self._queueLock:
+            self._idle.discard(connection)
+
+    def server_close(self):
+        super().server_close()
+        # idle keep-alive connections are woken up and hang up; requests
+        # that were already accepted run to completion, and their
+        # connections close after the response
+        with self._queueLock:
+            self.stopping = True
+            idle = list(self._idle)
+        for connection in idle:
+            self.hangUp(connection)
+        self.executor.shutdown(wait=True)
+
+    def hangUp(self, connection):
+        # wakes the handler waiting on an idle connection, which sees the
+        # end of the stream and closes it
+        try:
+            connection.shutdown(socket.SHUT_RD)
+        except OSError:
+            pass
+
+def parseArgs(argv=None, environ=None):
+    environ = os.environ if environ is None else environ
+    parser = argparse.ArgumentParser(description="Run the squirrel server.")
+    parser.add_argument("--host", default=environ.get("SQUIRREL_HOST", "127.0.0.1"))
+    parser.add_argument("--port", type=int, default=int(environ.get("SQUIRREL_PORT", 8080)))
+    parser.add_argument("--engine", choices=["threads", "asyncio"],
+                        default=environ.get("SQUIRREL_ENGINE", "threads"))
+    parser.add_argument("--mode", choices=["single", "threaded", "prefork"],
+                        default=environ.get("SQUIRREL_MODE", "threaded"))
+    parser.add_argument("--workers", type=int, default=int(environ.get("SQUIRREL_WORKERS", 8)),
+                        help="request threads per process")
+    parser.add_argument("--processes", type=int,
+                        default=int(environ.get("SQUIRREL_PROCESSES", os.cpu_count() or 1)),
+                        help="worker processes in prefork mode")
+    parser.add_argument("--db", default=environ.get("SQUIRREL_DB", DB_FILENAME))
+    parser.add_argument("--idle-timeout", type=float,
+                        default=float(environ.get("SQUIRREL_IDLE_TIMEOUT", SquirrelServerHandler.timeout)),
+                        help="seconds a keep-alive connection may stay idle")
+    parser.add_argument("--max-requests", type=int,
+                        default=int(environ.get("SQUIRREL_MAX_REQUESTS",
+                                                SquirrelServerHandler.maxRequestsPerConnection)),
+                        help="requests served on one connection before it is closed")
+    parser.add_argument("--group-commit", action="store_true",
+                        default=environ.get("SQUIRREL_GROUP_COMMIT", "") not in ("", "0"),
+                        help="coalesce concurrent writes into shared transactions")
+    parser.add_argument("--group-commit-window", type=float,
+                        default=float(environ.get("SQUIRREL_GROUP_COMMIT_WINDOW", 2.0)),
+                        help="milliseconds a group commit waits for more writes")
+    parser.add_argument("--group-commit-max", type=int,
+                        default=int(environ.get("SQUIRREL_GROUP_COMMIT_MAX", 256)),
+                        help="most writes folded into one group commit")
+    parser.add_argument("--cache-size", type=int, default=int(environ.get("SQUIRREL_CACHE_SIZE", 10000)),
+                        help="squirrels kept in the read cache (0 disables it)")
+    parser.add_argument("--cache-ttl", type=float, default=float(environ.get("SQUIRREL_CACHE_TTL", 60.0)),
+                        help="seconds a cached squirrel stays valid")
+    parser.add_argument("--index-cache", action=argparse.BooleanOptionalAction,
+                        default=environ.get("SQUIRREL_INDEX_CACHE", "1") not in ("", "0"),
+                        help="reuse the encoded GET /squirrels body until the data changes")
+    parser.add_argument("--index-cache-bytes", type=int,
+                        default=int(environ.get("SQUIRREL_INDEX_CACHE_BYTES", 64 << 20)),
+                        help="most bytes of list bodies the index cache keeps")
+    parser.add_argument("--compression-level", type=int,
+                        default=int(environ.get("SQUIRREL_COMPRESSION_LEVEL", SquirrelServerHandler.compressionLevel)),
+                        help="gzip/deflate level (capped at 9) or zstd level")
+    parser.add_argument("--compress-min-bytes", type=int,
+                        default=int(environ.get("SQUIRREL_COMPRESS_MIN_BYTES", SquirrelServerHandler.compressMinBytes)),
+                        help="smallest list body sent compressed")
+    parser.add_argument("--max-body-bytes", type=int,
+                        default=int(environ.get("SQUIRREL_MAX_BODY_BYTES", SquirrelServerHandler.maxBodyBytes)),
+                        help="largest request body accepted")
+    parser.add_argument("--change-log-size", type=int,
+                        default=int(environ.get("SQUIRREL_CHANGE_LOG_SIZE", 10000)),
+                        help="changes kept for GET /squirrels/changes (0 disables it)")
+    parser.add_argument("--max-changes-wait", type=float,
+                        default=float(environ.get("SQUIRREL_MAX_CHANGES_WAIT", SquirrelServerHandler.maxChangesWait)),
+                        help="longest a long-poll for changes may wait, in seconds")
+    parser.add_argument("--metrics", action=argparse.BooleanOptionalAction,
+                        default=environ.get("SQUIRREL_METRICS", "1") not in ("", "0"),
+                        help="collect request and db timings for GET /metrics")
+    parser.add_argument("--access-log", action=argparse.BooleanOptionalAction,
+                        default=environ.get("SQUIRREL_ACCESS_LOG", "1") not in ("", "0"),
+                        help="log every request to stderr")
+    parser.add_argument("--profiling", action=argparse.BooleanOptionalAction,
+                        default=environ.get("SQUIRREL_PROFILING", "") not in ("", "0"),
+                        help="profile requests on demand and serve /debug/profile")
+    parser.add_argument("--profile-sample-rate", type=float,
+                        default=float(environ.get("SQUIRREL_PROFILE_SAMPLE_RATE", 0.0)),
+                        help="share of all requests profiled, from 0 to 1")
+    parser.add_argument("--profile-mode", choices=PROFILE_MODES,
+                        default=environ.get("SQUIRREL_PROFILE_MODE", "cprofile"),
+                        help="cprofile for pstats data, stacks for collapsed wall-clock stacks")
+    parser.add_argument("--max-in-flight", type=int, default=int(environ.get("SQUIRREL_MAX_IN_FLIGHT", 0)),
+                        help="requests handled at once per process before the rest get 503 (0 for no limit)")
+    parser.add_argument("--read-reserve", type=int, default=int(environ.get("SQUIRREL_READ_RESERVE", 0)),
+                        help="of --max-in-flight, slots only reads may take")
+    parser.add_argument("--accept-queue", type=int, default=int(environ.get("SQUIRREL_ACCEPT_QUEUE", 128)),
+                        help="connections waiting for a worker thread before new ones get 503 (0 for no limit)")
+    parser.add_argument("--rate-limit", type=float, default=float(environ.get("SQUIRREL_RATE_LIMIT", 0.0)),
+                        help="requests per second per client address before 429 (0 for no limit)")
+    parser.add_argument("--rate-burst", type=float, default=float(environ.get("SQUIRREL_RATE_BURST", 0.0)),
+                        help="requests a client may send at once (0 for one second's worth)")
+    return parser.parse_args(argv)
+
+def openDB(config, poolSize, otherWriters=False):
+    # every server process opens its own connections; sqlite connections
+    # must never be shared across a fork. otherWriters says whether other
+    # processes write the same database
+    cache = SquirrelCache(config.cache_size, config.cache_ttl, otherWriters) if config.cache_size > 0 else None
+    changeLog = ChangeLog(config.change_log_size) if config.change_log_size > 0 else None
+    metrics = Metrics() if config.metrics else None
+    SquirrelServerHandler.dbPool = SquirrelDBPool(size=max(poolSize, 1), filename=config.db, cache=cache,
+                                                  changeLog=changeLog, metrics=metrics)
+    SquirrelServerHandler.indexCache = ResponseCache(maxBytes=config.index_cache_bytes) if config.index_cache else None
+    SquirrelServerHandler.changeLog = changeLog
+    SquirrelServerHandler.metrics = metrics
+    SquirrelServerHandler.groupCommitter = None
+    if config.group_commit:
+        SquirrelServerHandler.groupCommitter = GroupCommitter(config.db, window=config.group_commit_window / 1000.0,
+                                                              maxBatch=config.group_commit_max, cache=cache,
+                                                              changeLog=changeLog, metrics=metrics)
+
+def releaseWaiters():
+    # long-polls and event streams would otherwise hold on to the request
+    # threads a shutdown waits for
+    if SquirrelServerHandler.changeLog is not None:
+        SquirrelServerHandler.changeLog.close()
+
+def closeDB():
+    if SquirrelServerHandler.groupCommitter is not None:
+        SquirrelServerHandler.groupCommitter.close()
+    SquirrelServerHandler.dbPool.close()
+
+def configureHandler(config):
+    SquirrelServerHandler.timeout = config.idle_timeout
+    SquirrelServerHandler.maxRequestsPerConnection = config.max_requests
+    SquirrelServerHandler.compressionLevel = config.compression_level
+    SquirrelServerHandler.compressMinBytes = config.compress_min_bytes
+    SquirrelServerHandler.maxBodyBytes = config.max_body_bytes
+    SquirrelServerHandler.maxChangesWait = config.max_changes_wait
+    SquirrelServerHandler.accessLog = config.access_log
+    SquirrelServerHandler.profiler = None
+    if config.profiling:
+        SquirrelServerHandler.profiler = RequestProfiler(config.profile_sample_rate, config.profile_mode)
+    SquirrelServerHandler.admission = None
+
+def makeAdmission(config):
+    if not config.max_in_flight and not config.rate_limit:
+        return None
+    return AdmissionController(config.max_in_flight, config.read_reserve, config.rate_limit, config.rate_burst)
+
+def makeServer(config, reusePort=False, otherWriters=False):
+    openDB(config, config.workers, otherWriters)
+    configureHandler(config)
+    SquirrelServerHandler.admission = makeAdmission(config)
+    listen = (config.host, config.port)
+    if config.mode == "single":
+        return SingleHTTPServer(listen, SquirrelServerHandler)
+    return ThreadPoolHTTPServer(listen, SquirrelServerHandler, workers=config.workers, reusePort=reusePort,
+                                maxQueued=config.accept_queue)
+
+def serve(server):
+    def stop(signum, frame):
+        # shutdown() waits for serve_forever() to return, so it cannot run on
+        # the thread that is inside serve_forever()
+        threading.Thread(target=server.shutdown).start()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    try:
+        server.serve_forever()
+    finally:
+        releaseWaiters()
+        server.server_close()
+        closeDB()
+
+def runPrefork(config):
+    children = []
+    for i in range(config.processes):
+        pid = os.fork()
+        if pid == 0:
+            status = 0
+            try:
+                serve(makeServer(config, reusePort=True, otherWriters=True))
+            except BaseException:
+                traceback.print_exc()
+                status = 1
+            finally:
+                os._exit(status)
+        children.append(pid)
+
+    def forward(signum, frame):
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGTERM, forward)
+    signal.signal(signal.SIGINT, forward)
+    for pid in children:
+        os.waitpid(pid, 0)
+
+def run(argv=None):
+    config = parseArgs(argv)
+    if config.engine == "asyncio":
+        from squirrel_async_server import runAsync
+        print("squirrel_server running at {}:{} (asyncio engine)".format(config.host, config.port))
+        runAsync(config)
+        return
+    print("squirrel_server running at {}:{} ({} mode)".format(config.host, config.port, config.mode))
+    if config.mode == "prefork":
+        runPrefork(config)
+    else:
+        serve(makeServer(config))
 
 if __name__ == '__main__':
     run()
-
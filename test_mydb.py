@@ -1,4 +1,9 @@
-from mydb import MyDB
+import multiprocessing
+import os
+import pickle
+import shutil
+import pytest
+from mydb import MAGIC, SEARCH_HEADER, MyDB, encodeRecord
 
 def describe_init():
 
@@ -7,7 +12,9 @@ def describe_init():
             db = MyDB("mydatabase.db")
             assert db.fname == "mydatabase.db"
     
-    def it_calls_saveStrings_if_file_missing(mocker):
+    def it_calls_saveStrings_if_file_missing(mocker, monkeypatch, tmp_path):
+        # the creation happens under the writers' lock, <filename>.lock
+        monkeypatch.chdir(tmp_path)
         mock_isfile = mocker.patch("os.path.isfile", return_value=False)
         my_mock = mocker.patch.object(MyDB, "saveStrings")
 
@@ -54,91 +61,345 @@ def describe_load_strings_method():
         mock_pickle.assert_called_once()
 
 def describe_save_strings_method():
-    
-    def it_saves_data_with_small_array(mocker):
-        mock_open = mocker.patch("builtins.open", mocker.mock_open())
-
-        db = MyDB("dummyfile")
 
-        mock_pickle = mocker.patch("pickle.dump")
+    def it_saves_data_with_small_array(tmp_path):
+        db = MyDB(str(tmp_path / "strings.db"))
 
         db.saveStrings(["first", "second"])
-        
-        mock_open.assert_called_once_with("dummyfile", "wb")
-        mock_open.assert_called_once()
-        args, kwargs = mock_pickle.call_args
-        assert args[0] == ["first", "second"]
 
-    def it_saves_data_with_large_array(mocker):
-        mock_open = mocker.patch("builtins.open", mocker.mock_open())
+        assert db.loadStrings() == ["first", "second"]
 
-        db = MyDB("dummyfile")
-
-        mock_pickle = mocker.patch("pickle.dump")
+    def it_saves_data_with_large_array(tmp_path):
+        db = MyDB(str(tmp_path / "strings.db"))
 
         db.saveStrings(["Chicken", "nuggets", "are", "amazing", "and", "I", "love", "to", "eat", "them", "especially", "dino", "nuggs", "because", "they", "are", "the", "bomb"])
-        
-        mock_open.assert_called_once_with("dummyfile", "wb")
-        mock_open.assert_called_once
-        args, kwargs = mock_pickle.call_args
-        assert args[0] == ["Chicken", "nuggets", "are", "amazing", "and", "I", "love", "to", "eat", "them", "especially", "dino", "nuggs", "because", "they", "are", "the", "bomb"]
 
-def describe_save_string_method():
+        assert db.loadStrings() == ["Chicken", "nuggets", "are", "amazing", "and", "I", "love", "to", "eat", "them", "especially", "dino", "nuggs", "because", "they", "are", "the", "bomb"]
 
-    def it_calls_loadStrings_correctly(mocker):
-        db = MyDB("dummyfile")
+    def it_replaces_the_file_through_a_temporary_one(mocker, tmp_path):
+        db = MyDB(str(tmp_path / "strings.db"))
+        mock_replace = mocker.patch("os.replace")
 
-        mock_load = mocker.patch.object(db, "loadStrings", return_value=[])
+        db.saveStrings(["first"])
 
-        mocker.patch.object(db, "saveStrings")
+        mock_replace.assert_any_call(db.fname + ".tmp", db.fname)
+
+def describe_save_string_method():
+
+    def it_appends_without_loading_or_rewriting_the_store(mocker, tmp_path):
+        db = MyDB(str(tmp_path / "strings.db"))
+        mock_load = mocker.patch.object(db, "loadStrings")
+        mock_save = mocker.patch.object(db, "saveStrings")
 
         db.saveString("Nugget")
 
-        mock_load.assert_called_once()
+        mock_load.assert_not_called()
+        mock_save.assert_not_called()
 
-    def it_calls_saveStrings_correctly(mocker):
-        db = MyDB("dummyfile")
+    def it_appends_object_after_existing_strings(tmp_path):
+        db = MyDB(str(tmp_path / "strings.db"))
+        db.saveStrings(["Chicken", "Nuggets"])
 
-        mocker.patch.object(db, "loadStrings", return_value=[])
+        db.saveString("Yum")
+        db.saveString("Ünïcode")
 
-        mock_save = mocker.patch.object(db, "saveStrings")
+        assert MyDB(db.fname).loadStrings() == ["Chicken", "Nuggets", "Yum", "Ünïcode"]
 
-        db.saveString("Nugget")
+    def it_migrates_a_pickle_file_on_the_first_append(tmp_path):
+        fname = str(tmp_path / "old.db")
+        with open(fname, "wb") as f:
+            pickle.dump(["Chicken", "Nuggets"], f)
+        db = MyDB(fname)
 
-        mock_save.assert_called_once()
+        assert db.loadStrings() == ["Chicken", "Nuggets"]
 
-    def it_calls_both_loadStrings_and_saveStrings_correctly(mocker):
-        db = MyDB("dummyfile")
+        db.saveString("Yum")
 
-        mock_load = mocker.patch.object(db, "loadStrings", return_value=[])
+        with open(fname, "rb") as f:
+            assert f.read(len(MAGIC)) == MAGIC
+        assert db.loadStrings() == ["Chicken", "Nuggets", "Yum"]
 
-        mock_save = mocker.patch.object(db, "saveStrings")
+    def it_ignores_a_torn_tail_record_and_cuts_it_off_before_appending(tmp_path):
+        db = MyDB(str(tmp_path / "strings.db"))
+        db.saveStrings(["Chicken", "Nuggets"])
+        with open(db.fname, "ab") as f:
+            f.write(encodeRecord("Half written")[:-3])
 
-        db.saveString("Nugget")
+        assert MyDB(db.fname).loadStrings() == ["Chicken", "Nuggets"]
 
-        mock_load.assert_called_once()
-        mock_load.assert_called_once()
+        reopened = MyDB(db.fname)
+        reopened.saveString("Yum")
 
-    def it_appends_object_before_calling_saveStrings_correctly_single_item_array(mocker):
-        db = MyDB("dummyfile")
+        assert reopened.loadStrings() == ["Chicken", "Nuggets", "Yum"]
 
-        mocker.patch.object(db, "loadStrings", return_value=["Chicken"])
+    def it_stops_at_a_record_that_fails_its_checksum(tmp_path):
+        db = MyDB(str(tmp_path / "strings.db"))
+        db.saveStrings(["Chicken", "Nuggets"])
+        with open(db.fname, "r+b") as f:
+            f.seek(-1, 2)
+            f.write(b"X")
 
-        mock_save = mocker.patch.object(db, "saveStrings")
+        assert db.loadStrings() == ["Chicken"]
 
-        db.saveString("Nugget")
+    def it_refuses_to_cut_off_whole_records_after_a_corrupt_one(tmp_path):
+        db = MyDB(str(tmp_path / "strings.db"))
+        db.saveStrings(["Chicken", "Nuggets", "Are", "Good"])
+        with open(db.fname, "r+b") as f:
+            f.seek(len(MAGIC) + len(encodeRecord("Chicken")) + 10)
+            f.write(b"X")
+        os.remove(db.indexName)
+        with open(db.fname, "rb") as f:
+            damaged = f.read()
 
-        mock_save.assert_called_once_with(["Chicken", "Nugget"])
+        with pytest.raises(ValueError):
+            MyDB(db.fname).saveString("Yum")
+        with pytest.raises(ValueError):
+            db.loadStrings()
 
-    def it_appends_object_before_calling_saveStrings_correctly_populated_array(mocker):
-        db = MyDB("dummyfile")
+        with open(db.fname, "rb") as f:
+            assert f.read() == damaged
 
-        mocker.patch.object(db, "loadStrings", return_value=["Chicken", "Nuggets", "Are", "Really", "Good"])
+def describe_compact_method():
 
-        mock_save = mocker.patch.object(db, "saveStrings")
+    def it_rewrites_the_store_from_its_strings(tmp_path):
+        fname = str(tmp_path / "old.db")
+        with open(fname, "wb") as f:
+            pickle.dump(["Chicken"], f)
+        db = MyDB(fname)
+
+        db.compact()
+
+        with open(fname, "rb") as f:
+            assert f.read() == MAGIC + encodeRecord("Chicken")
+
+def describe_indexed_reads():
+
+    @pytest.fixture
+    def db(tmp_path):
+        db = MyDB(str(tmp_path / "strings.db"))
+        db.saveStrings(["Chicken", "Nuggets", "Are", "Good"])
+        return db
+
+    def it_reads_single_strings_and_the_length(db):
+        assert len(db) == 4
+        assert (db.getString(0), db.getString(3), db[-1]) == ("Chicken", "Good", "Good")
+
+    def it_slices_like_a_list(db):
+        assert db[1:3] == ["Nuggets", "Are"]
+        assert db[::-2] == ["Good", "Nuggets"]
+
+    def it_raises_index_error_past_the_end(db):
+        with pytest.raises(IndexError):
+            db.getString(4)
+
+    def it_sees_strings_appended_after_it_was_mapped(db):
+        assert len(db) == 4
 
         db.saveString("Yum")
 
-        mock_save.assert_called_once_with(["Chicken", "Nuggets", "Are", "Really", "Good", "Yum"])
+        assert (len(db), db[4]) == (5, "Yum")
 
-        
+    def it_sees_a_rewrite_of_the_store(db):
+        assert db[0] == "Chicken"
+
+        db.saveStrings(["Dino"])
+
+        assert db[:] == ["Dino"]
+
+    def it_reads_without_an_index(db):
+        os.remove(db.indexName)
+
+        assert MyDB(db.fname)[:] == ["Chicken", "Nuggets", "Are", "Good"]
+
+    def it_reads_records_appended_without_their_offsets(db):
+        # a crash between appending a record and its offset
+        with open(db.fname, "ab") as f:
+            f.write(encodeRecord("Yum"))
+
+        assert MyDB(db.fname)[3:] == ["Good", "Yum"]
+
+    def it_ignores_an_index_left_from_another_log(db, tmp_path):
+        other = MyDB(str(tmp_path / "other.db"))
+        other.saveStrings(["Dino", "Nuggs"])
+        shutil.copyfile(other.indexName, db.indexName)
+
+        assert MyDB(db.fname)[:] == ["Chicken", "Nuggets", "Are", "Good"]
+
+    def it_checks_the_checksum_of_every_string_it_reads(db):
+        with open(db.fname, "r+b") as f:
+            f.seek(len(MAGIC) + len(encodeRecord("Chicken")) + 10)
+            f.write(b"X")
+
+        assert db[0] == "Chicken"
+        with pytest.raises(ValueError):
+            db[:]
+        with pytest.raises(ValueError):
+            db.loadStrings()
+
+    def it_reads_a_pickle_file_by_index_without_converting_it(tmp_path):
+        fname = str(tmp_path / "old.db")
+        with open(fname, "wb") as f:
+            pickle.dump(["Chicken", "Nuggets"], f)
+
+        assert MyDB(fname)[1] == "Nuggets"
+        with open(fname, "rb") as f:
+            assert pickle.load(f) == ["Chicken", "Nuggets"]
+
+    def it_reads_without_locking_or_writing(mocker, db):
+        # a record a crash kept out of the index, and a torn one after it
+        with open(db.fname, "ab") as f:
+            f.write(encodeRecord("Yum") + encodeRecord("Half written")[:-3])
+        os.remove(db.indexName)
+        with open(db.fname, "rb") as f:
+            log = f.read()
+        mock_flock = mocker.patch("mydb.fcntl.flock")
+        mock_open = mocker.patch("mydb.open", wraps=open, create=True)
+
+        reader = MyDB(db.fname, searchIndex=True)
+
+        assert reader[:] == ["Chicken", "Nuggets", "Are", "Good", "Yum"]
+        assert reader.findPrefix("") == ["Are", "Chicken", "Good", "Nuggets", "Yum"]
+        mock_flock.assert_not_called()
+        assert {c.args[1] for c in mock_open.call_args_list} == {"rb"}
+        assert not os.path.exists(db.indexName) and not os.path.exists(db.searchName)
+        with open(db.fname, "rb") as f:
+            assert f.read() == log
+
+def describe_iter_strings_method():
+
+    def it_yields_the_strings_in_order(tmp_path):
+        db = MyDB(str(tmp_path / "strings.db"))
+        db.saveStrings(["Chicken", "Nuggets"])
+        db.saveString("Yum")
+
+        strings = db.iterStrings()
+
+        assert next(strings) == "Chicken"
+        assert list(strings) == ["Nuggets", "Yum"]
+
+    def it_reads_a_pickle_file_too(tmp_path):
+        fname = str(tmp_path / "old.db")
+        with open(fname, "wb") as f:
+            pickle.dump(["Chicken", "Nuggets"], f)
+
+        assert list(MyDB(fname).iterStrings()) == ["Chicken", "Nuggets"]
+
+def describe_search():
+
+    STRINGS = ["nugget", "chicken", "nuggs", "dino", "nug", "chick"]
+
+    @pytest.fixture(params=[True, False], ids=["indexed", "scanned"])
+    def db(request, tmp_path):
+        db = MyDB(str(tmp_path / "strings.db"), searchIndex=request.param)
+        db.saveStrings(STRINGS[:3])
+        for s in STRINGS[3:]:
+            db.saveString(s)
+        return db
+
+    def it_finds_strings_by_prefix_in_sorted_order(db):
+        assert db.findPrefix("nug") == ["nug", "nugget", "nuggs"]
+        assert db.findPrefix("chick") == ["chick", "chicken"]
+        assert db.findPrefix("z") == []
+
+    def it_tells_whether_a_string_is_stored(db):
+        assert db.contains("dino")
+        assert db.contains("chicken")
+        assert not db.contains("nugge")
+
+    def it_folds_appended_strings_into_the_sorted_file(mocker, tmp_path):
+        mocker.patch("mydb.MIN_TAIL", 2)
+        db = MyDB(str(tmp_path / "strings.db"), searchIndex=True)
+        for s in STRINGS:
+            db.saveString(s)
+
+        with open(db.searchName, "rb") as f:
+            covered = SEARCH_HEADER.unpack(f.read(SEARCH_HEADER.size))[2]
+        assert covered == 6
+        assert MyDB(db.fname, searchIndex=True).findPrefix("") == sorted(STRINGS)
+
+    def it_searches_past_a_missing_or_stale_sorted_file(tmp_path):
+        db = MyDB(str(tmp_path / "strings.db"), searchIndex=True)
+        db.saveStrings(STRINGS)
+        os.remove(db.searchName)
+
+        assert MyDB(db.fname, searchIndex=True).findPrefix("nugg") == ["nugget", "nuggs"]
+
+        MyDB(db.fname).saveStrings(["dino"])
+
+        assert MyDB(db.fname, searchIndex=True).findPrefix("") == ["dino"]
+
+    def it_leaves_rebuilding_the_sorted_file_to_the_next_writer(tmp_path):
+        db = MyDB(str(tmp_path / "strings.db"), searchIndex=True)
+        db.saveStrings(STRINGS)
+        os.remove(db.searchName)
+        assert db.contains("dino")
+        assert not os.path.exists(db.searchName)
+
+        MyDB(db.fname, searchIndex=True).saveString("yum")
+
+        with open(db.searchName, "rb") as f:
+            assert SEARCH_HEADER.unpack(f.read(SEARCH_HEADER.size))[2] == len(STRINGS) + 1
+
+def writeStrings(fname, prefix, count):
+    db = MyDB(fname, searchIndex=True)
+    for i in range(count):
+        if i % 2:
+            db.saveString("{}-{}".format(prefix, i))
+        else:
+            db.saveStringsBatch(["{}-{}".format(prefix, i)])
+
+def describe_batched_writes():
+
+    def it_appends_a_batch_with_one_write_to_the_log(mocker, tmp_path):
+        db = MyDB(str(tmp_path / "strings.db"))
+        db.saveString("Chicken")
+
+        db.saveStringsBatch(["Nuggets", "Are", "Good"])
+
+        assert db.loadStrings() == ["Chicken", "Nuggets", "Are", "Good"]
+        assert db[1:] == ["Nuggets", "Are", "Good"]
+
+    def it_fsyncs_once_per_batch_when_durable(mocker, tmp_path):
+        db = MyDB(str(tmp_path / "strings.db"), durable=True)
+        mock_fsync = mocker.patch("os.fsync")
+
+        db.saveStringsBatch(["Chicken", "Nuggets", "Are", "Good"])
+
+        mock_fsync.assert_called_once()
+
+    def it_buffers_strings_until_full_or_closed(mocker, tmp_path):
+        db = MyDB(str(tmp_path / "strings.db"))
+        spy = mocker.spy(db, "saveStringsBatch")
+
+        with db.writeBuffer(maxStrings=2) as buffer:
+            for s in ["Chicken", "Nuggets", "Yum"]:
+                buffer.saveString(s)
+
+        assert spy.call_args_list == [mocker.call(["Chicken", "Nuggets"]), mocker.call(["Yum"])]
+        assert db.loadStrings() == ["Chicken", "Nuggets", "Yum"]
+
+    def it_cuts_off_a_record_another_writer_left_half_written(tmp_path):
+        db = MyDB(str(tmp_path / "strings.db"))
+        db.saveString("Chicken")
+        with open(db.fname, "ab") as f:
+            f.write(encodeRecord("Half written")[:-3])
+
+        db.saveString("Yum")
+
+        assert db[:] == ["Chicken", "Yum"]
+
+    def it_loses_nothing_to_concurrent_writer_processes(tmp_path):
+        fname = str(tmp_path / "strings.db")
+        MyDB(fname)
+        context = multiprocessing.get_context("fork")
+        writers = [context.Process(target=writeStrings, args=(fname, n, 100)) for n in range(4)]
+        for writer in writers:
+            writer.start()
+        for writer in writers:
+            writer.join()
+
+        db = MyDB(fname, searchIndex=True)
+        expected = sorted("{}-{}".format(n, i) for n in range(4) for i in range(100))
+        assert sorted(db.loadStrings()) == expected
+        assert sorted(db[:]) == expected
+        assert db.findPrefix("") == expected
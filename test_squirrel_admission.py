@@ -0,0 +1,73 @@
+import pytest
+from squirrel_admission import AdmissionController, refusal
+
+@pytest.fixture
+def clock(mocker):
+    now = [1000.0]
+    mocker.patch("squirrel_admission.time.monotonic", side_effect=lambda: now[0])
+    return now
+
+def describe_AdmissionController():
+
+    def it_admits_everything_without_limits():
+        admission = AdmissionController()
+
+        assert all(admission.admit("10.0.0.1", True) is None for i in range(1000))
+
+    def it_refuses_requests_past_the_in_flight_limit_until_one_is_released():
+        admission = AdmissionController(maxInFlight=2)
+
+        assert admission.admit("10.0.0.1", False) is None
+        assert admission.admit("10.0.0.1", False) is None
+        assert admission.admit("10.0.0.1", False) == {"status": 503, "retryAfter": 1}
+        admission.release()
+        assert admission.admit("10.0.0.1", False) is None
+
+    def it_keeps_the_read_reserve_free_of_writes():
+        admission = AdmissionController(maxInFlight=3, readReserve=1)
+
+        assert admission.admit("10.0.0.1", True) is None
+        assert admission.admit("10.0.0.1", True) is None
+        assert admission.admit("10.0.0.1", True)["status"] == 503
+        assert admission.admit("10.0.0.1", False) is None
+        assert admission.admit("10.0.0.1", False)["status"] == 503
+
+    def it_rejects_a_reserve_as_large_as_the_limit():
+        with pytest.raises(ValueError):
+            AdmissionController(maxInFlight=2, readReserve=2)
+
+    def it_rate_limits_each_client_with_its_own_bucket(clock):
+        admission = AdmissionController(rate=2, burst=2)
+
+        assert admission.admit("10.0.0.1", False) is None
+        assert admission.admit("10.0.0.1", False) is None
+        assert admission.admit("10.0.0.1", False) == {"status": 429, "retryAfter": 1}
+        assert admission.admit("10.0.0.2", False) is None
+        clock[0] += 0.5
+        assert admission.admit("10.0.0.1", False) is None
+
+    def it_asks_slow_clients_to_wait_for_their_next_token(clock):
+        admission = AdmissionController(rate=0.25)
+
+        assert admission.admit("10.0.0.1", False) is None
+        assert admission.admit("10.0.0.1", False) == {"status": 429, "retryAfter": 4}
+
+    def it_forgets_clients_whose_buckets_have_refilled(clock):
+        admission = AdmissionController(rate=1, maxClients=2)
+        admission.admit("10.0.0.1", False)
+        clock[0] += 5
+        admission.admit("10.0.0.2", False)
+
+        admission.admit("10.0.0.3", False)
+
+        assert sorted(admission._buckets) == ["10.0.0.2", "10.0.0.3"]
+
+def describe_refusal():
+
+    def it_builds_a_complete_response():
+        response = refusal(503, 2, close=True)
+
+        assert response.startswith(b"HTTP/1.1 503 Service Unavailable\r\n")
+        assert b"Retry-After: 2\r\n" in response
+        assert b"Connection: close\r\n" in response
+        assert response.endswith(b"\r\n\r\n503 Service Unavailable")
@@ -0,0 +1,243 @@
+import asyncio
+import json
+import shutil
+import threading
+import pytest
+from squirrel_admission import AdmissionController
+from squirrel_async_server import AsyncSquirrelServer, frameResponse
+from squirrel_server import SquirrelServerHandler
+from squirrel_db import ChangeLog, SquirrelDB, SquirrelDBPool
+
+@pytest.fixture(autouse=True)
+def db_pool(mocker, tmp_path):
+    filename = str(tmp_path / "squirrel_db.db")
+    shutil.copyfile("empty_squirrel_db.db", filename)
+    pool = SquirrelDBPool(size=2, filename=filename)
+    mocker.patch.object(SquirrelServerHandler, "dbPool", pool)
+    mocker.patch.object(SquirrelServerHandler, "log_message")
+    return pool
+
+#starts the engine on a free loopback port, runs the client coroutine
+#against it and shuts everything down again
+def serve_and_call(client, **kwargs):
+    async def main():
+        server = AsyncSquirrelServer("127.0.0.1", 0, readers=2, **kwargs)
+        await server.start()
+        try:
+            reader, writer = await asyncio.open_connection(*server.server_address)
+            result = await client(reader, writer)
+            writer.close()
+            return result
+        finally:
+            await server.close()
+    return asyncio.run(main())
+
+async def read_response(reader):
+    head = await reader.readuntil(b"\r\n\r\n")
+    length = 0
+    for line in head.split(b"\r\n"):
+        if line.lower().startswith(b"content-length:"):
+            length = int(line.split(b":")[1])
+    body = await reader.readexactly(length)
+    return head, body
+
+def describe_frame_response():
+
+    def it_adds_content_length_and_keep_alive():
+        response, keepAlive = frameResponse(b"HTTP/1.0 200 OK\r\nContent-Type: text/plain\r\n\r\nhello", True)
+
+        assert keepAlive
+        assert b"Content-Length: 5\r\n" in response
+        assert b"Connection: keep-alive\r\n" in response
+        assert response.endswith(b"\r\n\r\nhello")
+
+    def it_leaves_204_without_a_body_length():
+        response, keepAlive = frameResponse(b"HTTP/1.0 204 No Content\r\n\r\n", True)
+
+        assert b"Content-Length" not in response
+
+    def it_adds_no_length_to_the_start_of_a_stream():
+        response, keepAlive = frameResponse(b"HTTP/1.0 200 OK\r\nConnection: close\r\n\r\n[1,", True, streaming=True)
+
+        assert not keepAlive
+        assert b"Content-Length" not in response
+
+    def it_honors_connection_close_from_the_handler():
+        response, keepAlive = frameResponse(b"HTTP/1.1 400 Bad\r\nConnection: close\r\n\r\n", True)
+
+        assert not keepAlive
+
+def describe_AsyncSquirrelServer():
+
+    def it_serves_the_same_index_as_the_threaded_handler(mocker):
+        mocker.patch.object(SquirrelDB, "getSquirrelRows", return_value=["squirrel"])
+
+        async def client(reader, writer):
+            writer.write(b"GET /squirrels HTTP/1.1\r\nHost: x\r\n\r\n")
+            return await read_response(reader)
+
+        head, body = serve_and_call(client)
+
+        assert head.startswith(b"HTTP/1.1 200")
+        assert body == b'["squirrel"]'
+
+    def it_answers_unknown_paths_with_404():
+        async def client(reader, writer):
+            writer.write(b"GET /nope HTTP/1.1\r\nHost: x\r\n\r\n")
+            return await read_response(reader)
+
+        head, body = serve_and_call(client)
+
+        assert head.startswith(b"HTTP/1.1 404")
+        assert body == b"404 Not Found"
+
+    def it_keeps_the_connection_open_for_pipelined_requests(mocker):
+        mocker.patch.object(SquirrelDB, "getSquirrel", side_effect=lambda squirrelId: {"id": squirrelId})
+
+        async def client(reader, writer):
+            writer.write(b"GET /squirrels/1 HTTP/1.1\r\nHost: x\r\n\r\n"
+                         b"GET /squirrels/2 HTTP/1.1\r\nHost: x\r\n\r\n")
+            return [await read_response(reader), await read_response(reader)]
+
+        first, second = serve_and_call(client)
+
+        assert first[1] == b'{"id": "1"}'
+        assert second[1] == b'{"id": "2"}'
+
+    def it_runs_writes_on_the_single_writer_thread(mocker):
+        threads = []
+        def createSquirrel(name, size):
+            threads.append(threading.current_thread().name)
+            return {"id": 1, "name": name, "size": size}
+        mocker.patch.object(SquirrelDB, "createSquirrel", side_effect=createSquirrel)
+
+        async def client(reader, writer):
+            writer.write(b"POST /squirrels HTTP/1.1\r\nHost: x\r\nContent-Length: 22\r\n\r\n"
+                         b"name=Chippy&size=small")
+            return await read_response(reader)
+
+        head, body = serve_and_call(client)
+
+        assert head.startswith(b"HTTP/1.1 201")
+        assert threads[0].startswith("squirrel-writer")
+
+    def it_closes_connections_that_stay_idle():
+        async def client(reader, writer):
+            return await reader.read()
+
+        assert serve_and_call(client, idleTimeout=0.05) == b""
+
+    def it_refuses_oversized_bodies_without_reading_them(mocker):
+        mocker.patch.object(SquirrelServerHandler, "maxBodyBytes", 10)
+
+        async def client(reader, writer):
+            writer.write(b"POST /squirrels HTTP/1.1\r\nHost: x\r\nContent-Length: 22\r\n\r\n")
+            return await read_response(reader)
+
+        head, body = serve_and_call(client)
+
+        assert head.startswith(b"HTTP/1.1 413")
+        assert b"Connection: close" in head
+
+    def it_streams_rows_to_the_client_while_they_are_read(mocker):
+        received = threading.Event()
+        def rows(**kwargs):
+            for i in range(1000):
+                yield {"id": i, "name": "Chippy"}
+            # the rest waits until the client has the start of the body
+            yield {"id": -1, "name": "streamed" if received.wait(5) else "buffered"}
+        mocker.patch.object(SquirrelDB, "iterSquirrelRows", side_effect=rows)
+
+        async def client(reader, writer):
+            writer.write(b"GET /squirrels?stream=ndjson HTTP/1.1\r\nHost: x\r\n\r\n")
+            head = await reader.readuntil(b"\r\n\r\n")
+            await reader.readuntil(b"\r\n")
+            received.set()
+            body = await reader.readuntil(b"0\r\n\r\n")
+            return head, body
+
+        head, body = serve_and_call(client)
+
+        assert b"Transfer-Encoding: chunked" in head
+        assert b"Connection: keep-alive" in head
+        assert b'"streamed"' in body
+
+    def it_sends_each_change_event_as_it_is_committed(mocker):
+        change_log = ChangeLog()
+        mocker.patch.object(SquirrelServerHandler, "changeLog", change_log)
+        mocker.patch.object(SquirrelServerHandler, "changesStreamSeconds", 30.0)
+
+        async def client(reader, writer):
+            writer.write(b"GET /squirrels/changes?since=0&stream=sse HTTP/1.1\r\nHost: x\r\n\r\n")
+            head = await reader.readuntil(b"\r\n\r\n")
+            threading.Timer(0.05, change_log.append, [[("create", 1, {"id": 1})]]).start()
+            event = await asyncio.wait_for(reader.readuntil(b"\n\n"), 5)
+            change_log.close()
+            return head, event
+
+        head, event = serve_and_call(client)
+
+        assert b"Content-Type: text/event-stream" in head
+        assert b"Transfer-Encoding: chunked" in head
+        assert b"id: 1\n" in event
+
+    def it_waits_for_changes_without_holding_a_reader_thread(mocker):
+        mocker.patch.object(SquirrelDB, "getSquirrelRows", return_value=["squirrel"])
+        change_log = ChangeLog()
+        mocker.patch.object(SquirrelServerHandler, "changeLog", change_log)
+
+        async def client(reader, writer):
+            address = writer.get_extra_info("peername")
+            polls = []
+            # more long-polls than there are reader threads
+            for _ in range(3):
+                pollReader, pollWriter = await asyncio.open_connection(*address)
+                pollWriter.write(b"GET /squirrels/changes?since=0&wait=10 HTTP/1.1\r\nHost: x\r\n\r\n")
+                polls.append((pollReader, pollWriter))
+            await asyncio.sleep(0.05)
+            writer.write(b"GET /squirrels HTTP/1.1\r\nHost: x\r\n\r\n")
+            index = await asyncio.wait_for(read_response(reader), 5)
+            change_log.append([("delete", 1, None)])
+            answers = [await asyncio.wait_for(read_response(pollReader), 5) for pollReader, _ in polls]
+            for _, pollWriter in polls:
+                pollWriter.close()
+            return index, answers
+
+        index, answers = serve_and_call(client)
+
+        assert index[0].startswith(b"HTTP/1.1 200")
+        for head, body in answers:
+            assert head.startswith(b"HTTP/1.1 200")
+            assert b"Cache-Control: no-store" in head
+            assert json.loads(body) == {"changes": [{"seq": 1, "op": "delete", "id": 1, "squirrel": None}],
+                                        "next": 1}
+
+    def it_leaves_malformed_change_feed_requests_to_the_handler(mocker):
+        mocker.patch.object(SquirrelServerHandler, "changeLog", ChangeLog())
+
+        async def client(reader, writer):
+            writer.write(b"GET /squirrels/changes?since=x HTTP/1.1\r\nHost: x\r\n\r\n")
+            return await read_response(reader)
+
+        head, body = serve_and_call(client)
+
+        assert head.startswith(b"HTTP/1.1 400")
+
+    def it_sheds_writes_past_the_read_reserve_and_still_serves_reads(mocker):
+        mock_create = mocker.patch.object(SquirrelDB, "createSquirrel")
+        admission = AdmissionController(maxInFlight=2, readReserve=1)
+        admission.inFlight = 1
+
+        async def client(reader, writer):
+            writer.write(b"POST /squirrels HTTP/1.1\r\nHost: x\r\nContent-Length: 22\r\n\r\n"
+                         b"name=Chippy&size=small"
+                         b"GET /nope HTTP/1.1\r\nHost: x\r\n\r\n")
+            return [await read_response(reader), await read_response(reader)]
+
+        refused, served = serve_and_call(client, admission=admission)
+
+        assert refused[0].startswith(b"HTTP/1.1 503")
+        assert b"Retry-After: 1" in refused[0]
+        assert served[0].startswith(b"HTTP/1.1 404")
+        mock_create.assert_not_called()
+        assert admission.inFlight == 1
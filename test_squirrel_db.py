@@ -0,0 +1,597 @@
+import json
+import shutil
+import threading
+import time
+import pytest
+from squirrel_db import ChangeLog, GroupCommitter, Squirrel, SquirrelCache, SquirrelDB, SquirrelDBPool, PoolClosedError, SquirrelRows
+from squirrel_metrics import Metrics
+
+@pytest.fixture
+def db_filename(tmp_path):
+    filename = str(tmp_path / "squirrel_db.db")
+    shutil.copyfile("empty_squirrel_db.db", filename)
+    return filename
+
+@pytest.fixture
+def pool(db_filename):
+    pool = SquirrelDBPool(size=2, filename=db_filename, timeout=0.1)
+    yield pool
+    pool.close()
+
+def describe_SquirrelDBPool():
+
+    def describe_acquire():
+
+        def it_returns_a_squirrel_db(pool):
+            with pool.connection() as db:
+                assert isinstance(db, SquirrelDB)
+
+        def it_reuses_the_connection_after_release(pool):
+            with pool.connection() as first:
+                pass
+            with pool.connection() as second:
+                pass
+
+            assert first is second
+
+        def it_hands_the_same_connection_to_nested_borrows_on_one_thread(pool):
+            with pool.connection() as outer:
+                with pool.connection() as inner:
+                    assert inner is outer
+
+        def it_gives_other_threads_their_own_connection(pool):
+            seen = []
+            with pool.connection() as mine:
+                thread = threading.Thread(target=lambda: seen.append(pool.acquire()))
+                thread.start()
+                thread.join()
+
+            assert seen[0] is not mine
+
+        def it_times_out_when_every_connection_is_borrowed(db_filename):
+            pool = SquirrelDBPool(size=1, filename=db_filename, timeout=0.01)
+            errors = []
+            def borrow():
+                try:
+                    pool.acquire()
+                except TimeoutError as e:
+                    errors.append(e)
+
+            with pool.connection():
+                thread = threading.Thread(target=borrow)
+                thread.start()
+                thread.join()
+
+            assert len(errors) == 1
+            pool.close()
+
+    def describe_health_checks():
+
+        def it_replaces_a_connection_that_fails_its_check(mocker, db_filename):
+            pool = SquirrelDBPool(size=1, filename=db_filename, healthCheckAfter=0)
+            with pool.connection() as first:
+                pass
+            mocker.patch.object(first, "isHealthy", return_value=False)
+            mock_close = mocker.patch.object(first, "close")
+
+            with pool.connection() as second:
+                pass
+
+            assert second is not first
+            mock_close.assert_called_once()
+            pool.close()
+
+        def it_skips_the_check_for_recently_released_connections(mocker, pool):
+            with pool.connection() as first:
+                pass
+            mock_healthy = mocker.patch.object(first, "isHealthy")
+
+            with pool.connection():
+                pass
+
+            mock_healthy.assert_not_called()
+
+    def describe_close():
+
+        def it_closes_idle_connections(mocker, pool):
+            with pool.connection() as db:
+                pass
+            mock_close = mocker.patch.object(db, "close")
+
+            pool.close()
+
+            mock_close.assert_called_once()
+
+        def it_closes_borrowed_connections_when_they_come_back(mocker, pool):
+            db = pool.acquire()
+            mock_close = mocker.patch.object(db, "close")
+
+            pool.close()
+            mock_close.assert_not_called()
+            pool.release(db)
+
+            mock_close.assert_called_once()
+
+        def it_refuses_new_borrows(pool):
+            pool.close()
+
+            with pytest.raises(PoolClosedError):
+                pool.acquire()
+
+@pytest.fixture
+def db(db_filename):
+    db = SquirrelDB(db_filename)
+    for name in ["Chippy", "Nutty", "Fluffy", "Rocky", "Acorn"]:
+        db.createSquirrel(name, "small")
+    yield db
+    db.close()
+
+def describe_SquirrelDB_paging():
+
+    def it_returns_every_squirrel_without_a_limit(db):
+        assert [row["id"] for row in db.getSquirrels()] == [1, 2, 3, 4, 5]
+
+    def it_returns_the_page_after_the_given_id(db):
+        assert [row["id"] for row in db.getSquirrels(limit=2, afterId=2)] == [3, 4]
+
+    def it_streams_rows_in_batches(db):
+        assert [row["name"] for row in db.iterSquirrels(afterId=3, batchSize=1)] == ["Rocky", "Acorn"]
+
+    def it_finds_where_the_next_page_starts(db):
+        assert db.getPageEnd(2, afterId=1) == 3
+
+    def it_reports_no_next_page_on_the_last_page(db):
+        assert db.getPageEnd(2, afterId=3) is None
+
+def describe_SquirrelDB_batches():
+
+    def it_creates_a_batch_and_returns_the_new_ids(db):
+        ids = db.createSquirrels([("Hazel", "large"), ("Pecan", "medium")])
+
+        assert ids == [6, 7]
+        assert db.getSquirrel(7)["name"] == "Pecan"
+
+    def it_reports_which_updates_found_their_squirrel(db):
+        found = db.updateSquirrels([(1, "Chip", "tiny"), (99, "Ghost", "none")])
+
+        assert found == [True, False]
+        assert db.getSquirrel(1)["name"] == "Chip"
+
+    def it_reports_which_deletes_found_their_squirrel(db):
+        found = db.deleteSquirrels([2, 99, 3])
+
+        assert found == [True, False, True]
+        assert [row["id"] for row in db.getSquirrels()] == [1, 4, 5]
+
+    def it_rolls_back_the_whole_batch_on_error(db):
+        with pytest.raises(RuntimeError):
+            with db.transaction():
+                db.createSquirrel("Doomed", "small")
+                raise RuntimeError("boom")
+
+        assert len(db.getSquirrels()) == 5
+
+def describe_SquirrelDB_journal():
+
+    def it_opens_the_database_in_wal_mode(db):
+        assert db.connection.execute("PRAGMA journal_mode").fetchone()["journal_mode"] == "wal"
+
+    def it_uses_normal_synchronous_writes(db):
+        assert db.connection.execute("PRAGMA synchronous").fetchone()["synchronous"] == 1
+
+def describe_GroupCommitter():
+
+    def it_acks_each_write_after_commit(db, db_filename):
+        committer = GroupCommitter(db_filename, window=0.05)
+
+        futures = [committer.submit("createSquirrel", "Batch{}".format(i), "small") for i in range(3)]
+        results = [future.result(timeout=5) for future in futures]
+        committer.close()
+
+        assert [squirrel["id"] for squirrel in results] == [6, 7, 8]
+        assert len(db.getSquirrels()) == 8
+
+    def it_folds_concurrent_writes_into_one_transaction(mocker, db_filename):
+        begins = []
+        original = SquirrelDB.transaction
+        def counting(self):
+            begins.append(1)
+            return original(self)
+        mocker.patch.object(SquirrelDB, "transaction", counting)
+        committer = GroupCommitter(db_filename, window=0.2)
+
+        futures = [committer.submit("createSquirrel", "Batch{}".format(i), "small") for i in range(5)]
+        for future in futures:
+            future.result(timeout=5)
+        committer.close()
+
+        assert len(begins) == 1
+
+    def it_only_fails_the_write_that_raised(db, db_filename):
+        committer = GroupCommitter(db_filename, window=0.05)
+
+        good = committer.submit("createSquirrel", "Keeper", "small")
+        bad = committer.submit("noSuchMethod")
+        also_good = committer.submit("deleteSquirrel", 1)
+        committer.close()
+
+        assert good.result()["name"] == "Keeper" and also_good.result()["id"] == 1
+        with pytest.raises(AttributeError):
+            bad.result()
+        assert [row["name"] for row in db.getSquirrels()][-1] == "Keeper"
+        assert db.getSquirrel(1) is None
+
+def describe_SquirrelCache():
+
+    def it_counts_hits_and_misses():
+        cache = SquirrelCache()
+        cache.put(1, "one")
+
+        assert cache.get(1) == "one"
+        assert cache.get(2) is None
+        assert (cache.hits, cache.misses) == (1, 1)
+
+    def it_evicts_the_least_recently_used_entry():
+        cache = SquirrelCache(maxSize=2)
+        cache.put(1, "one")
+        cache.put(2, "two")
+        cache.get(1)
+        cache.put(3, "three")
+
+        assert cache.get(2) is None
+        assert cache.get(1) == "one"
+        assert cache.evictions == 1
+
+    def it_expires_entries_after_the_ttl(mocker):
+        clock = mocker.patch("squirrel_db.time.monotonic", return_value=100.0)
+        cache = SquirrelCache(ttl=10)
+        cache.put(1, "one")
+        clock.return_value = 111.0
+
+        assert cache.get(1) is None
+
+    def it_drops_a_put_that_raced_an_invalidation():
+        cache = SquirrelCache()
+        token = cache.token()
+        cache.invalidate(1)
+        cache.put(1, "stale", token)
+
+        assert cache.get(1) is None
+
+def describe_SquirrelDB_with_cache():
+
+    @pytest.fixture
+    def cached_db(db, db_filename):
+        cached = SquirrelDB(db_filename, cache=SquirrelCache())
+        yield cached
+        cached.close()
+
+    def it_serves_repeat_reads_from_the_cache(db, cached_db):
+        first = cached_db.getSquirrelJSON(1)
+        db.connection.execute("UPDATE squirrels SET name = 'Sneaky' WHERE id = 1")
+        db.connection.commit()
+
+        assert cached_db.getSquirrelJSON(1) == first == b'{"id": 1, "name": "Chippy", "size": "small"}'
+        assert cached_db.cache.hits == 1
+
+    def it_shares_entries_between_row_and_json_reads(cached_db):
+        cached_db.getSquirrel(2)
+
+        assert cached_db.getSquirrelJSON(2) == b'{"id": 2, "name": "Nutty", "size": "small"}'
+        assert cached_db.cache.hits == 1
+
+    def it_invalidates_exactly_the_updated_squirrel(cached_db):
+        cached_db.getSquirrel(1)
+        cached_db.getSquirrel(2)
+
+        cached_db.updateSquirrel("1", "Chip", "tiny")
+
+        assert cached_db.getSquirrel(1)["name"] == "Chip"
+        assert cached_db.cache.stats()["invalidations"] == 1
+        assert cached_db.getSquirrel(2)["name"] == "Nutty"
+
+    def it_sees_writes_made_by_other_processes(db_filename, cached_db):
+        cached_db.cache.otherWriters = True
+        cached_db.getSquirrel(1)
+        cached_db.getSquirrel(2)
+        cached_db.getSquirrel(3)
+        other = SquirrelDB(db_filename)
+        other.updateSquirrel("1", "Chip", "tiny")
+        other.deleteSquirrel("3")
+        other.close()
+
+        assert cached_db.getSquirrelEntry(1)[0]["name"] == "Chip"
+        assert cached_db.getSquirrel(3) is None
+        assert cached_db.getSquirrel(2)["name"] == "Nutty"
+
+    def it_answers_hits_without_a_query_when_no_other_process_writes(mocker, cached_db):
+        cached_db.getSquirrel(1)
+        spy = mocker.spy(cached_db, "getDataVersion")
+
+        assert cached_db.getSquirrel(1)["name"] == "Chippy"
+        spy.assert_not_called()
+
+    def it_invalidates_deleted_squirrels_after_a_batch_commits(cached_db):
+        cached_db.getSquirrel(3)
+
+        cached_db.deleteSquirrels([3])
+
+        assert cached_db.getSquirrel(3) is None
+
+def describe_ChangeLog():
+
+    def it_numbers_changes_in_order():
+        log = ChangeLog()
+        log.append([("create", 1, {"id": 1}), ("delete", 2, None)])
+
+        changes, lastSeq = log.since(0)
+
+        assert [(change["seq"], change["op"], change["id"]) for change in changes] == [(1, "create", 1), (2, "delete", 2)]
+        assert lastSeq == 2
+
+    def it_returns_nothing_new_without_waiting():
+        log = ChangeLog()
+        log.append([("delete", 1, None)])
+
+        assert log.since(1) == ([], 1)
+
+    def it_caps_a_read_at_the_limit():
+        log = ChangeLog()
+        log.append([("delete", squirrelId, None) for squirrelId in range(5)])
+
+        changes, lastSeq = log.since(1, limit=2)
+
+        assert [change["seq"] for change in changes] == [2, 3]
+        assert lastSeq == 3
+
+    def it_asks_readers_past_its_retention_to_resync():
+        log = ChangeLog(maxEntries=2)
+        log.append([("delete", squirrelId, None) for squirrelId in range(4)])
+
+        assert log.since(1) == (None, 4)
+        assert [change["seq"] for change in log.since(2)[0]] == [3, 4]
+
+    def it_tells_subscribers_about_appends_and_close_until_they_unsubscribe():
+        log = ChangeLog()
+        calls = []
+        listener = lambda: calls.append(log.lastSeq())
+        log.subscribe(listener)
+        log.append([("delete", 1, None)])
+        log.close()
+        log.unsubscribe(listener)
+        log.append([("delete", 2, None)])
+
+        assert calls == [1, 1]
+
+    def it_asks_readers_from_the_future_to_resync():
+        assert ChangeLog().since(7) == (None, 0)
+
+    def it_wakes_a_waiting_reader_on_append():
+        log = ChangeLog()
+        timer = threading.Timer(0.05, log.append, [[("delete", 1, None)]])
+        timer.start()
+
+        changes, lastSeq = log.since(0, timeout=5)
+
+        timer.join()
+        assert lastSeq == 1
+
+    def it_stops_waiting_once_closed():
+        log = ChangeLog()
+        threading.Timer(0.05, log.close).start()
+        start = time.monotonic()
+
+        assert log.since(0, timeout=5) == ([], 0)
+        assert time.monotonic() - start < 1
+
+def describe_SquirrelDB_change_log():
+
+    @pytest.fixture
+    def logged_db(db, db_filename):
+        logged = SquirrelDB(db_filename, changeLog=ChangeLog())
+        yield logged
+        logged.close()
+
+    def it_logs_single_row_writes(logged_db):
+        logged_db.createSquirrel("Hazel", "large")
+        logged_db.updateSquirrel("1", "Chip", "tiny")
+        logged_db.deleteSquirrel(2)
+        logged_db.deleteSquirrel(99)
+
+        changes = logged_db.changeLog.since(0)[0]
+
+        assert [(change["op"], change["id"]) for change in changes] == [("create", 6), ("update", 1), ("delete", 2)]
+        assert changes[1]["squirrel"] == {"id": 1, "name": "Chip", "size": "tiny"}
+
+    def it_logs_every_row_of_a_batch(logged_db):
+        logged_db.createSquirrels([("Hazel", "large"), ("Pecan", "medium")])
+        logged_db.deleteSquirrels([3, 99, 3])
+
+        changes = logged_db.changeLog.since(0)[0]
+
+        assert [(change["op"], change["id"]) for change in changes] == [("create", 6), ("create", 7), ("delete", 3)]
+
+    def it_logs_nothing_for_a_rolled_back_transaction(logged_db):
+        with pytest.raises(RuntimeError):
+            with logged_db.transaction():
+                logged_db.createSquirrel("Doomed", "small")
+                raise RuntimeError("boom")
+
+        assert logged_db.changeLog.lastSeq() == 0
+
+    def it_logs_group_commits_without_the_failed_writes(mocker, db_filename):
+        # the first write fails after it has logged its change
+        mocker.patch.object(SquirrelDB, "_commit", side_effect=[RuntimeError("boom"), None])
+        changeLog = ChangeLog()
+        committer = GroupCommitter(db_filename, window=0.05, changeLog=changeLog)
+
+        doomed = committer.submit("createSquirrel", "Doomed", "small")
+        kept = committer.submit("createSquirrel", "Keeper", "small")
+        committer.close()
+
+        with pytest.raises(RuntimeError):
+            doomed.result()
+        assert [change["squirrel"]["name"] for change in changeLog.since(0)[0]] == [kept.result()["name"]]
+
+def describe_SquirrelDB_metrics():
+
+    def it_times_the_connection_queries_and_commits(db, db_filename):
+        metrics = Metrics()
+        timed = SquirrelDB(db_filename, metrics=metrics)
+        timed.getSquirrels()
+        timed.updateSquirrel(1, "Chip", "tiny")
+        timed.close()
+
+        text = metrics.render()
+
+        for operation in ("connect", "getSquirrels", "updateSquirrel", "commit"):
+            assert 'squirrel_db_duration_seconds_count{{operation="{}"}} 1\n'.format(operation) in text
+
+    def it_times_the_row_read_behind_a_cache_miss(db, db_filename):
+        metrics = Metrics()
+        timed = SquirrelDB(db_filename, cache=SquirrelCache(), metrics=metrics)
+        timed.getSquirrelEntry(1)
+        timed.getSquirrelEntry(1)
+        timed.close()
+
+        assert 'squirrel_db_duration_seconds_count{operation="selectSquirrel"} 1\n' in metrics.render()
+
+    def it_hands_the_metrics_to_pooled_connections(db_filename):
+        pool = SquirrelDBPool(size=1, filename=db_filename, metrics=Metrics())
+        with pool.connection() as db:
+            db.getDataVersion()
+        pool.close()
+
+        assert 'operation="getDataVersion"} 1\n' in pool.metrics.render()
+
+def describe_SquirrelDB_data_version():
+
+    def it_bumps_the_version_on_every_write(db):
+        start = db.getDataVersion()
+        db.createSquirrel("Hazel", "large")
+        db.updateSquirrel(1, "Chip", "tiny")
+        db.deleteSquirrel(2)
+
+        assert db.getDataVersion() == start + 3
+
+    def it_bumps_the_version_once_per_batch(db):
+        start = db.getDataVersion()
+        db.createSquirrels([("Hazel", "large"), ("Pecan", "medium")])
+
+        assert db.getDataVersion() == start + 1
+
+    def it_leaves_the_version_alone_when_a_batch_changes_nothing(db):
+        start = db.getDataVersion()
+
+        assert db.createSquirrels([]) == []
+        assert db.updateSquirrels([(99, "Ghost", "tiny")]) == [False]
+        assert db.deleteSquirrels([98, 99]) == [False, False]
+
+        assert db.getDataVersion() == start
+
+    def it_sees_versions_bumped_by_other_connections(db, db_filename):
+        other = SquirrelDB(db_filename)
+        start = db.getDataVersion()
+        other.createSquirrel("Hazel", "large")
+        other.close()
+
+        assert db.getDataVersion() == start + 1
+
+    def it_leaves_the_version_alone_when_a_write_rolls_back(db):
+        start = db.getDataVersion()
+        with pytest.raises(RuntimeError):
+            with db.transaction():
+                db.createSquirrel("Doomed", "small")
+                raise RuntimeError("boom")
+
+        assert db.getDataVersion() == start
+
+def describe_SquirrelDB_row_versions():
+
+    def it_stamps_written_rows_with_the_new_data_version(db):
+        untouched = db.getRowVersion(2)
+        db.updateSquirrel(1, "Chip", "tiny")
+
+        assert db.getRowVersion(1) == db.getDataVersion()
+        assert db.getRowVersion(2) == untouched
+
+    def it_returns_the_row_and_its_version_together(db):
+        db.updateSquirrel(1, "Chip", "tiny")
+
+        squirrel, body, version = db.getSquirrelEntry(1)
+
+        assert squirrel["name"] == "Chip"
+        assert version == db.getDataVersion()
+
+    def it_only_writes_rows_still_at_the_expected_version(db):
+        version = db.getRowVersion(1)
+        db.updateSquirrel(1, "Chip", "tiny")
+
+        assert db.updateSquirrel(1, "Stale", "huge", version) is None
+        assert db.deleteSquirrel(1, version) is None
+        assert db.getSquirrel(1)["name"] == "Chip"
+        assert db.deleteSquirrel(1, db.getRowVersion(1)) is not None
+
+    def it_gives_a_recreated_id_a_fresh_version(db):
+        db.deleteSquirrel(5)
+        db.createSquirrel("Hazel", "large")
+
+        assert db.getSquirrel(5)["name"] == "Hazel"
+        assert db.getRowVersion(5) == db.getDataVersion()
+
+def describe_SquirrelDB_filters():
+
+    def it_filters_on_name_and_size(db):
+        db.updateSquirrel(2, "Nutty", "large")
+
+        assert [row["id"] for row in db.getSquirrels(size="small")] == [1, 3, 4, 5]
+        assert db.getSquirrels(name="Nutty", size="large") == [{"id": 2, "name": "Nutty", "size": "large"}]
+
+    def it_returns_only_the_requested_fields(db):
+        assert db.getSquirrels(limit=2, fields=("name",)) == [{"name": "Chippy"}, {"name": "Nutty"}]
+
+    def it_rejects_unknown_fields(db):
+        with pytest.raises(ValueError):
+            db.getSquirrels(fields=("name; DROP TABLE squirrels",))
+
+    def it_pages_through_filtered_rows(db):
+        db.updateSquirrel(2, "Nutty", "large")
+
+        assert db.getPageEnd(2, size="small") == 3
+        assert [row["id"] for row in db.iterSquirrels(afterId=3, size="small")] == [4, 5]
+
+    def it_uses_the_indexes_for_filtered_lookups(db):
+        plan = db.connection.execute("EXPLAIN QUERY PLAN " + db._pageQuery(10, None, name="Nutty")[0], ["Nutty", 10]).fetchall()
+
+        assert any("squirrels_name" in row["detail"] for row in plan)
+
+def describe_Squirrel_records():
+
+    def it_leaves_get_squirrels_returning_plain_dicts(db):
+        rows = db.getSquirrels(limit=1)
+
+        assert json.loads(json.dumps(rows)) == [{"id": 1, "name": "Chippy", "size": "small"}]
+        assert next(db.iterSquirrels(fields=("name",))) == {"name": "Chippy"}
+
+    def it_lists_rows_as_records(db):
+        rows = db.getSquirrelRows(limit=1)
+
+        assert isinstance(rows, SquirrelRows)
+        assert isinstance(rows[0], Squirrel)
+        assert rows[0].name == rows[0]["name"] == "Chippy"
+        assert dict(rows[0]) == {"id": 1, "name": "Chippy", "size": "small"}
+
+    def it_keeps_only_the_projected_columns(db):
+        row = next(db.iterSquirrelRows(fields=("size", "name")))
+
+        assert row.keys() == ("size", "name")
+        with pytest.raises(KeyError):
+            row["id"]
+
+    def it_encodes_the_same_json_as_json_dumps():
+        rows = SquirrelRows(Squirrel, [(1, 'Ché "q"\n', None), (2 ** 70, "", 1.5)])
+
+        assert rows.toJSON() == json.dumps([dict(row) for row in rows])
+        assert rows.toJSON(batchSize=1) == rows.toJSON()
+        assert rows.project(("size",)).toJSON() == '[{"size": null}, {"size": 1.5}]'
+        assert rows[1].toJSON() == json.dumps(dict(rows[1]))
@@ -0,0 +1,58 @@
+import pytest
+from squirrel_metrics import Histogram, Metrics
+
+def describe_Histogram():
+
+    def it_counts_values_into_cumulative_buckets():
+        histogram = Histogram((0.1, 1.0))
+        for value in (0.05, 0.1, 0.5, 3.0):
+            histogram.observe(value)
+
+        assert list(histogram.samples()) == [("0.1", 2), ("1.0", 3), ("+Inf", 4)]
+        assert (histogram.count, histogram.sum) == (4, pytest.approx(3.65))
+
+def describe_Metrics():
+
+    @pytest.fixture
+    def metrics():
+        return Metrics(buckets=(0.5,))
+
+    def it_counts_requests_by_handler_method_and_status(metrics):
+        for status in (200, 200, 404):
+            metrics.requestFinished(metrics.requestStarted("handleSquirrelsRetrieve", "GET"), status)
+
+        text = metrics.render()
+
+        assert 'squirrel_requests_total{handler="handleSquirrelsRetrieve",method="GET",status="200"} 2\n' in text
+        assert 'squirrel_requests_total{handler="handleSquirrelsRetrieve",method="GET",status="404"} 1\n' in text
+        assert 'squirrel_request_duration_seconds_count{handler="handleSquirrelsRetrieve",method="GET"} 3\n' in text
+
+    def it_reports_requests_still_in_flight(metrics):
+        token = metrics.requestStarted("handleSquirrelsChanges", "GET")
+
+        assert 'squirrel_requests_in_flight{handler="handleSquirrelsChanges",method="GET"} 1\n' in metrics.render()
+
+        metrics.requestFinished(token, 200)
+
+        assert 'squirrel_requests_in_flight{handler="handleSquirrelsChanges",method="GET"} 0\n' in metrics.render()
+
+    def it_labels_requests_that_raised_as_errors(metrics):
+        metrics.requestFinished(metrics.requestStarted("handleSquirrelsIndex", "GET"), None)
+
+        assert 'status="error"} 1\n' in metrics.render()
+
+    def it_renders_db_timings_as_histograms(metrics):
+        metrics.observeDB("commit", 0.25)
+        metrics.observeDB("commit", 2.0)
+
+        text = metrics.render()
+
+        assert "# TYPE squirrel_db_duration_seconds histogram\n" in text
+        assert 'squirrel_db_duration_seconds_bucket{operation="commit",le="0.5"} 1\n' in text
+        assert 'squirrel_db_duration_seconds_bucket{operation="commit",le="+Inf"} 2\n' in text
+        assert 'squirrel_db_duration_seconds_sum{operation="commit"} 2.25\n' in text
+
+    def it_escapes_label_values(metrics):
+        metrics.observeDB('say "hi"\\', 0.1)
+
+        assert 'operation="say \\"hi\\"\\\\"' in metrics.render()
@@ -0,0 +1,112 @@
+import marshal
+import pytest
+from squirrel_profiler import RequestProfiler, StackTracer
+
+def leaf():
+    return sum(range(100))
+
+def branch():
+    return leaf() + leaf()
+
+def describe_StackTracer():
+
+    def it_charges_time_to_the_full_call_stack():
+        tracer = StackTracer()
+
+        assert tracer.run(branch) == 9900
+
+        stacks = tracer.stacks
+        assert "test_squirrel_profiler.branch;test_squirrel_profiler.leaf" in stacks
+        assert "test_squirrel_profiler.branch;test_squirrel_profiler.leaf;builtins.sum" in stacks
+        assert all(seconds >= 0 for seconds in stacks.values())
+
+def describe_RequestProfiler():
+
+    def it_profiles_requests_that_ask_for_it():
+        profiler = RequestProfiler()
+
+        assert profiler.shouldProfile("1")
+        assert not profiler.shouldProfile(None)
+        assert not profiler.shouldProfile("0")
+
+    def it_ignores_the_header_when_told_to():
+        profiler = RequestProfiler(allowHeader=False)
+
+        assert not profiler.shouldProfile("1")
+
+    def it_samples_requests_at_the_configured_rate():
+        assert RequestProfiler(sampleRate=1.0).shouldProfile()
+        assert not RequestProfiler(sampleRate=0.0).shouldProfile()
+
+    def it_profiles_nothing_while_disabled():
+        profiler = RequestProfiler(sampleRate=1.0)
+        profiler.configure({"enabled": False})
+
+        assert not profiler.shouldProfile("1")
+
+    def it_aggregates_pstats_across_requests():
+        profiler = RequestProfiler()
+
+        profiler.profile(branch)
+        profiler.profile(branch)
+
+        stats = marshal.loads(profiler.pstatsData())
+        calls = [value[1] for key, value in stats.items() if key[2] == "leaf"]
+        assert calls == [4]
+        assert profiler.settings()["profiled"] == 2
+
+    def it_aggregates_collapsed_stacks_in_stacks_mode():
+        profiler = RequestProfiler(mode="stacks")
+
+        assert profiler.profile(branch) == 9900
+
+        for line in profiler.collapsedStacks().splitlines():
+            stack, microseconds = line.rsplit(" ", 1)
+            assert stack.startswith("test_squirrel_profiler.branch")
+            assert int(microseconds) > 0
+        assert profiler.pstatsData() is None
+
+    def it_runs_requests_unprofiled_while_another_is_profiled():
+        profiler = RequestProfiler()
+
+        assert profiler.profile(lambda: profiler.profile(branch)) == 9900
+
+        assert profiler.settings()["profiled"] == 1
+
+    def it_runs_requests_unprofiled_when_another_tool_holds_the_hook(mocker):
+        profile = mocker.patch("squirrel_profiler.cProfile.Profile").return_value
+        profile.enable.side_effect = ValueError("Another profiling tool is already active")
+        profiler = RequestProfiler()
+
+        assert profiler.profile(branch) == 9900
+
+        assert profiler.settings()["profiled"] == 0
+        assert profiler.pstatsData() is None
+        profile.disable.assert_not_called()
+
+    def it_records_requests_that_raise():
+        profiler = RequestProfiler()
+
+        with pytest.raises(ZeroDivisionError):
+            profiler.profile(lambda: 1 / 0)
+
+        assert profiler.settings()["profiled"] == 1
+
+    def it_rejects_bad_settings_without_applying_any():
+        profiler = RequestProfiler()
+
+        for settings in ({"sampleRate": 2}, {"mode": "perf"}, {"enabled": "yes"}, {"sampleRate": 0.5, "mode": "perf"}):
+            with pytest.raises(ValueError):
+                profiler.configure(settings)
+
+        assert profiler.settings() == {"enabled": True, "sampleRate": 0.0, "mode": "cprofile",
+                                       "allowHeader": True, "profiled": 0}
+
+    def it_forgets_what_it_collected_on_reset():
+        profiler = RequestProfiler()
+        profiler.profile(branch)
+
+        profiler.reset()
+
+        assert profiler.pstatsData() is None
+        assert profiler.settings()["profiled"] == 0
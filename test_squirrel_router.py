@@ -0,0 +1,46 @@
+import pytest
+from squirrel_router import Router
+
+@pytest.fixture
+def router():
+    router = Router()
+    router.add("GET", "/squirrels", "index")
+    router.add("POST", "/squirrels", "create")
+    router.add("GET", "/squirrels/{squirrelId}", "retrieve")
+    router.add("GET", "/squirrels/latest", "latest")
+    return router
+
+def describe_Router():
+
+    def it_matches_a_static_path(router):
+        assert router.match("/squirrels") == ({"GET": "index", "POST": "create"}, {})
+
+    def it_captures_template_parameters(router):
+        assert router.match("/squirrels/42") == ({"GET": "retrieve"}, {"squirrelId": "42"})
+
+    def it_prefers_literal_segments_over_parameters(router):
+        assert router.match("/squirrels/latest") == ({"GET": "latest"}, {})
+
+    def it_ignores_one_trailing_slash(router):
+        assert router.match("/squirrels/") == router.match("/squirrels")
+
+    def it_returns_none_for_paths_no_template_fits(router):
+        assert router.match("/squirrels/1/acorns") is None
+        assert router.match("/squirrels//") is None
+        assert router.match("/") is None
+        assert router.match("squirrels") is None
+
+    def it_matches_static_paths_without_splitting_them(router, mocker):
+        mock_split = mocker.patch("squirrel_router.splitPath")
+
+        assert router.match("/squirrels/latest/") == ({"GET": "latest"}, {})
+        mock_split.assert_not_called()
+
+    def it_sees_methods_added_to_a_static_path_later(router):
+        router.add("DELETE", "/squirrels/latest", "forget")
+
+        assert router.match("/squirrels/latest") == ({"GET": "latest", "DELETE": "forget"}, {})
+
+    def it_rejects_conflicting_parameter_names(router):
+        with pytest.raises(ValueError):
+            router.add("PUT", "/squirrels/{id}", "update")
@@ -1,8 +1,21 @@
 import io
 import json
+import marshal
+import os
+import shutil
+import socket
+import threading
+import time
 import pytest
-from squirrel_server import SquirrelServerHandler
-from squirrel_db import SquirrelDB
+from unittest.mock import call
+from http.server import BaseHTTPRequestHandler
+import gzip
+import zlib
+from squirrel_admission import AdmissionController
+from squirrel_server import ResponseCache, SingleHTTPServer, SquirrelServerHandler, ThreadPoolHTTPServer, decodeForm, parseArgs, makeServer
+from squirrel_db import ChangeLog, Squirrel, SquirrelDB, SquirrelDBPool, SquirrelRows
+from squirrel_metrics import Metrics
+from squirrel_profiler import RequestProfiler
 
 # use @todo to cause pytest to skip that section
 # handy for stubbing things out and then coming back later to finish them.
@@ -11,25 +24,32 @@ from squirrel_db import SquirrelDB
 todo = pytest.mark.skip(reason='TODO: pending spec')
 
 class FakeRequest():
-    def __init__(self, mock_wfile, method, path, body=None):
+    def __init__(self, mock_wfile, method, path, body=None, headers=None):
         self._mock_wfile = mock_wfile
         self._method = method
         self._path = path
         self._body = body
+        self._headers = headers or {}
 
     def sendall(self, x):
         return
 
+    def settimeout(self, timeout):
+        return
+
+    def setsockopt(self, *args):
+        return
+
     #this is not a 'makefile' like in c++ instead it 'makes' a response file
     def makefile(self, *args, **kwargs):
         if args[0] == 'rb':
-            if self._body:
-                headers = 'Content-Length: {}\r\n'.format(len(self._body))
-                body = self._body
-            else:
-                headers = ''
-                body = ''
-            request = bytes('{} {} HTTP/1.0\r\n{}\r\n{}'.format(self._method, self._path, headers, body), 'utf-8')
+            headers = ''.join('{}: {}\r\n'.format(name, value) for name, value in self._headers.items())
+            body = self._body or b''
+            if isinstance(body, str):
+                body = bytes(body, 'utf-8')
+            if body:
+                headers += 'Content-Length: {}\r\n'.format(len(body))
+            request = bytes('{} {} HTTP/1.0\r\n{}\r\n'.format(self._method, self._path, headers), 'utf-8') + body
             return io.BytesIO(request)
         elif args[0] == 'wb':
             return self._mock_wfile
@@ -44,15 +64,28 @@ def dummy_client():
 def dummy_server():
     return None
 
+#every test borrows from its own pool over a scratch copy of the empty db,
+#so nothing leaks into squirrel_db.db or between tests
+@pytest.fixture(autouse=True)
+def db_pool(mocker, tmp_path):
+    filename = str(tmp_path / "squirrel_db.db")
+    shutil.copyfile("empty_squirrel_db.db", filename)
+    pool = SquirrelDBPool(size=1, filename=filename)
+    mocker.patch.object(SquirrelServerHandler, "dbPool", pool)
+    return pool
+
 #a patch for mocking the DB initialize 
 # function - this gets called a lot.
 @pytest.fixture
 def mock_db_init(mocker):
+    #without a connection the ETag version reads need stubbing too
+    mocker.patch.object(SquirrelDB, 'getDataVersion', return_value=0)
+    mocker.patch.object(SquirrelDB, 'getRowVersion', return_value=0)
     return mocker.patch.object(SquirrelDB, '__init__', return_value=None)
 
 @pytest.fixture
 def mock_db_get_squirrels(mocker, mock_db_init):
-    return mocker.patch.object(SquirrelDB, 'getSquirrels', return_value=['squirrel'])
+    return mocker.patch.object(SquirrelDB, 'getSquirrelRows', return_value=['squirrel'])
 
 
 @pytest.fixture
@@ -116,7 +149,7 @@ def describe_Squirrel_Server_Handlers():
 
             SquirrelServerHandler(fake_get_squirrels_request, dummy_client, dummy_server)
 
-            mock_send_header.assert_called_once_with("Content-Type", "application/json")
+            assert mock_send_header.call_args_list == [call("Content-Type", "application/json"), call("ETag", '"v0"'), call("Vary", "Accept, Accept-Encoding"), call("Content-Length", "2")]
 
         def it_calls_end_headers(fake_get_squirrels_request, dummy_client, dummy_server, mock_response_methods):
             mock_send_response, mock_send_header, mock_end_headers = mock_response_methods
@@ -126,12 +159,203 @@ def describe_Squirrel_Server_Handlers():
             mock_end_headers.assert_called_once
 
         def it_writes_json_list_of_squirrels(fake_get_squirrels_request, dummy_client, dummy_server, mocker):
-            mocker.patch.object(SquirrelDB, "getSquirrels", return_value=["squirrel"])
+            mocker.patch.object(SquirrelDB, "getSquirrelRows", return_value=["squirrel"])
             
             handler = SquirrelServerHandler(fake_get_squirrels_request, dummy_client, dummy_server)
 
             handler.wfile.write.assert_called_once_with(bytes(json.dumps(['squirrel']), "utf-8"))
 
+        def it_encodes_squirrel_rows_without_json_dumps(fake_get_squirrels_request, dummy_client, dummy_server, mocker):
+            mocker.patch.object(SquirrelDB, "getSquirrelRows", return_value=SquirrelRows(Squirrel, [(1, "Chippy", "small")]))
+            mock_dumps = mocker.patch("squirrel_server.json.dumps")
+
+            handler = SquirrelServerHandler(fake_get_squirrels_request, dummy_client, dummy_server)
+
+            handler.wfile.write.assert_called_once_with(b'[{"id": 1, "name": "Chippy", "size": "small"}]')
+            mock_dumps.assert_not_called()
+
+    def describe_handle_Squirrels_Index_pages():
+
+        def it_asks_the_db_for_one_row_past_the_page(mocker, dummy_client, dummy_server):
+            mock_get = mocker.patch.object(SquirrelDB, "getSquirrelRows", return_value=[])
+
+            SquirrelServerHandler(FakeRequest(mocker.Mock(), "GET", "/squirrels?limit=2&after_id=7"), dummy_client, dummy_server)
+
+            mock_get.assert_called_once_with(limit=3, afterId=7)
+
+        def it_links_the_next_page_when_there_are_more_rows(mocker, dummy_client, dummy_server, mock_response_methods):
+            mocker.patch.object(SquirrelDB, "getSquirrelRows", return_value=[{"id": 1}, {"id": 2}, {"id": 3}])
+            mock_send_response, mock_send_header, mock_end_headers = mock_response_methods
+
+            handler = SquirrelServerHandler(FakeRequest(mocker.Mock(), "GET", "/squirrels?limit=2"), dummy_client, dummy_server)
+
+            mock_send_header.assert_any_call("Link", '</squirrels?limit=2&after_id=2>; rel="next"')
+            handler.wfile.write.assert_called_once_with(b'[{"id": 1}, {"id": 2}]')
+
+        def it_rejects_a_bad_limit(mocker, dummy_client, dummy_server, mock_response_methods):
+            mock_get = mocker.patch.object(SquirrelDB, "getSquirrelRows")
+
+            SquirrelServerHandler(FakeRequest(mocker.Mock(), "GET", "/squirrels?limit=abc"), dummy_client, dummy_server)
+
+            mock_response_methods[0].assert_called_once_with(400)
+            mock_get.assert_not_called()
+
+        def it_streams_ndjson_rows_from_the_cursor(mocker, dummy_client, dummy_server, mock_response_methods):
+            mocker.patch.object(SquirrelDB, "iterSquirrelRows", return_value=(row for row in [{"id": 1}, {"id": 2}]))
+            mock_send_response, mock_send_header, mock_end_headers = mock_response_methods
+
+            handler = SquirrelServerHandler(FakeRequest(mocker.Mock(), "GET", "/squirrels?stream=ndjson"), dummy_client, dummy_server)
+
+            mock_send_header.assert_any_call("Content-Type", "application/x-ndjson")
+            handler.wfile.write.assert_called_once_with(b'{"id": 1}\n{"id": 2}\n')
+
+        def it_streams_squirrel_records(mocker, dummy_client, dummy_server, mock_response_methods):
+            record = Squirrel.projection(("id", "name"))
+            mocker.patch.object(SquirrelDB, "iterSquirrelRows", return_value=(row for row in [record(1, "Chippy"), record(2, "Nutty")]))
+
+            handler = SquirrelServerHandler(FakeRequest(mocker.Mock(), "GET", "/squirrels?stream=json"), dummy_client, dummy_server)
+
+            handler.wfile.write.assert_called_once_with(b'[{"id": 1, "name": "Chippy"}, {"id": 2, "name": "Nutty"}]')
+
+    def describe_handle_Squirrels_Index_filters():
+
+        def it_passes_filters_and_fields_to_the_db(mocker, dummy_client, dummy_server):
+            mock_get = mocker.patch.object(SquirrelDB, "getSquirrelRows", return_value=SquirrelRows(Squirrel.projection(("id", "name")), [(1, "Chippy")]))
+
+            handler = SquirrelServerHandler(FakeRequest(mocker.Mock(), "GET", "/squirrels?size=small&fields=name"), dummy_client, dummy_server)
+
+            mock_get.assert_called_once_with(size="small", fields=("id", "name"))
+            handler.wfile.write.assert_called_once_with(b'[{"name": "Chippy"}]')
+
+        def it_keeps_filters_in_the_next_page_link(mocker, dummy_client, dummy_server, mock_response_methods):
+            mocker.patch.object(SquirrelDB, "getSquirrelRows", return_value=[{"id": 1}, {"id": 2}])
+
+            SquirrelServerHandler(FakeRequest(mocker.Mock(), "GET", "/squirrels?limit=1&name=Chippy&fields=id"), dummy_client, dummy_server)
+
+            mock_response_methods[1].assert_any_call("Link", '</squirrels?limit=1&after_id=1&name=Chippy&fields=id>; rel="next"')
+
+        def it_rejects_unknown_fields(mocker, dummy_client, dummy_server, mock_response_methods):
+            mock_get = mocker.patch.object(SquirrelDB, "getSquirrelRows")
+
+            SquirrelServerHandler(FakeRequest(mocker.Mock(), "GET", "/squirrels?fields=acorns"), dummy_client, dummy_server)
+
+            mock_response_methods[0].assert_called_once_with(400)
+            mock_get.assert_not_called()
+
+    def describe_handle_Squirrels_Index_cached():
+
+        @pytest.fixture(autouse=True)
+        def index_cache(mocker):
+            mocker.patch.object(SquirrelServerHandler, "indexCache", ResponseCache())
+
+        def it_reuses_the_body_until_the_version_changes(mocker, dummy_client, dummy_server):
+            mocker.patch.object(SquirrelDB, "getDataVersion", return_value=4)
+            mock_get = mocker.patch.object(SquirrelDB, "getSquirrelRows", return_value=[{"id": 1}])
+
+            SquirrelServerHandler(FakeRequest(mocker.Mock(), "GET", "/squirrels"), dummy_client, dummy_server)
+            handler = SquirrelServerHandler(FakeRequest(mocker.Mock(), "GET", "/squirrels"), dummy_client, dummy_server)
+
+            mock_get.assert_called_once()
+            handler.wfile.write.assert_called_once_with(b'[{"id": 1}]')
+
+        def it_rebuilds_the_body_after_a_write(mocker, dummy_client, dummy_server):
+            mocker.patch.object(SquirrelDB, "getDataVersion", side_effect=[4, 5])
+            mock_get = mocker.patch.object(SquirrelDB, "getSquirrelRows", side_effect=[[{"id": 1}], []])
+
+            SquirrelServerHandler(FakeRequest(mocker.Mock(), "GET", "/squirrels"), dummy_client, dummy_server)
+            handler = SquirrelServerHandler(FakeRequest(mocker.Mock(), "GET", "/squirrels"), dummy_client, dummy_server)
+
+            assert mock_get.call_count == 2
+            handler.wfile.write.assert_called_once_with(b'[]')
+
+        def it_serves_gzip_to_clients_that_accept_it(mocker, dummy_client, dummy_server, mock_response_methods):
+            mocker.patch.object(SquirrelDB, "getSquirrelRows", return_value=[{"id": 1}])
+            mocker.patch.object(SquirrelServerHandler, "compressMinBytes", 0)
+            mocker.patch.object(SquirrelServerHandler, "acceptsEncoding", side_effect=lambda encoding: encoding == "gzip")
+
+            handler = SquirrelServerHandler(FakeRequest(mocker.Mock(), "GET", "/squirrels"), dummy_client, dummy_server)
+
+            mock_response_methods[1].assert_any_call("Content-Encoding", "gzip")
+            assert gzip.decompress(handler.wfile.write.call_args[0][0]) == b'[{"id": 1}]'
+
+        def it_reuses_the_compressed_body(mocker, dummy_client, dummy_server):
+            mocker.patch.object(SquirrelDB, "getDataVersion", return_value=4)
+            mocker.patch.object(SquirrelDB, "getSquirrelRows", return_value=[{"id": 1}])
+            mocker.patch.object(SquirrelServerHandler, "compressMinBytes", 0)
+            mock_compress = mocker.patch("squirrel_server.compressBody", return_value=b"packed")
+            headers = {"Accept-Encoding": "deflate"}
+
+            SquirrelServerHandler(FakeRequest(mocker.Mock(), "GET", "/squirrels?limit=5", headers=headers), dummy_client, dummy_server)
+            handler = SquirrelServerHandler(FakeRequest(mocker.Mock(), "GET", "/squirrels?limit=5", headers=headers), dummy_client, dummy_server)
+
+            mock_compress.assert_called_once_with(b'[{"id": 1}]', "deflate", 6)
+            handler.wfile.write.assert_called_once_with(b"packed")
+
+    def describe_compression():
+
+        #stands in for the optional zstandard package, compressing with zlib
+        #so the output can be checked without it
+        class FakeZstandard:
+            class ZstdCompressor:
+                def __init__(self, level):
+                    self.level = level
+
+                def compressobj(self):
+                    return zlib.compressobj(self.level)
+
+        @pytest.fixture
+        def fake_zstd(mocker):
+            mocker.patch("squirrel_server.zstandard", FakeZstandard)
+            mocker.patch.object(SquirrelServerHandler, "compressEncodings", ("zstd", "gzip", "deflate"))
+
+        def it_leaves_bodies_under_the_threshold_alone(mocker, dummy_client, dummy_server, mock_response_methods):
+            mocker.patch.object(SquirrelDB, "getSquirrelRows", return_value=[{"id": 1}])
+            request = FakeRequest(mocker.Mock(), "GET", "/squirrels", headers={"Accept-Encoding": "gzip"})
+
+            handler = SquirrelServerHandler(request, dummy_client, dummy_server)
+
+            assert call("Content-Encoding", "gzip") not in mock_response_methods[1].call_args_list
+            handler.wfile.write.assert_called_once_with(b'[{"id": 1}]')
+
+        def it_compresses_large_lists_with_the_preferred_accepted_encoding(mocker, dummy_client, dummy_server, mock_response_methods):
+            rows = [{"id": i, "name": "Chippy", "size": "small"} for i in range(100)]
+            mocker.patch.object(SquirrelDB, "getSquirrelRows", return_value=rows)
+            request = FakeRequest(mocker.Mock(), "GET", "/squirrels", headers={"Accept-Encoding": "gzip;q=0, deflate"})
+
+            handler = SquirrelServerHandler(request, dummy_client, dummy_server)
+
+            mock_response_methods[1].assert_any_call("Content-Encoding", "deflate")
+            assert json.loads(zlib.decompress(handler.wfile.write.call_args[0][0])) == rows
+
+        def it_prefers_zstd_when_it_is_installed_and_accepted(mocker, dummy_client, dummy_server, mock_response_methods, fake_zstd):
+            rows = [{"id": i, "name": "Chippy", "size": "small"} for i in range(100)]
+            mocker.patch.object(SquirrelDB, "getSquirrelRows", return_value=rows)
+            request = FakeRequest(mocker.Mock(), "GET", "/squirrels", headers={"Accept-Encoding": "gzip, zstd"})
+
+            handler = SquirrelServerHandler(request, dummy_client, dummy_server)
+
+            mock_response_methods[1].assert_any_call("Content-Encoding", "zstd")
+            assert json.loads(zlib.decompress(handler.wfile.write.call_args[0][0])) == rows
+
+        def it_falls_back_when_zstd_is_not_accepted(mocker, dummy_client, dummy_server, mock_response_methods, fake_zstd):
+            rows = [{"id": i, "name": "Chippy", "size": "small"} for i in range(100)]
+            mocker.patch.object(SquirrelDB, "getSquirrelRows", return_value=rows)
+            request = FakeRequest(mocker.Mock(), "GET", "/squirrels", headers={"Accept-Encoding": "gzip"})
+
+            SquirrelServerHandler(request, dummy_client, dummy_server)
+
+            mock_response_methods[1].assert_any_call("Content-Encoding", "gzip")
+
+        def it_compresses_streams_on_the_fly(mocker, dummy_client, dummy_server, mock_response_methods):
+            mocker.patch.object(SquirrelDB, "iterSquirrelRows", return_value=(row for row in [{"id": 1}, {"id": 2}]))
+            request = FakeRequest(mocker.Mock(), "GET", "/squirrels?stream=ndjson", headers={"Accept-Encoding": "gzip"})
+
+            handler = SquirrelServerHandler(request, dummy_client, dummy_server)
+
+            mock_response_methods[1].assert_any_call("Content-Encoding", "gzip")
+            body = b"".join(args[0] for args, kwargs in handler.wfile.write.call_args_list)
+            assert gzip.decompress(body) == b'{"id": 1}\n{"id": 2}\n'
+
     def describe_handle_Squirrels_Retrieve():
         
         def describe_when_squirrel_exists():
@@ -155,7 +379,7 @@ def describe_Squirrel_Server_Handlers():
                 
                 handler = SquirrelServerHandler(fake_get_squirrels_request, dummy_client, dummy_server)
 
-                mock_send_header.assert_called_once_with("Content-Type", "application/json")
+                assert mock_send_header.call_args_list == [call("Content-Type", "application/json"), call("ETag", '"v0"'), call("Vary", "Accept, Accept-Encoding"), call("Content-Length", "12")]
 
             def it_calls_end_headers(fake_get_squirrels_request, dummy_client, dummy_server, mock_db_get_squirrels, mock_db_get_squirrel, mock_response_methods):
                 mock_send_response, mock_send_header, mock_end_headers = mock_response_methods
@@ -171,6 +395,13 @@ def describe_Squirrel_Server_Handlers():
 
                 handler.wfile.write.assert_called_once_with(bytes(json.dumps(['squirrel']), "utf-8"))
 
+            def it_writes_the_pre_serialized_squirrel(mocker, dummy_client, dummy_server):
+                mocker.patch.object(SquirrelDB, "getSquirrelEntry", return_value=({"id": 1}, b'{"id": 1}', 3))
+
+                handler = SquirrelServerHandler(FakeRequest(mocker.Mock(), "GET", "/squirrels/1"), dummy_client, dummy_server)
+
+                handler.wfile.write.assert_called_once_with(b'{"id": 1}')
+
         def describe_when_squirrel_does_not_exist():
 
             def it_calls_handle404(mocker, fake_get_squirrels_request, dummy_client, dummy_server):
@@ -187,10 +418,16 @@ def describe_Squirrel_Server_Handlers():
         def describe_create_squirrels_with_good_request():
 
             def it_creates_squirrel_with_correct_data(mocker, fake_create_squirrel_request, dummy_client, dummy_server):
-                mock_create = mocker.patch("squirrel_server.SquirrelDB.createSquirrel")
+                mock_create = mocker.patch("squirrel_server.SquirrelDB.createSquirrel", return_value={"id": 1, "name": "Chippy", "size": "small"})
                 handler = SquirrelServerHandler(fake_create_squirrel_request, dummy_client, dummy_server)
                 mock_create.assert_called_once_with("Chippy", "small")
 
+            def it_writes_the_created_squirrel_and_its_location(mocker, fake_create_squirrel_request, dummy_client, dummy_server, mock_response_methods):
+                handler = SquirrelServerHandler(fake_create_squirrel_request, dummy_client, dummy_server)
+
+                mock_response_methods[1].assert_any_call("Location", "/squirrels/1")
+                handler.wfile.write.assert_called_once_with(b'{"id": 1, "name": "Chippy", "size": "small"}')
+
             def it_sends_201_status_code(mocker, fake_create_squirrel_request, dummy_client, dummy_server, mock_response_methods):
                 handler = SquirrelServerHandler(fake_create_squirrel_request, dummy_client, dummy_server)
                 mock_response_methods[0].assert_called_once_with(201)
@@ -199,46 +436,54 @@ def describe_Squirrel_Server_Handlers():
                 handler = SquirrelServerHandler(fake_create_squirrel_request, dummy_client, dummy_server)
                 mock_response_methods[2].assert_called_once()
                 
+            def it_hands_the_write_to_the_group_committer_when_enabled(mocker, fake_create_squirrel_request, dummy_client, dummy_server):
+                mock_committer = mocker.Mock()
+                mock_committer.call.return_value = ({"id": 1, "name": "Chippy", "size": "small"}, 7)
+                mocker.patch.object(SquirrelServerHandler, "groupCommitter", mock_committer)
+                mock_create = mocker.patch("squirrel_server.SquirrelDB.createSquirrel")
+
+                SquirrelServerHandler(fake_create_squirrel_request, dummy_client, dummy_server)
+
+                mock_committer.call.assert_called_once_with("createSquirrelWithVersion", "Chippy", "small")
+                mock_create.assert_not_called()
+
     def describe_handle_Squirrels_Update():
         
         def describe_squirrel_exists():
 
             def it_updates_existing_squirrel(mocker, dummy_client, dummy_server, mock_response_methods):
-                mocker.patch("squirrel_server.SquirrelDB.updateSquirrel")
-                mocker.patch("squirrel_server.SquirrelDB.getSquirrel", return_value={"id": "1"})
+                mocker.patch("squirrel_server.SquirrelDB.updateSquirrel", return_value={"id": 1, "name": "Chippy", "size": "small"})
                 mocker.patch.object(SquirrelServerHandler, "getRequestData", return_value={"name": "Chippy", "size": "small"})
                 mock_send_response, mock_send_header, mock_end_headers = mock_response_methods
 
                 fake_request = FakeRequest(mocker.Mock(), "PUT", "/squirrels/1")
                 handler = SquirrelServerHandler(fake_request, dummy_client, dummy_server)
 
-                mock_send_response.assert_called_once_with(204)
+                mock_send_response.assert_called_once_with(200)
 
-            def it_calls_getSquirrel_when_handle_squirrels_update_is_called(mocker, dummy_client, dummy_server, mock_response_methods):
-                mocker.patch("squirrel_server.SquirrelDB.updateSquirrel")
-                mock_get_squirrel = mocker.patch("squirrel_server.SquirrelDB.getSquirrel", return_value={"id": "1"})
+            def it_does_not_read_the_squirrel_before_updating_it(mocker, dummy_client, dummy_server, mock_response_methods):
+                mocker.patch("squirrel_server.SquirrelDB.updateSquirrel", return_value={"id": 1, "name": "Chippy", "size": "small"})
+                mock_get_squirrel = mocker.patch("squirrel_server.SquirrelDB.getSquirrel")
                 mocker.patch.object(SquirrelServerHandler, "getRequestData", return_value={"name": "Chippy", "size": "small"})
                 mock_send_response, mock_send_header, mock_end_headers = mock_response_methods
 
                 fake_request = FakeRequest(mocker.Mock(), "PUT", "/squirrels/1")
                 handler = SquirrelServerHandler(fake_request, dummy_client, dummy_server)
 
-                mock_get_squirrel.assert_called_once_with('1')
+                mock_get_squirrel.assert_not_called()
 
             def it_calls_updateSquirrel_when_handle_squirrels_update_is_called(mocker, dummy_client, dummy_server, mock_response_methods):
-                mock_update = mocker.patch("squirrel_server.SquirrelDB.updateSquirrel")
-                mocker.patch("squirrel_server.SquirrelDB.getSquirrel", return_value={"id": "1"})
+                mock_update = mocker.patch("squirrel_server.SquirrelDB.updateSquirrel", return_value={"id": 1, "name": "Chippy", "size": "small"})
                 mocker.patch.object(SquirrelServerHandler, "getRequestData", return_value={"name": "Chippy", "size": "small"})
                 mock_send_response, mock_send_header, mock_end_headers = mock_response_methods
 
                 fake_request = FakeRequest(mocker.Mock(), "PUT", "/squirrels/1")
                 handler = SquirrelServerHandler(fake_request, dummy_client, dummy_server)
 
-                mock_update.assert_called_once()
+                mock_update.assert_called_once_with("1", "Chippy", "small", None)
 
             def it_calls_getRequestData_when_handle_squirrels_update_is_called(mocker, dummy_client, dummy_server, mock_response_methods):
-                mocker.patch("squirrel_server.SquirrelDB.updateSquirrel")
-                mocker.patch("squirrel_server.SquirrelDB.getSquirrel", return_value={"id": "1"})
+                mocker.patch("squirrel_server.SquirrelDB.updateSquirrel", return_value={"id": 1, "name": "Chippy", "size": "small"})
                 mock_get_data = mocker.patch.object(SquirrelServerHandler, "getRequestData", return_value={"name": "Chippy", "size": "small"})
                 mock_send_response, mock_send_header, mock_end_headers = mock_response_methods
 
@@ -247,9 +492,17 @@ def describe_Squirrel_Server_Handlers():
 
                 mock_get_data.assert_called_once()
 
+            def it_writes_the_updated_squirrel(mocker, dummy_client, dummy_server, mock_response_methods):
+                mocker.patch("squirrel_server.SquirrelDB.updateSquirrel", return_value={"id": 1, "name": "Chippy", "size": "small"})
+                mocker.patch.object(SquirrelServerHandler, "getRequestData", return_value={"name": "Chippy", "size": "small"})
+
+                fake_request = FakeRequest(mocker.Mock(), "PUT", "/squirrels/1")
+                handler = SquirrelServerHandler(fake_request, dummy_client, dummy_server)
+
+                handler.wfile.write.assert_called_once_with(b'{"id": 1, "name": "Chippy", "size": "small"}')
+
             def it_calls_end_headers_when_handle_squirrels_update_is_called(mocker, dummy_client, dummy_server, mock_response_methods):
-                mocker.patch("squirrel_server.SquirrelDB.updateSquirrel")
-                mocker.patch("squirrel_server.SquirrelDB.getSquirrel", return_value={"id": "1"})
+                mocker.patch("squirrel_server.SquirrelDB.updateSquirrel", return_value={"id": 1, "name": "Chippy", "size": "small"})
                 mocker.patch.object(SquirrelServerHandler, "getRequestData", return_value={"name": "Chippy", "size": "small"})
                 mock_send_response, mock_send_header, mock_end_headers = mock_response_methods
 
@@ -261,7 +514,8 @@ def describe_Squirrel_Server_Handlers():
         def describe_squirrel_does_not_exist():
             
             def it_returns_404_when_squirrel_does_not_exist(mocker, dummy_client, dummy_server):
-                mocker.patch("squirrel_server.SquirrelDB.getSquirrel", return_value=None)
+                mocker.patch("squirrel_server.SquirrelDB.updateSquirrel", return_value=None)
+                mocker.patch.object(SquirrelServerHandler, "getRequestData", return_value={"name": "Chippy", "size": "small"})
                 mock_404 = mocker.patch.object(SquirrelServerHandler, "handle404")
 
                 fake_request = FakeRequest(mocker.Mock(), "PUT", "/squirrels/999")
@@ -269,14 +523,14 @@ def describe_Squirrel_Server_Handlers():
 
                 mock_404.assert_called_once()
 
-            def it_calls_getSquirrel_when_handle_squirrels_update_is_called_and_squirrel_does_not_exist(mocker, dummy_client, dummy_server, mock_response_methods):
-                mock_get_squirrel = mocker.patch("squirrel_server.SquirrelDB.getSquirrel", return_value=None)
-                mock_404 = mocker.patch.object(SquirrelServerHandler, "handle404")
+            def it_answers_404_from_the_real_db_in_one_write(mocker, dummy_client, dummy_server, mock_response_methods):
+                mock_update = mocker.spy(SquirrelDB, "updateSquirrel")
 
-                fake_request = FakeRequest(mocker.Mock(), "PUT", "/squirrels/999")
+                fake_request = FakeRequest(mocker.Mock(), "PUT", "/squirrels/999", body="name=Chippy&size=small")
                 handler = SquirrelServerHandler(fake_request, dummy_client, dummy_server)
 
-                mock_get_squirrel.assert_called_once_with("999")
+                mock_update.assert_called_once()
+                mock_response_methods[0].assert_called_once_with(404)
 
 
     def describe_handle_squirrels_delete():
@@ -284,29 +538,27 @@ def describe_Squirrel_Server_Handlers():
         def describe_squirrel_exists():
 
             def it_deletes_existing_squirrel(mocker, dummy_client, dummy_server, mock_response_methods):
-                mocker.patch("squirrel_server.SquirrelDB.deleteSquirrel")
-                mocker.patch("squirrel_server.SquirrelDB.getSquirrel", return_value={"id": "1"})
+                mocker.patch("squirrel_server.SquirrelDB.deleteSquirrel", return_value={"id": 1})
                 mock_send_response, mock_send_header, mock_end_headers = mock_response_methods
 
                 handler = SquirrelServerHandler.__new__(SquirrelServerHandler)
                 handler.handleSquirrelsDelete("1")
 
-                SquirrelDB.deleteSquirrel.assert_called_once_with("1")
+                SquirrelDB.deleteSquirrel.assert_called_once_with("1", None)
                 mock_send_response.assert_called_once_with(204)
 
-            def it_calls_getSquirrel_when_delete_squirrels_is_called(mocker, dummy_client, dummy_server, mock_response_methods):
-                mocker.patch("squirrel_server.SquirrelDB.deleteSquirrel")
-                mock_get = mocker.patch("squirrel_server.SquirrelDB.getSquirrel", return_value={"id": "1"})
+            def it_does_not_read_the_squirrel_before_deleting_it(mocker, dummy_client, dummy_server, mock_response_methods):
+                mocker.patch("squirrel_server.SquirrelDB.deleteSquirrel", return_value={"id": 1})
+                mock_get = mocker.patch("squirrel_server.SquirrelDB.getSquirrel")
                 mock_send_response, mock_send_header, mock_end_headers = mock_response_methods
 
                 handler = SquirrelServerHandler.__new__(SquirrelServerHandler)
                 handler.handleSquirrelsDelete("1")
 
-                mock_get.assert_called_once()
+                mock_get.assert_not_called()
 
             def it_calls_end_headers_when_delete_squirrels_is_called(mocker, dummy_client, dummy_server, mock_response_methods):
-                mocker.patch("squirrel_server.SquirrelDB.deleteSquirrel")
-                mock_get = mocker.patch("squirrel_server.SquirrelDB.getSquirrel", return_value={"id": "1"})
+                mocker.patch("squirrel_server.SquirrelDB.deleteSquirrel", return_value={"id": 1})
                 mock_send_response, mock_send_header, mock_end_headers = mock_response_methods
 
                 handler = SquirrelServerHandler.__new__(SquirrelServerHandler)
@@ -315,8 +567,7 @@ def describe_Squirrel_Server_Handlers():
                 mock_end_headers.assert_called_once()
 
             def it_calls_send_response_when_delete_squirrels_is_called(mocker, dummy_client, dummy_server, mock_response_methods):
-                mocker.patch("squirrel_server.SquirrelDB.deleteSquirrel")
-                mock_get = mocker.patch("squirrel_server.SquirrelDB.getSquirrel", return_value={"id": "1"})
+                mocker.patch("squirrel_server.SquirrelDB.deleteSquirrel", return_value={"id": 1})
                 mock_send_response, mock_send_header, mock_end_headers = mock_response_methods
 
                 handler = SquirrelServerHandler.__new__(SquirrelServerHandler)
@@ -327,7 +578,7 @@ def describe_Squirrel_Server_Handlers():
         def describe_squirrel_does_not_exist():
 
             def it_returns_404_when_squirrel_does_not_exist(mocker, dummy_client, dummy_server):
-                mocker.patch("squirrel_server.SquirrelDB.getSquirrel", return_value=None)
+                mocker.patch("squirrel_server.SquirrelDB.deleteSquirrel", return_value=None)
                 mock_404 = mocker.patch.object(SquirrelServerHandler, "handle404")
 
                 handler = SquirrelServerHandler.__new__(SquirrelServerHandler)
@@ -336,6 +587,408 @@ def describe_Squirrel_Server_Handlers():
                 mock_404.assert_called_once()
 
 
+    def describe_conditional_requests():
+
+        @pytest.fixture
+        def squirrel(db_pool):
+            with db_pool.connection() as db:
+                db.createSquirrel("Chippy", "small")
+                return db.getSquirrelEntry(1)
+
+        def it_tags_a_squirrel_with_its_row_version(mocker, dummy_client, dummy_server, mock_response_methods, squirrel):
+            SquirrelServerHandler(FakeRequest(mocker.Mock(), "GET", "/squirrels/1"), dummy_client, dummy_server)
+
+            mock_response_methods[1].assert_any_call("ETag", '"r{}"'.format(squirrel[2]))
+
+        def it_answers_a_matching_if_none_match_with_a_bodyless_304(mocker, dummy_client, dummy_server, mock_response_methods, squirrel):
+            request = FakeRequest(mocker.Mock(), "GET", "/squirrels/1", headers={"If-None-Match": '"r{}"'.format(squirrel[2])})
+
+            handler = SquirrelServerHandler(request, dummy_client, dummy_server)
+
+            mock_response_methods[0].assert_called_once_with(304)
+            handler.wfile.write.assert_not_called()
+
+        def it_skips_the_index_query_when_the_collection_is_unchanged(mocker, dummy_client, dummy_server, mock_response_methods):
+            mocker.patch.object(SquirrelDB, "getDataVersion", return_value=7)
+            mock_get = mocker.patch.object(SquirrelDB, "getSquirrelRows")
+            request = FakeRequest(mocker.Mock(), "GET", "/squirrels", headers={"If-None-Match": 'W/"v7"'})
+
+            SquirrelServerHandler(request, dummy_client, dummy_server)
+
+            mock_response_methods[0].assert_called_once_with(304)
+            mock_get.assert_not_called()
+
+        def it_updates_without_a_pre_read_when_if_match_is_current(mocker, dummy_client, dummy_server, mock_response_methods, squirrel):
+            mock_get = mocker.spy(SquirrelDB, "getSquirrel")
+            request = FakeRequest(mocker.Mock(), "PUT", "/squirrels/1", body="name=Chip&size=tiny",
+                                  headers={"If-Match": '"r{}"'.format(squirrel[2])})
+
+            SquirrelServerHandler(request, dummy_client, dummy_server)
+
+            mock_response_methods[0].assert_called_once_with(200)
+            mock_get.assert_not_called()
+
+        def it_answers_412_when_if_match_is_stale(mocker, dummy_client, dummy_server, mock_response_methods, db_pool, squirrel):
+            request = FakeRequest(mocker.Mock(), "DELETE", "/squirrels/1", headers={"If-Match": '"r{}"'.format(squirrel[2] - 1)})
+
+            SquirrelServerHandler(request, dummy_client, dummy_server)
+
+            mock_response_methods[0].assert_called_once_with(412)
+            with db_pool.connection() as db:
+                assert db.getSquirrel(1) is not None
+
+        def it_returns_the_new_etag_so_writes_can_chain_if_match(mocker, dummy_client, dummy_server, mock_response_methods, squirrel):
+            request = FakeRequest(mocker.Mock(), "PUT", "/squirrels/1", body="name=Chip&size=tiny",
+                                  headers={"If-Match": '"r{}"'.format(squirrel[2])})
+            SquirrelServerHandler(request, dummy_client, dummy_server)
+            etag = dict(call.args for call in mock_response_methods[1].call_args_list)["ETag"]
+
+            request = FakeRequest(mocker.Mock(), "DELETE", "/squirrels/1", headers={"If-Match": etag})
+            SquirrelServerHandler(request, dummy_client, dummy_server)
+
+            assert etag == '"r{}"'.format(squirrel[2] + 1)
+            assert mock_response_methods[0].call_args_list == [call(200), call(204)]
+
+        def it_matches_if_match_lists_against_every_format(mocker, dummy_client, dummy_server, mock_response_methods, squirrel):
+            tags = '"r{0}-other", "r{0}-msgpack"'.format(squirrel[2])
+            request = FakeRequest(mocker.Mock(), "DELETE", "/squirrels/1", headers={"If-Match": tags})
+
+            SquirrelServerHandler(request, dummy_client, dummy_server)
+
+            mock_response_methods[0].assert_called_once_with(204)
+
+        def it_tags_ndjson_streams_apart_from_the_json_listing(mocker, dummy_client, dummy_server, mock_response_methods):
+            mocker.patch.object(SquirrelDB, "getDataVersion", return_value=2)
+            request = FakeRequest(mocker.Mock(), "GET", "/squirrels",
+                                  headers={"Accept": "application/x-ndjson", "If-None-Match": '"v2"'})
+
+            SquirrelServerHandler(request, dummy_client, dummy_server)
+
+            mock_response_methods[0].assert_called_once_with(200)
+            mock_response_methods[1].assert_any_call("ETag", '"v2-ndjson"')
+
+    def describe_handle_Squirrels_Batch():
+
+        def it_creates_valid_items_in_one_call(mocker, dummy_client, dummy_server):
+            mock_create = mocker.patch.object(SquirrelDB, "createSquirrels", return_value=[7])
+            body = json.dumps([{"name": "Chippy", "size": "small"}, {"name": "Nameless"}])
+
+            handler = SquirrelServerHandler(FakeRequest(mocker.Mock(), "POST", "/squirrels:batch", body=body), dummy_client, dummy_server)
+
+            mock_create.assert_called_once_with([("Chippy", "small")])
+            results = json.loads(handler.wfile.write.call_args[0][0])
+            assert results == [{"status": 201, "id": 7}, {"status": 400, "error": "name and size are required"}]
+
+        def it_reports_missing_squirrels_on_update(mocker, dummy_client, dummy_server):
+            mock_update = mocker.patch.object(SquirrelDB, "updateSquirrels", return_value=[True, False])
+            body = json.dumps([{"id": 1, "name": "Chippy", "size": "small"}, {"id": 2, "name": "Nutty", "size": "large"}])
+
+            handler = SquirrelServerHandler(FakeRequest(mocker.Mock(), "PUT", "/squirrels:batch", body=body), dummy_client, dummy_server)
+
+            mock_update.assert_called_once_with([(1, "Chippy", "small"), (2, "Nutty", "large")])
+            results = json.loads(handler.wfile.write.call_args[0][0])
+            assert results == [{"status": 204, "id": 1}, {"status": 404, "id": 2}]
+
+        def it_accepts_plain_ids_or_objects_on_delete(mocker, dummy_client, dummy_server):
+            mock_delete = mocker.patch.object(SquirrelDB, "deleteSquirrels", return_value=[True, True])
+
+            SquirrelServerHandler(FakeRequest(mocker.Mock(), "DELETE", "/squirrels:batch", body='[1, {"id": 2}]'), dummy_client, dummy_server)
+
+            mock_delete.assert_called_once_with([1, 2])
+
+        def it_skips_the_db_when_no_item_is_valid(mocker, dummy_client, dummy_server):
+            mock_connection = mocker.spy(SquirrelServerHandler.dbPool, "connection")
+
+            for method in ("POST", "PUT", "DELETE"):
+                request = FakeRequest(mocker.Mock(), method, "/squirrels:batch", body='[{"name": 1}, {"name": 2}]')
+                handler = SquirrelServerHandler(request, dummy_client, dummy_server)
+
+                results = json.loads(handler.wfile.write.call_args[0][0])
+                assert [result["status"] for result in results] == [400, 400]
+            mock_connection.assert_not_called()
+
+        def it_rejects_a_body_that_is_not_a_json_array(mocker, dummy_client, dummy_server, mock_response_methods):
+            mock_create = mocker.patch.object(SquirrelDB, "createSquirrels")
+
+            SquirrelServerHandler(FakeRequest(mocker.Mock(), "POST", "/squirrels:batch", body='{"name": "x"}'), dummy_client, dummy_server)
+
+            mock_response_methods[0].assert_called_once_with(400)
+            mock_create.assert_not_called()
+
+    def describe_request_bodies():
+
+        def it_creates_a_squirrel_from_json(mocker, dummy_client, dummy_server, mock_response_methods):
+            mock_create = mocker.patch.object(SquirrelDB, "createSquirrel", return_value={"id": 1, "name": "Chippy", "size": "small"})
+            request = FakeRequest(mocker.Mock(), "POST", "/squirrels", body='{"name": "Chippy", "size": "small"}',
+                                  headers={"Content-Type": "application/json; charset=utf-8"})
+
+            SquirrelServerHandler(request, dummy_client, dummy_server)
+
+            mock_create.assert_called_once_with("Chippy", "small")
+            mock_response_methods[0].assert_called_once_with(201)
+
+        def it_answers_400_for_malformed_json(mocker, dummy_client, dummy_server, mock_response_methods):
+            mock_create = mocker.patch.object(SquirrelDB, "createSquirrel")
+            request = FakeRequest(mocker.Mock(), "POST", "/squirrels", body='{"name": ',
+                                  headers={"Content-Type": "application/json"})
+
+            SquirrelServerHandler(request, dummy_client, dummy_server)
+
+            mock_response_methods[0].assert_called_once_with(400)
+            mock_create.assert_not_called()
+
+        def it_answers_400_when_a_field_is_missing(mocker, fake_bad_request, dummy_client, dummy_server, mock_response_methods):
+            SquirrelServerHandler(fake_bad_request, dummy_client, dummy_server)
+
+            mock_response_methods[0].assert_called_once_with(400)
+
+        def it_refuses_bodies_over_the_limit_with_413(mocker, fake_create_squirrel_request, dummy_client, dummy_server, mock_response_methods):
+            mocker.patch.object(SquirrelServerHandler, "maxBodyBytes", 8)
+            mock_create = mocker.patch.object(SquirrelDB, "createSquirrel")
+
+            SquirrelServerHandler(fake_create_squirrel_request, dummy_client, dummy_server)
+
+            mock_response_methods[0].assert_called_once_with(413)
+            mock_create.assert_not_called()
+
+        def it_answers_415_for_unknown_content_types(mocker, dummy_client, dummy_server, mock_response_methods):
+            request = FakeRequest(mocker.Mock(), "POST", "/squirrels", body="<squirrel/>", headers={"Content-Type": "text/xml"})
+
+            SquirrelServerHandler(request, dummy_client, dummy_server)
+
+            mock_response_methods[0].assert_called_once_with(415)
+
+        def it_keeps_every_value_of_a_repeated_form_field():
+            assert decodeForm(b"name=Chippy&size=small&size=large") == {"name": "Chippy", "size": ["small", "large"]}
+
+        def it_speaks_messagepack_both_ways(mocker, dummy_client, dummy_server):
+            msgpack = pytest.importorskip("msgpack")
+            mocker.patch.object(SquirrelDB, "createSquirrels", return_value=[1])
+            request = FakeRequest(mocker.Mock(), "POST", "/squirrels:batch",
+                                  body=msgpack.packb([{"name": "Chippy", "size": "small"}]),
+                                  headers={"Content-Type": "application/msgpack", "Accept": "application/msgpack"})
+
+            handler = SquirrelServerHandler(request, dummy_client, dummy_server)
+
+            assert msgpack.unpackb(handler.wfile.write.call_args[0][0]) == [{"status": 201, "id": 1}]
+
+    def describe_handle_Squirrels_Changes():
+
+        @pytest.fixture
+        def change_log(mocker):
+            changeLog = ChangeLog(maxEntries=2)
+            mocker.patch.object(SquirrelServerHandler, "changeLog", changeLog)
+            return changeLog
+
+        def it_returns_the_changes_after_since(mocker, dummy_client, dummy_server, change_log):
+            change_log.append([("create", 1, {"id": 1, "name": "Chippy", "size": "small"}), ("delete", 1, None)])
+
+            handler = SquirrelServerHandler(FakeRequest(mocker.Mock(), "GET", "/squirrels/changes?since=1"), dummy_client, dummy_server)
+
+            handler.wfile.write.assert_called_once_with(b'{"changes": [{"seq": 2, "op": "delete", "id": 1, "squirrel": null}], "next": 2}')
+
+        def it_waits_for_a_change_when_asked_to(mocker, dummy_client, dummy_server, change_log):
+            timer = threading.Timer(0.05, change_log.append, [[("delete", 3, None)]])
+            timer.start()
+
+            handler = SquirrelServerHandler(FakeRequest(mocker.Mock(), "GET", "/squirrels/changes?since=0&wait=5"), dummy_client, dummy_server)
+
+            timer.join()
+            handler.wfile.write.assert_called_once_with(b'{"changes": [{"seq": 1, "op": "delete", "id": 3, "squirrel": null}], "next": 1}')
+
+        def it_tells_clients_that_fell_behind_to_resync(mocker, dummy_client, dummy_server, change_log):
+            change_log.append([("delete", squirrelId, None) for squirrelId in range(5)])
+
+            handler = SquirrelServerHandler(FakeRequest(mocker.Mock(), "GET", "/squirrels/changes?since=1"), dummy_client, dummy_server)
+
+            handler.wfile.write.assert_called_once_with(b'{"resync": true, "next": 5}')
+
+        def it_streams_server_sent_events(mocker, dummy_client, dummy_server, change_log, mock_response_methods):
+            mocker.patch.object(SquirrelServerHandler, "changesStreamSeconds", 0.05)
+            mocker.patch.object(SquirrelServerHandler, "changesKeepAlive", 0.01)
+            change_log.append([("delete", 4, None)])
+            request = FakeRequest(mocker.Mock(), "GET", "/squirrels/changes", headers={"Accept": "text/event-stream", "Last-Event-ID": "0"})
+
+            handler = SquirrelServerHandler(request, dummy_client, dummy_server)
+
+            mock_response_methods[1].assert_any_call("Content-Type", "text/event-stream")
+            writes = [args[0] for args, kwargs in handler.wfile.write.call_args_list]
+            assert writes[0] == b'id: 1\ndata: {"seq": 1, "op": "delete", "id": 4, "squirrel": null}\n\n'
+            assert b": keep-alive\n\n" in writes
+
+        def it_answers_404_without_a_change_log(mocker, dummy_client, dummy_server, mock_response_methods):
+            SquirrelServerHandler(FakeRequest(mocker.Mock(), "GET", "/squirrels/changes"), dummy_client, dummy_server)
+
+            mock_response_methods[0].assert_called_once_with(404)
+
+        def it_rejects_a_bad_since(mocker, dummy_client, dummy_server, change_log, mock_response_methods):
+            SquirrelServerHandler(FakeRequest(mocker.Mock(), "GET", "/squirrels/changes?since=-1"), dummy_client, dummy_server)
+
+            mock_response_methods[0].assert_called_once_with(400)
+
+    def describe_handle_Metrics():
+
+        @pytest.fixture
+        def metrics(mocker):
+            metrics = Metrics()
+            mocker.patch.object(SquirrelServerHandler, "metrics", metrics)
+            return metrics
+
+        def it_records_each_request_by_handler_and_status(mocker, dummy_client, dummy_server, metrics):
+            SquirrelServerHandler(FakeRequest(mocker.Mock(), "GET", "/squirrels/99"), dummy_client, dummy_server)
+
+            handler = SquirrelServerHandler(FakeRequest(mocker.Mock(), "GET", "/metrics"), dummy_client, dummy_server)
+
+            body = handler.wfile.write.call_args[0][0].decode("utf-8")
+            assert 'squirrel_requests_total{handler="handleSquirrelsRetrieve",method="GET",status="404"} 1\n' in body
+            assert 'squirrel_requests_in_flight{handler="handleMetrics",method="GET"} 1\n' in body
+
+        def it_labels_unrouted_requests_by_their_error_handler(mocker, dummy_client, dummy_server, metrics):
+            SquirrelServerHandler(FakeRequest(mocker.Mock(), "PATCH", "/squirrels"), dummy_client, dummy_server)
+
+            assert 'handler="handle405",method="PATCH",status="405"} 1\n' in metrics.render()
+
+        def it_serves_the_prometheus_text_format(mocker, dummy_client, dummy_server, metrics, mock_response_methods):
+            SquirrelServerHandler(FakeRequest(mocker.Mock(), "GET", "/metrics"), dummy_client, dummy_server)
+
+            mock_response_methods[1].assert_any_call("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+
+        def it_answers_404_when_metrics_are_off(mocker, dummy_client, dummy_server, mock_response_methods):
+            SquirrelServerHandler(FakeRequest(mocker.Mock(), "GET", "/metrics"), dummy_client, dummy_server)
+
+            mock_response_methods[0].assert_called_once_with(404)
+
+    def describe_handle_Profile():
+
+        @pytest.fixture
+        def profiler(mocker):
+            profiler = RequestProfiler()
+            mocker.patch.object(SquirrelServerHandler, "profiler", profiler)
+            return profiler
+
+        def it_profiles_requests_sending_the_header(mocker, dummy_client, dummy_server, profiler):
+            request = FakeRequest(mocker.Mock(), "GET", "/squirrels/99", headers={"X-Squirrel-Profile": "1"})
+
+            SquirrelServerHandler(request, dummy_client, dummy_server)
+
+            assert profiler.settings()["profiled"] == 1
+            assert profiler.pstatsData() is not None
+
+        def it_leaves_other_requests_alone(mocker, dummy_client, dummy_server, profiler):
+            SquirrelServerHandler(FakeRequest(mocker.Mock(), "GET", "/squirrels/99"), dummy_client, dummy_server)
+
+            assert profiler.settings()["profiled"] == 0
+
+        def it_changes_settings_at_runtime(mocker, dummy_client, dummy_server, profiler):
+            request = FakeRequest(mocker.Mock(), "PUT", "/debug/profile", body='{"mode": "stacks", "sampleRate": 1}',
+                                  headers={"Content-Type": "application/json"})
+
+            handler = SquirrelServerHandler(request, dummy_client, dummy_server)
+
+            settings = json.loads(handler.wfile.write.call_args[0][0])
+            assert (settings["mode"], settings["sampleRate"]) == ("stacks", 1.0)
+            SquirrelServerHandler(FakeRequest(mocker.Mock(), "GET", "/squirrels/99"), dummy_client, dummy_server)
+            assert "handleSquirrelsRetrieve;" in profiler.collapsedStacks()
+
+        def it_profiles_routing_as_well_as_the_handler(mocker, dummy_client, dummy_server, profiler):
+            request = FakeRequest(mocker.Mock(), "GET", "/squirrels/99", headers={"X-Squirrel-Profile": "1"})
+
+            SquirrelServerHandler(request, dummy_client, dummy_server)
+
+            functions = {(os.path.basename(path), name) for path, line, name in marshal.loads(profiler.pstatsData())}
+            assert ("squirrel_router.py", "match") in functions
+            assert ("squirrel_server.py", "handleSquirrelsRetrieve") in functions
+
+        def it_rejects_bad_settings(mocker, dummy_client, dummy_server, profiler, mock_response_methods):
+            request = FakeRequest(mocker.Mock(), "PUT", "/debug/profile", body='{"sampleRate": 5}',
+                                  headers={"Content-Type": "application/json"})
+
+            SquirrelServerHandler(request, dummy_client, dummy_server)
+
+            mock_response_methods[0].assert_called_once_with(400)
+            assert profiler.sampleRate == 0.0
+
+        def it_serves_the_collected_pstats(mocker, dummy_client, dummy_server, profiler, mock_response_methods):
+            profiler.profile(sum, [1, 2])
+
+            SquirrelServerHandler(FakeRequest(mocker.Mock(), "GET", "/debug/profile/pstats"), dummy_client, dummy_server)
+
+            mock_response_methods[1].assert_any_call("Content-Type", "application/octet-stream")
+
+        def it_answers_404_when_profiling_is_off(mocker, dummy_client, dummy_server, mock_response_methods):
+            SquirrelServerHandler(FakeRequest(mocker.Mock(), "GET", "/debug/profile"), dummy_client, dummy_server)
+
+            mock_response_methods[0].assert_called_once_with(404)
+
+    def describe_admission():
+
+        def it_refuses_requests_past_the_in_flight_limit_with_503(mocker, dummy_client, dummy_server, mock_response_methods):
+            admission = AdmissionController(maxInFlight=1)
+            admission.inFlight = 1
+            mocker.patch.object(SquirrelServerHandler, "admission", admission)
+            mock_get = mocker.patch.object(SquirrelDB, "getSquirrel")
+
+            SquirrelServerHandler(FakeRequest(mocker.Mock(), "GET", "/squirrels/1"), dummy_client, dummy_server)
+
+            mock_response_methods[0].assert_called_once_with(503)
+            mock_response_methods[1].assert_any_call("Retry-After", "1")
+            mock_response_methods[1].assert_any_call("Connection", "close")
+            mock_get.assert_not_called()
+
+        def it_answers_clients_over_their_rate_with_429(mocker, dummy_client, dummy_server, mock_response_methods):
+            mocker.patch.object(SquirrelServerHandler, "admission", AdmissionController(rate=0.5))
+
+            SquirrelServerHandler(FakeRequest(mocker.Mock(), "GET", "/nope"), dummy_client, dummy_server)
+            SquirrelServerHandler(FakeRequest(mocker.Mock(), "GET", "/nope"), dummy_client, dummy_server)
+
+            assert mock_response_methods[0].call_args_list == [call(404), call(429)]
+            mock_response_methods[1].assert_any_call("Retry-After", "2")
+
+        def it_frees_the_slot_once_the_handler_is_done(mocker, dummy_client, dummy_server):
+            admission = AdmissionController(maxInFlight=1)
+            mocker.patch.object(SquirrelServerHandler, "admission", admission)
+
+            SquirrelServerHandler(FakeRequest(mocker.Mock(), "GET", "/nope"), dummy_client, dummy_server)
+
+            assert admission.inFlight == 0
+
+    def describe_access_log():
+
+        def it_logs_requests_by_default(mocker, dummy_client, dummy_server):
+            mock_log = mocker.patch.object(SquirrelServerHandler, "log_message")
+
+            SquirrelServerHandler(FakeRequest(mocker.Mock(), "GET", "/squirrels/99"), dummy_client, dummy_server)
+
+            mock_log.assert_called_once()
+
+        def it_can_be_turned_off(mocker, dummy_client, dummy_server):
+            mocker.patch.object(SquirrelServerHandler, "accessLog", False)
+            mock_log = mocker.patch.object(SquirrelServerHandler, "log_message")
+
+            SquirrelServerHandler(FakeRequest(mocker.Mock(), "GET", "/squirrels/99"), dummy_client, dummy_server)
+
+            mock_log.assert_not_called()
+
+    def describe_routing():
+
+        def it_answers_405_with_the_allowed_methods(mocker, dummy_client, dummy_server, mock_response_methods):
+            SquirrelServerHandler(FakeRequest(mocker.Mock(), "DELETE", "/squirrels"), dummy_client, dummy_server)
+
+            mock_response_methods[0].assert_called_once_with(405)
+            mock_response_methods[1].assert_any_call("Allow", "GET, POST")
+
+        def it_strips_the_query_string_before_matching_an_id(mocker, dummy_client, dummy_server):
+            mock_retrieve = mocker.patch.object(SquirrelServerHandler, "handleSquirrelsRetrieve")
+
+            SquirrelServerHandler(FakeRequest(mocker.Mock(), "GET", "/squirrels/7?fields=name"), dummy_client, dummy_server)
+
+            mock_retrieve.assert_called_once_with(squirrelId="7")
+
+        def it_answers_404_for_paths_without_a_route(mocker, dummy_client, dummy_server, mock_response_methods):
+            SquirrelServerHandler(FakeRequest(mocker.Mock(), "GET", "/squirrels/7/acorns"), dummy_client, dummy_server)
+
+            mock_response_methods[0].assert_called_once_with(404)
+
     def describe_handle_404():
 
         def it_sends_404_status_code(mocker, dummy_client, dummy_server, mock_response_methods):
@@ -356,7 +1009,7 @@ def describe_Squirrel_Server_Handlers():
             
             handler.handle404()
             
-            mock_send_header.assert_called_once_with("Content-Type", "text/plain")
+            assert mock_send_header.call_args_list == [call("Content-Type", "text/plain"), call("Content-Length", "13")]
 
         def it_calls_end_headers(mocker, dummy_client, dummy_server, mock_response_methods):
             fake_wfile = mocker.Mock()
@@ -378,3 +1031,322 @@ def describe_Squirrel_Server_Handlers():
             
             fake_wfile.write.assert_called_once_with(bytes("404 Not Found", "utf-8"))
 
+
+def describe_run_configuration():
+
+    def describe_parse_args():
+
+        def it_defaults_to_threaded_on_localhost_8080():
+            config = parseArgs([], environ={})
+
+            assert (config.host, config.port, config.mode) == ("127.0.0.1", 8080, "threaded")
+
+        def it_reads_settings_from_the_environment():
+            config = parseArgs([], environ={"SQUIRREL_HOST": "0.0.0.0", "SQUIRREL_PORT": "9000",
+                                            "SQUIRREL_MODE": "prefork", "SQUIRREL_WORKERS": "3",
+                                            "SQUIRREL_PROCESSES": "5", "SQUIRREL_DB": "other.db"})
+
+            assert (config.host, config.port, config.mode) == ("0.0.0.0", 9000, "prefork")
+            assert (config.workers, config.processes, config.db) == (3, 5, "other.db")
+
+        def it_keeps_a_change_log_unless_its_size_is_zero():
+            assert parseArgs([], environ={}).change_log_size == 10000
+            assert parseArgs([], environ={"SQUIRREL_CHANGE_LOG_SIZE": "0"}).change_log_size == 0
+
+        def it_bounds_the_index_cache_by_bytes():
+            assert parseArgs([], environ={}).index_cache_bytes == 64 << 20
+            assert parseArgs(["--index-cache-bytes", "1000"], environ={}).index_cache_bytes == 1000
+
+        def it_leaves_profiling_off_unless_asked():
+            assert parseArgs([], environ={}).profiling is False
+            config = parseArgs(["--profiling", "--profile-mode", "stacks"], environ={"SQUIRREL_PROFILE_SAMPLE_RATE": "0.01"})
+            assert (config.profiling, config.profile_mode, config.profile_sample_rate) == (True, "stacks", 0.01)
+
+        def it_bounds_the_accept_queue_but_not_requests_by_default():
+            config = parseArgs([], environ={})
+            assert (config.accept_queue, config.max_in_flight, config.rate_limit) == (128, 0, 0.0)
+            config = parseArgs(["--max-in-flight", "32", "--read-reserve", "8"], environ={"SQUIRREL_RATE_LIMIT": "50"})
+            assert (config.max_in_flight, config.read_reserve, config.rate_limit) == (32, 8, 50.0)
+
+        def it_lets_flags_override_the_environment():
+            config = parseArgs(["--port", "9100", "--workers", "2"], environ={"SQUIRREL_PORT": "9000"})
+
+            assert (config.port, config.workers) == (9100, 2)
+
+    def describe_make_server():
+
+        def it_builds_a_thread_pool_server_with_its_own_db_pool(mocker):
+            mocker.patch.object(SquirrelServerHandler, "dbPool")
+            config = parseArgs(["--port", "0", "--workers", "3", "--db", "scratch.db"], environ={})
+
+            server = makeServer(config)
+
+            assert isinstance(server, ThreadPoolHTTPServer)
+            assert server.executor._max_workers == 3
+            assert SquirrelServerHandler.dbPool.filename == "scratch.db"
+            server.server_close()
+
+        def it_checks_cache_hits_against_other_processes_only_when_asked(mocker):
+            mocker.patch.object(SquirrelServerHandler, "dbPool")
+            config = parseArgs(["--port", "0", "--cache-size", "10"], environ={})
+
+            for otherWriters in (False, True):
+                server = makeServer(config, otherWriters=otherWriters)
+
+                assert SquirrelServerHandler.dbPool.cache.otherWriters is otherWriters
+                server.server_close()
+
+        def it_builds_a_plain_server_in_single_mode(mocker):
+            mocker.patch.object(SquirrelServerHandler, "dbPool")
+            config = parseArgs(["--port", "0", "--mode", "single"], environ={})
+
+            server = makeServer(config)
+
+            assert not isinstance(server, ThreadPoolHTTPServer)
+            assert not server.keepAlive
+            server.server_close()
+
+    def describe_thread_pool_server():
+
+        def it_hands_requests_to_the_worker_pool(mocker):
+            server = ThreadPoolHTTPServer(("127.0.0.1", 0), SquirrelServerHandler, workers=1)
+            mock_submit = mocker.patch.object(server.executor, "submit")
+
+            server.process_request("request", ("127.0.0.1", 80))
+
+            mock_submit.assert_called_once_with(server.processRequestWorker, "request", ("127.0.0.1", 80))
+            server.server_close()
+
+        def it_refuses_connections_past_the_accept_queue_with_503(mocker):
+            server = ThreadPoolHTTPServer(("127.0.0.1", 0), SquirrelServerHandler, workers=1, maxQueued=1)
+            mock_submit = mocker.patch.object(server.executor, "submit")
+            server.process_request("request", ("127.0.0.1", 80))
+            client, request = socket.socketpair()
+            client.sendall(b"GET /squirrels HTTP/1.1\r\n\r\n")
+
+            server.process_request(request, ("127.0.0.1", 81))
+
+            assert client.recv(65536).startswith(b"HTTP/1.1 503 Service Unavailable\r\nRetry-After: 1\r\n")
+            assert mock_submit.call_count == 1
+            client.close()
+            server.server_close()
+
+        def it_counts_connections_the_accept_queue_refuses(mocker):
+            metrics = Metrics()
+            mocker.patch.object(SquirrelServerHandler, "metrics", metrics)
+            server = ThreadPoolHTTPServer(("127.0.0.1", 0), SquirrelServerHandler, workers=1, maxQueued=1)
+            mocker.patch.object(server.executor, "submit")
+            server.process_request("request", ("127.0.0.1", 80))
+            clients = []
+            for sent in [b"GET /squirrels HTTP/1.1\r\n\r\n", b"\x16\x03\x01", b""]:
+                client, request = socket.socketpair()
+                client.sendall(sent)
+                clients.append(client)
+                server.process_request(request, ("127.0.0.1", 81))
+
+            rendered = metrics.render()
+            assert 'handler="handleRefused",method="GET",status="503"} 1' in rendered
+            assert 'handler="handleRefused",method="-",status="503"} 2' in rendered
+            for client in clients:
+                client.close()
+            server.server_close()
+
+
+#a real server on a loopback port, with the autouse header patches undone
+#so responses actually reach the socket
+@pytest.fixture
+def live_server(mocker):
+    mocker.patch.object(SquirrelServerHandler, "end_headers", BaseHTTPRequestHandler.end_headers)
+    mocker.patch.object(SquirrelServerHandler, "wbufsize", 0)
+    mocker.patch.object(SquirrelServerHandler, "log_message")
+    server = ThreadPoolHTTPServer(("127.0.0.1", 0), SquirrelServerHandler, workers=2)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+def read_responses(sock, count):
+    reader = sock.makefile("rb")
+    responses = []
+    for i in range(count):
+        status = reader.readline()
+        headers = {}
+        line = reader.readline()
+        while line not in (b"\r\n", b""):
+            name, _, value = line.decode("latin-1").partition(":")
+            headers[name.lower()] = value.strip()
+            line = reader.readline()
+        body = reader.read(int(headers.get("content-length", 0)))
+        responses.append((status, headers, body))
+    return responses
+
+def describe_keep_alive():
+
+    def it_answers_pipelined_requests_on_one_connection(live_server, mocker):
+        mocker.patch.object(SquirrelDB, "getSquirrel", side_effect=lambda squirrelId: {"id": squirrelId})
+        sock = socket.create_connection(live_server.server_address)
+
+        sock.sendall(b"GET /squirrels/1 HTTP/1.1\r\nHost: x\r\n\r\n"
+                     b"GET /squirrels/2 HTTP/1.1\r\nHost: x\r\n\r\n")
+        responses = read_responses(sock, 2)
+        sock.close()
+
+        assert [body for status, headers, body in responses] == [b'{"id": "1"}', b'{"id": "2"}']
+
+    def it_sends_content_length_on_201_and_404_but_not_204(live_server, mocker):
+        sock = socket.create_connection(live_server.server_address)
+
+        sock.sendall(b"POST /squirrels HTTP/1.1\r\nContent-Length: 22\r\n\r\nname=Chippy&size=small"
+                     b"DELETE /squirrels/1 HTTP/1.1\r\n\r\n"
+                     b"GET /nope HTTP/1.1\r\n\r\n")
+        responses = read_responses(sock, 3)
+        sock.close()
+
+        assert [status.split()[1] for status, headers, body in responses] == [b"201", b"204", b"404"]
+        assert [headers.get("content-length") for status, headers, body in responses] == ["44", None, "13"]
+
+    def it_hangs_up_idle_connections_on_shutdown(live_server):
+        sock = socket.create_connection(live_server.server_address)
+        sock.sendall(b"GET /nope HTTP/1.1\r\n\r\n")
+        read_responses(sock, 1)
+        started = time.monotonic()
+
+        live_server.shutdown()
+        live_server.server_close()
+
+        assert time.monotonic() - started < 5
+        assert sock.recv(1) == b""
+        sock.close()
+
+    def it_hangs_up_idle_connections_when_others_wait_for_a_worker(live_server, mocker):
+        mocker.patch.object(SquirrelServerHandler, "timeout", 5)
+        idle = []
+        for i in range(2):
+            sock = socket.create_connection(live_server.server_address)
+            sock.sendall(b"GET /nope HTTP/1.1\r\n\r\n")
+            read_responses(sock, 1)
+            idle.append(sock)
+        started = time.monotonic()
+
+        waiting = socket.create_connection(live_server.server_address)
+        waiting.sendall(b"GET /nope HTTP/1.1\r\n\r\n")
+        responses = read_responses(waiting, 1)
+
+        assert responses[0][0].split()[1] == b"404"
+        assert time.monotonic() - started < 2
+        hungUp = 0
+        for sock in idle:
+            sock.settimeout(0.2)
+            try:
+                hungUp += sock.recv(1) == b""
+            except socket.timeout:
+                pass
+        assert hungUp == 1
+        for sock in idle + [waiting]:
+            sock.close()
+
+    def it_closes_every_connection_after_its_response_in_single_mode(mocker):
+        mocker.patch.object(SquirrelServerHandler, "end_headers", BaseHTTPRequestHandler.end_headers)
+        mocker.patch.object(SquirrelServerHandler, "log_message")
+        server = SingleHTTPServer(("127.0.0.1", 0), SquirrelServerHandler)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        try:
+            sock = socket.create_connection(server.server_address)
+            sock.sendall(b"GET /nope HTTP/1.1\r\n\r\n")
+            responses = read_responses(sock, 1)
+
+            assert responses[0][1]["connection"] == "close"
+            assert sock.recv(1) == b""
+            sock.close()
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    def it_skips_request_bodies_the_handler_did_not_read(live_server):
+        sock = socket.create_connection(live_server.server_address)
+
+        sock.sendall(b"POST /nope HTTP/1.1\r\nContent-Length: 5\r\n\r\nhello"
+                     b"GET /nope HTTP/1.1\r\n\r\n")
+        responses = read_responses(sock, 2)
+        sock.close()
+
+        assert [status.split()[1] for status, headers, body in responses] == [b"404", b"404"]
+
+    def it_streams_chunked_json_to_http_1_1_clients(live_server, mocker):
+        mocker.patch.object(SquirrelDB, "iterSquirrelRows", return_value=(row for row in [{"id": 1}, {"id": 2}]))
+        sock = socket.create_connection(live_server.server_address)
+
+        sock.sendall(b"GET /squirrels?stream=json HTTP/1.1\r\n\r\n")
+        reader = sock.makefile("rb")
+        head = b""
+        while not head.endswith(b"\r\n\r\n"):
+            head += reader.readline()
+        body = reader.readline() + reader.readline() + reader.readline() + reader.readline()
+        sock.close()
+
+        assert b"Transfer-Encoding: chunked" in head
+        assert body == b"16\r\n[{\"id\": 1}, {\"id\": 2}]\r\n0\r\n\r\n"
+
+    def it_closes_the_connection_after_the_request_cap(live_server, mocker):
+        mocker.patch.object(SquirrelServerHandler, "maxRequestsPerConnection", 2)
+        sock = socket.create_connection(live_server.server_address)
+
+        sock.sendall(b"GET /nope HTTP/1.1\r\n\r\n" * 2)
+        responses = read_responses(sock, 2)
+        leftover = sock.recv(1)
+        sock.close()
+
+        assert "connection" not in responses[0][1]
+        assert responses[1][1]["connection"] == "close"
+        assert leftover == b""
+
+
+def describe_ResponseCache():
+
+    def it_returns_bodies_for_the_current_version():
+        cache = ResponseCache()
+        cache.put(3, "identity", b"plain")
+        cache.put(3, "gzip", b"packed")
+
+        assert (cache.get(3, "identity"), cache.get(3, "gzip")) == (b"plain", b"packed")
+
+    def it_drops_old_versions_when_a_newer_one_arrives():
+        cache = ResponseCache()
+        cache.put(3, "identity", b"old")
+        cache.put(4, "identity", b"new")
+
+        assert cache.get(3, "identity") is None
+        assert cache.get(4, "identity") == b"new"
+
+    def it_ignores_bodies_for_older_versions():
+        cache = ResponseCache()
+        cache.put(4, "identity", b"new")
+        cache.put(3, "identity", b"old")
+
+        assert cache.get(4, "identity") == b"new"
+
+    def it_stops_storing_new_keys_once_full():
+        cache = ResponseCache(maxEntries=1)
+        cache.put(4, "identity", b"plain")
+        cache.put(4, "gzip", b"packed")
+
+        assert cache.get(4, "gzip") is None
+        assert cache.get(4, "identity") == b"plain"
+
+    def it_stops_storing_bodies_past_its_byte_budget():
+        cache = ResponseCache(maxBytes=10)
+        cache.put(4, "page1", b"x" * 6)
+        cache.put(4, "page2", b"x" * 6)
+        cache.put(4, "page3", (b"x" * 4, []), 4)
+
+        assert cache.get(4, "page2") is None
+        assert (cache.get(4, "page1"), cache.get(4, "page3")) == (b"x" * 6, (b"x" * 4, []))
+
+    def it_starts_a_fresh_budget_for_a_new_version():
+        cache = ResponseCache(maxBytes=10)
+        cache.put(4, "page1", b"x" * 10)
+        cache.put(5, "page1", b"y" * 10)
+
+        assert cache.get(5, "page1") == b"y" * 10